@@ -0,0 +1,23 @@
+"""
+Rebuilds the profile pp timeline of every registered user in every mode by replaying their scores in date order.
+Run it once after creating the profile_pp_timeline table, and again if the table is ever suspected to be out of date.
+"""
+import time
+from sqlalchemy import select
+from database.ORM import ORM
+from database.models import RegisteredUser
+from database.timelineService import backfill_timeline
+from database.util import modes
+
+orm = ORM()
+session = orm.sessionmaker()
+user_ids = session.scalars(select(RegisteredUser.user_id)).all()
+
+start = time.time()
+for i, user_id in enumerate(user_ids):
+    for mode in modes:
+        points = backfill_timeline(session, user_id, mode)
+        if points:
+            print('%s/%s: %s points for %s in %s' % (i + 1, len(user_ids), points, user_id, mode))
+session.close()
+print('Elapsed time: ' + str(time.time() - start))
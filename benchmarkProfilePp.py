@@ -0,0 +1,38 @@
+"""
+Times profile pp for many users: the batch (one get_top_pp_matrix query, then weighted_pp_sums) against one get_top_n
+query per user, on the configured database.
+    python benchmarkProfilePp.py --users 1000 --mode osu
+"""
+import argparse
+import time
+from sqlalchemy import select
+from database.ORM import ORM
+from database.models import RegisteredUser
+from database.scoreService import get_top_pp_matrix, weighted_pp_sums, get_top_n
+from database.userService import get_profile_pp
+
+parser = argparse.ArgumentParser(description='Time batch profile pp against per-user queries')
+parser.add_argument('--users', type=int, default=1000, help='number of registered users to compute')
+parser.add_argument('--mode', default='osu', choices=['osu', 'taiko', 'fruits', 'mania'])
+parser.add_argument('--skip-loop', action='store_true', help='only time the batch')
+args = parser.parse_args()
+
+orm = ORM()
+session = orm.sessionmaker()
+user_ids = session.scalars(select(RegisteredUser.user_id).order_by(RegisteredUser.user_id).limit(args.users)).all()
+
+start = time.perf_counter()
+pp_matrix = get_top_pp_matrix(session, user_ids, args.mode)
+query_time = time.perf_counter() - start
+start = time.perf_counter()
+batch = weighted_pp_sums(pp_matrix)
+weighting_time = time.perf_counter() - start
+print('%s users, batch: %.3fs query, %.4fs weighting' % (len(user_ids), query_time, weighting_time))
+
+if not args.skip_loop:
+    start = time.perf_counter()
+    looped = [get_profile_pp(get_top_n(session, user_id, args.mode)) for user_id in user_ids]
+    print('%s users, per user: %.3fs' % (len(user_ids), time.perf_counter() - start))
+    mismatches = sum(abs(a - b) > 0.01 for a, b in zip(batch.tolist(), looped))
+    print('%s users with a different total' % mismatches)
+session.close()
@@ -0,0 +1,51 @@
+"""
+Checks that the web and fetch apps import within their budget, measured with python -X importtime in a fresh
+interpreter. Importing must not connect to the database or build API clients (that happens in the apps' lifespan),
+so an import over budget usually means something started doing work at import time again.
+
+Run from the repository root; exits with 1 if a module is over budget.
+python checkImportTime.py
+"""
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Seconds each module may take to import
+BUDGETS = {
+    'web.webapi': 2.0,
+    'scores_fetcher.fetchQueueAPI': 2.0,
+}
+
+def import_time(module: str) -> Tuple[float, List[Tuple[float, str]]]:
+    """
+    The seconds a fresh interpreter takes to import module, and the slowest modules it imports by their own time
+    """
+    env = dict(os.environ)
+    # The apps are run with the repository, web and database directories on the path
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, os.path.join(ROOT, 'web'), os.path.join(ROOT, 'database')])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                          cwd=ROOT, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError('Could not import %s:\n%s' % (module, proc.stderr[-2000:]))
+    total, modules = 0, []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(own) / 1e6, name.strip()))
+        if name.strip() == module:
+            total = int(cumulative) / 1e6
+    return total, sorted(modules, reverse=True)[:10]
+
+if __name__ == '__main__':
+    over = False
+    for module, budget in BUDGETS.items():
+        total, slowest = import_time(module)
+        print('%s: %.3fs (budget %.1fs)' % (module, total, budget))
+        if total > budget:
+            over = True
+            for seconds, name in slowest:
+                print('    %.3fs %s' % (seconds, name))
+    sys.exit(1 if over else 0)
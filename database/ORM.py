@@ -1,32 +1,72 @@
 import os
+import threading
+from typing import Dict
 
 import sqlalchemy.exc
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from dotenv import load_dotenv
 from sqlalchemy.orm import sessionmaker
 
+# (connection string, process id) -> (engine, sessionmaker), so every ORM of a process shares one connection pool
+_engines: Dict[tuple, tuple] = {}
+_engines_lock = threading.Lock()
+
+def _connect(user, password, host, port, dbname) -> Engine:
+    """
+    An engine for the configured host, or for localhost if only localhost can be reached. If neither can be reached
+    right now the configured host is kept, and its pool connects once the database is back.
+    """
+    engine = create_engine("mysql+mysqldb://%s:%s@%s:%s/%s" % (user, password, host, port, dbname), echo=False)
+    try:
+        with engine.connect():
+            return engine
+    except sqlalchemy.exc.OperationalError:
+        pass
+    local = create_engine("mysql+mysqldb://%s:%s@%s:%s/%s" % (user, password, 'localhost', port, dbname), echo=False)
+    try:
+        with local.connect():
+            engine.dispose()
+            return local
+    except sqlalchemy.exc.OperationalError:
+        local.dispose()
+        return engine
+
 class ORM:
+    """
+    Constructing an ORM does not connect: the engine is created on first use of engine, sessionmaker or session
+    """
 
     def __init__(self):
         load_dotenv()
-        user = os.getenv('DB_USER')
-        password = os.getenv('DB_PASS')
-        host = os.getenv('DB_HOST')
-        port = os.getenv('DB_PORT')
-        dbname = os.getenv('DB_NAME')
-        connection_string = "mysql+mysqldb://%s:%s@%s:%s/%s" % (user, password, host, port, dbname)
-        self.engine = create_engine(connection_string, echo=False)
-        try:
-            self.engine.connect()
-        except sqlalchemy.exc.OperationalError:
-            connection_string = "mysql+mysqldb://%s:%s@%s:%s/%s" % (user, password, 'localhost', port, dbname)
-            self.engine = create_engine(connection_string, echo=False)
-        self.sessionmaker = sessionmaker(self.engine)
-        self.session = self.sessionmaker()
+        self.config = (os.getenv('DB_USER'), os.getenv('DB_PASS'), os.getenv('DB_HOST'), os.getenv('DB_PORT'), os.getenv('DB_NAME'))
+        self._session = None
+
+    def _bind(self) -> tuple:
+        key = (self.config, os.getpid())
+        with _engines_lock:
+            if key not in _engines:
+                engine = _connect(*self.config)
+                _engines[key] = (engine, sessionmaker(engine))
+            return _engines[key]
+
+    @property
+    def engine(self) -> Engine:
+        return self._bind()[0]
+
+    @property
+    def sessionmaker(self) -> sessionmaker:
+        return self._bind()[1]
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self.sessionmaker()
+        return self._session
 
 if __name__ == '__main__':
     orm = ORM()
     s1 = orm.sessionmaker()
     s2 = orm.sessionmaker()
 
-    print('success')
\ No newline at end of file
+    print('success')
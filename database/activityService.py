@@ -0,0 +1,104 @@
+"""
+Maintains score_count_rollup, the number of scores per (date, mode, user), and answers activity questions from it.
+insert_scores adds its new scores to the rollup in the same transaction. reconcile_rollup recounts a date range from
+the score tables, to repair anything the write path missed (e.g. rows deleted or written by hand).
+"""
+import datetime
+from typing import Dict, Iterable, List, Sequence
+from sqlalchemy import select, delete, func, type_coerce, Date
+from sqlalchemy.orm import Session
+from database.models import Score, ScoreCountRollup
+from database.util import get_mode_table, naive_utc, modes
+
+def _upsert_counts(session: Session, rows: List[dict]) -> None:
+    """
+    Adds counts to existing rollup rows, creating the missing ones
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(ScoreCountRollup)
+        stmt = stmt.on_duplicate_key_update(count=ScoreCountRollup.count + stmt.inserted['count'])
+    else:
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(ScoreCountRollup)
+        stmt = stmt.on_conflict_do_update(index_elements=[ScoreCountRollup.date, ScoreCountRollup.mode, ScoreCountRollup.user_id],
+                                          set_={'count': ScoreCountRollup.count + stmt.excluded['count']})
+    session.execute(stmt, rows)
+
+def count_new_scores(session: Session, scores: Iterable[Score]) -> None:
+    """
+    Adds scores that were not in the database before to the rollup. Does not commit.
+    """
+    counts = {}
+    for score in scores:
+        if score.date is None:
+            continue
+        key = (naive_utc(score.date).date(), score.get_mode(), score.user_id)
+        counts[key] = counts.get(key, 0) + 1
+    if counts:
+        _upsert_counts(session, [{'date': date, 'mode': mode, 'user_id': user_id, 'count': count}
+                                 for (date, mode, user_id), count in counts.items()])
+
+def existing_score_ids(session: Session, scores: Sequence[Score]) -> set:
+    """
+    The ids of the given scores that are already stored, one query per mode
+    """
+    by_mode = {}
+    for score in scores:
+        by_mode.setdefault(score.get_mode(), []).append(score.score_id)
+    existing = set()
+    for mode, score_ids in by_mode.items():
+        table = get_mode_table(mode)
+        existing.update(session.scalars(select(table.score_id).filter(table.score_id.in_(score_ids))))
+    return existing
+
+def reconcile_rollup(session: Session, since: datetime.date = None) -> int:
+    """
+    Recounts the rollup from the score tables, from a date onwards or entirely. Returns the number of rows written.
+    """
+    clear = delete(ScoreCountRollup)
+    if since is not None:
+        clear = clear.filter(ScoreCountRollup.date >= since)
+    session.execute(clear)
+
+    written = 0
+    for mode in modes:
+        table = get_mode_table(mode)
+        day = type_coerce(func.date(table.date), Date)
+        stmt = select(day, table.user_id, func.count()).filter(table.date.is_not(None)).group_by(day, table.user_id)
+        if since is not None:
+            stmt = stmt.filter(table.date >= datetime.datetime.combine(since, datetime.time()))
+        rows = [{'date': date, 'mode': mode, 'user_id': user_id, 'count': count} for date, user_id, count in session.execute(stmt)]
+        if rows:
+            _upsert_counts(session, rows)
+            written += len(rows)
+    session.commit()
+    return written
+
+def get_daily_counts(session: Session, start: datetime.date, end: datetime.date, user_id: int = None) -> Dict[datetime.date, Dict[str, int]]:
+    """
+    {date: {mode: number of scores}} for every date from start to end inclusive, with 0 for days without scores
+    """
+    stmt = (select(ScoreCountRollup.date, ScoreCountRollup.mode, func.sum(ScoreCountRollup.count))
+            .filter(ScoreCountRollup.date >= start, ScoreCountRollup.date <= end)
+            .group_by(ScoreCountRollup.date, ScoreCountRollup.mode))
+    if user_id is not None:
+        stmt = stmt.filter(ScoreCountRollup.user_id == user_id)
+    counts = {start + datetime.timedelta(days=i): {mode: 0 for mode in modes} for i in range((end - start).days + 1)}
+    for date, mode, count in session.execute(stmt):
+        counts[date][mode.value] = int(count)
+    return counts
+
+def get_mode_totals(session: Session) -> Dict[str, int]:
+    """
+    The number of scores in each mode
+    """
+    totals = {mode: 0 for mode in modes}
+    stmt = select(ScoreCountRollup.mode, func.sum(ScoreCountRollup.count)).group_by(ScoreCountRollup.mode)
+    for mode, count in session.execute(stmt):
+        totals[mode.value] = int(count)
+    return totals
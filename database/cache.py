@@ -0,0 +1,210 @@
+"""
+Read-through caches.
+LRUCache keeps the most recently used values up to maxsize, expires them after ttl seconds, and can drop every entry
+carrying a tag (e.g. every cached leaderboard of one beatmap) when the data behind it changes.
+
+ResponseCache caches endpoint responses by normalized request parameters plus the generation of everything the
+response depends on, e.g. ('user', 10651409). Writers bump generations (see scoreService.insert_scores), which makes
+every older entry unreachable without having to find it; LRU eviction then reclaims the space.
+Generations and responses live in this process, or in redis when REDIS_URL is set so that all workers and the
+fetcher share them. Without redis, writes from other processes are picked up when entries expire.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Set, Tuple
+import orjson
+
+class LRUCache:
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, stored at, tags)
+        self.entries: OrderedDict = OrderedDict()
+        self.tags: Dict[Hashable, Set[Hashable]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value, tags: Iterable[Hashable] = ()) -> None:
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            tags = tuple(tags)
+            self.entries[key] = (value, time.monotonic(), tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any], tags: Iterable[Hashable] = ()):
+        """
+        Returns the cached value, or calls load() and caches its result
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = load()
+            self.set(key, value, tags)
+        return value
+
+    def delete(self, key: Hashable) -> None:
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def invalidate_tags(self, tags: Iterable[Hashable]) -> int:
+        """
+        Drops every entry carrying one of the tags. Returns the number dropped.
+        """
+        with self.lock:
+            keys = set()
+            for tag in tags:
+                keys |= self.tags.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+MISSING = object()
+
+_redis = None
+
+def get_redis():
+    """
+    The shared redis client, or None when REDIS_URL is not set
+    """
+    global _redis
+    url = os.getenv('REDIS_URL')
+    if _redis is None and url:
+        try:
+            import redis
+        except ImportError:
+            print('REDIS_URL is set but redis is not installed, caches stay in-process')
+            return None
+        _redis = redis.Redis.from_url(url)
+    return _redis
+
+def _generation_name(key: Tuple) -> str:
+    return 'generation:' + ':'.join(str(part) for part in key)
+
+class Generations:
+    """
+    A counter per entity, bumped whenever the entity's data changes
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, keys: Iterable[Tuple]) -> Tuple[int, ...]:
+        keys = list(keys)
+        client = get_redis()
+        if client is not None:
+            try:
+                return tuple(int(value or 0) for value in client.mget([_generation_name(key) for key in keys]))
+            except Exception as e:
+                print(e)
+        return tuple(self.counters.get(key, 0) for key in keys)
+
+    def bump(self, keys: Iterable[Tuple]) -> None:
+        keys = set(keys)
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + 1
+        client = get_redis()
+        if client is not None and keys:
+            try:
+                pipeline = client.pipeline()
+                for key in keys:
+                    pipeline.incr(_generation_name(key))
+                pipeline.execute()
+            except Exception as e:
+                print(e)
+
+generations = Generations()
+
+def normalize_params(params) -> Tuple:
+    """
+    Query parameters as a sorted tuple, so the same request always has the same key
+    """
+    items = params.multi_items() if hasattr(params, 'multi_items') else params.items()
+    return tuple(sorted((str(key), str(getattr(value, 'value', value))) for key, value in items))
+
+class ResponseCache:
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300):
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.shared_hits = 0
+        response_caches[name] = self
+
+    def lookup(self, params, depends_on: Iterable[Tuple] = (), version: str = None) -> Tuple[str, Any]:
+        """
+        Returns (key, cached response or MISSING). Pass the key to store() after computing a miss.
+        version is any other marker the response depends on, e.g. its ETag, so a body is never served under a newer one.
+        """
+        depends_on = tuple(depends_on)
+        key = orjson.dumps([self.name, normalize_params(params), depends_on, generations.get(depends_on), version])
+        key = '%s:%s' % (self.name, hashlib.sha1(key).hexdigest())
+        value = self.local.get(key, MISSING)
+        if value is not MISSING:
+            return key, value
+        client = get_redis()
+        if client is not None:
+            try:
+                data = client.get('response:' + key)
+            except Exception as e:
+                print(e)
+                data = None
+            if data is not None:
+                value = orjson.loads(data)
+                self.local.set(key, value)
+                self.shared_hits += 1
+        return key, value
+
+    def store(self, key: str, value) -> None:
+        self.local.set(key, value)
+        client = get_redis()
+        if client is not None:
+            try:
+                client.setex('response:' + key, int(self.ttl), orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+            except Exception as e:
+                print(e)
+
+    def stats(self) -> dict:
+        return self.local.stats() | {'shared_hits': self.shared_hits, 'shared': get_redis() is not None}
+
+response_caches: Dict[str, ResponseCache] = {}
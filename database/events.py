@@ -0,0 +1,37 @@
+"""
+A small in-process publish/subscribe hub.
+The score write path emits events and other services subscribe to them, so scoreService does not need to import
+everything that reacts to new scores.
+
+    events.subscribe(events.SCORES_INSERTED, handler)   # handler(session, scores)
+    events.emit(events.SCORES_INSERTED, session, scores)
+"""
+from typing import Callable, Dict, List
+
+# Emitted by scoreService.insert_scores after a batch is committed, with the written Score objects
+SCORES_INSERTED = 'scores_inserted'
+
+_subscribers: Dict[str, List[Callable]] = {}
+
+def subscribe(event: str, handler: Callable) -> None:
+    handlers = _subscribers.setdefault(event, [])
+    if handler not in handlers:
+        handlers.append(handler)
+
+def unsubscribe(event: str, handler: Callable) -> None:
+    handlers = _subscribers.get(event, [])
+    if handler in handlers:
+        handlers.remove(handler)
+
+def emit(event: str, session, *args) -> None:
+    """
+    Calls every handler of an event in subscription order.
+    A failing handler is rolled back and logged so it cannot stop the others or the writer.
+    """
+    for handler in list(_subscribers.get(event, ())):
+        try:
+            handler(session, *args)
+        except Exception as e:
+            session.rollback()
+            print('Handler %s for %s failed' % (handler.__name__, event))
+            print(e)
@@ -0,0 +1,111 @@
+"""
+Encodes streams of score rows as NDJSON, CSV or Parquet.
+Each function takes a header and an iterator of row partitions (see scoreService.stream_scores) and yields bytes,
+one chunk per partition, so nothing holds more than one partition in memory.
+"""
+import csv
+import enum
+import io
+import json
+from typing import Iterator, Sequence, Tuple
+import orjson
+from sqlalchemy import Integer, Float, Boolean, DateTime, Date
+
+export_formats = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+def _plain(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value)
+    return value
+
+def export_ndjson(header: Tuple[str, ...], partitions: Iterator[Sequence[tuple]]) -> Iterator[bytes]:
+    for rows in partitions:
+        yield b''.join(orjson.dumps(dict(zip(header, row)), option=orjson.OPT_NON_STR_KEYS) + b'\n' for row in rows)
+
+def export_csv(header: Tuple[str, ...], partitions: Iterator[Sequence[tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for rows in partitions:
+        writer.writerows([_plain(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+class _ChunkSink(io.RawIOBase):
+    """
+    File-like object that keeps what was written until drain() is called
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _arrow_type(column):
+    import pyarrow as pa
+    column_type = column.type
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+def export_parquet(header: Tuple[str, ...], partitions: Iterator[Sequence[tuple]], columns: tuple) -> Iterator[bytes]:
+    """
+    Writes one row group per partition. Needs pyarrow, and the selected columns to build a fixed schema.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export requires pyarrow')
+
+    schema = pa.schema([(name, _arrow_type(column)) for name, column in zip(header, columns)])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in partitions:
+            data = {name: [_plain(row[i]) for row in rows] for i, name in enumerate(header)}
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def export_rows(export_format: str, header: Tuple[str, ...], columns: tuple, partitions: Iterator[Sequence[tuple]]) -> Iterator[bytes]:
+    match export_format:
+        case 'csv':
+            return export_csv(header, partitions)
+        case 'parquet':
+            return export_parquet(header, partitions, columns)
+        case _:
+            return export_ndjson(header, partitions)
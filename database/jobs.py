@@ -0,0 +1,218 @@
+"""
+Runs long analytics queries (exports, pp record histories, big count groupings) in a background worker pool, so they
+are not bound by a request timeout and don't hold a web worker.
+
+A job is submitted with the function that computes it and gets an id. The function returns its result as a media type
+and an iterable of byte chunks, which are written to a file under JOB_DIR, so a large result never sits in memory.
+Status and progress are polled (or streamed) by id, and finished jobs and their files are removed JOB_TTL seconds later.
+Jobs live in the memory of the process that runs them, and in redis when REDIS_URL is set so that every worker can
+report on them and serve their results (JOB_DIR must then be shared by the workers). Without redis, a job is only
+found by the worker that runs it.
+"""
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Tuple
+import orjson
+from sqlalchemy.orm import Session
+from database.cache import get_redis
+
+JOB_DIR = os.getenv('JOB_DIR') or os.path.join(tempfile.gettempdir(), 'osu-ladder-jobs')
+JOB_TTL = 3600
+MAX_ACTIVE_JOBS_PER_USER = 3
+# How often a running job's progress is written to redis, in seconds
+SAVE_INTERVAL = 1
+
+class TooManyJobs(Exception):
+    pass
+
+class Job:
+
+    def __init__(self, kind: str, params: dict, user_id: int):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.user_id = user_id
+        # queued -> running -> done or failed
+        self.status = 'queued'
+        # Work done so far, in units the job chooses (e.g. rows exported)
+        self.progress = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.media_type = None
+        self.path = None
+        self.size = None
+        self.error = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    @staticmethod
+    def from_record(record: dict) -> 'Job':
+        job = Job.__new__(Job)
+        job.__dict__.update(record)
+        return job
+
+    def to_dict(self) -> dict:
+        return {'job_id': self.job_id, 'kind': self.kind, 'params': self.params, 'status': self.status,
+                'progress': self.progress, 'created_at': self.created_at, 'started_at': self.started_at,
+                'finished_at': self.finished_at, 'media_type': self.media_type, 'size': self.size, 'error': self.error}
+
+Work = Callable[[Session, Job], Tuple[str, Iterable[bytes]]]
+
+class JobRunner:
+
+    def __init__(self, sessionmaker, max_workers: int = 2, ttl: float = JOB_TTL, directory: str = JOB_DIR):
+        self.sessionmaker = sessionmaker
+        self.ttl = ttl
+        self.directory = directory
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jobs')
+
+    def submit(self, kind: str, params: dict, user_id: int, work: Work) -> Job:
+        """
+        Queues work(session, job). Raises TooManyJobs if the user already has MAX_ACTIVE_JOBS_PER_USER unfinished jobs.
+        """
+        self.cleanup()
+        job = Job(kind, params, user_id)
+        with self.lock:
+            active = sum(1 for x in self._user_jobs(user_id) if not x.finished)
+            if active >= MAX_ACTIVE_JOBS_PER_USER:
+                raise TooManyJobs('You already have %s jobs running, wait for one to finish' % active)
+            self.jobs[job.job_id] = job
+        self._save(job)
+        self.pool.submit(self._run, job, work)
+        return job
+
+    def get(self, job_id: str) -> Job or None:
+        """
+        The job, or a snapshot of it if another worker runs it
+        """
+        self.cleanup()
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        client = get_redis()
+        if client is not None:
+            try:
+                record = client.get('job:' + job_id)
+                if record is not None:
+                    return Job.from_record(orjson.loads(record))
+            except Exception as e:
+                print(e)
+        return None
+
+    def _user_jobs(self, user_id: int) -> list:
+        """
+        The user's jobs in this process, and in every worker if redis is shared
+        """
+        jobs = {job.job_id: job for job in self.jobs.values() if job.user_id == user_id}
+        client = get_redis()
+        if client is not None:
+            try:
+                job_ids = client.smembers('jobs:user:%d' % user_id)
+                records = client.mget(['job:%s' % job_id.decode() for job_id in job_ids]) if job_ids else []
+                for record in records:
+                    if record is not None:
+                        job = Job.from_record(orjson.loads(record))
+                        jobs.setdefault(job.job_id, job)
+            except Exception as e:
+                print(e)
+        return list(jobs.values())
+
+    def _save(self, job: Job) -> None:
+        """
+        Shares the job's state with the other workers, if there is redis. Records expire ttl seconds after their last write.
+        """
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            pipeline = client.pipeline()
+            pipeline.set('job:' + job.job_id, orjson.dumps(job.__dict__), ex=int(self.ttl))
+            pipeline.sadd('jobs:user:%d' % job.user_id, job.job_id)
+            pipeline.expire('jobs:user:%d' % job.user_id, int(self.ttl))
+            pipeline.execute()
+        except Exception as e:
+            print(e)
+
+    def _run(self, job: Job, work: Work):
+        job.status = 'running'
+        job.started_at = time.time()
+        self._save(job)
+        session = self.sessionmaker()
+        path = os.path.join(self.directory, job.job_id)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            media_type, chunks = work(session, job)
+            saved = time.monotonic()
+            with open(path + '.part', 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    if time.monotonic() - saved > SAVE_INTERVAL:
+                        self._save(job)
+                        saved = time.monotonic()
+            os.replace(path + '.part', path)
+            job.media_type = media_type
+            job.path = path
+            job.size = os.path.getsize(path)
+            # finished_at is set before the status, so cleanup never sees a finished job without it
+            job.finished_at = time.time()
+            job.status = 'done'
+        except Exception as e:
+            session.rollback()
+            print('Job %s (%s) failed' % (job.job_id, job.kind))
+            print(e)
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.status = 'failed'
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+        finally:
+            session.close()
+            self._save(job)
+
+    def cleanup(self) -> None:
+        """
+        Forgets jobs that finished more than ttl seconds ago and deletes their results
+        """
+        now = time.time()
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished and now - job.finished_at > self.ttl]
+            for job in expired:
+                del self.jobs[job.job_id]
+        for job in expired:
+            if job.path is not None and os.path.exists(job.path):
+                os.remove(job.path)
+
+    def stats(self) -> dict:
+        """
+        The number of jobs of this process in each status
+        """
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job.status] += 1
+        return counts
+
+def sweep_results(directory: str = JOB_DIR, ttl: float = JOB_TTL) -> None:
+    """
+    Deletes result files (and partial ones) last written more than ttl seconds ago, which cleanup never reaches if the
+    process that ran the job was restarted. Recent files are kept, as another worker may still be serving them.
+    """
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError as e:
+            print(e)
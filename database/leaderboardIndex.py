@@ -0,0 +1,137 @@
+"""
+Keeps each leaderboard's spots ranked in memory, so pages of a leaderboard and a user's rank are served without a query.
+An index is loaded on first use with one query (spots with their users' display fields), kept in sync by
+leaderboardService whenever it writes spots, and reloaded after INDEX_TTL seconds to pick up writes made by other
+processes (the fetcher, the websocket listener). Callers that already read the leaderboard's last_updated can pass it
+to get_index to reload as soon as another process writes.
+"""
+import bisect
+import datetime
+import threading
+import time
+from typing import Dict, List, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload
+from database.models import Leaderboard, LeaderboardSpot, RegisteredUser
+
+INDEX_TTL = 300
+
+def _sort_key(user_id: int, value: float or None) -> Tuple[float, int]:
+    # Best first, ties by user id, spots without a value last
+    return (-value if value is not None else float('inf'), user_id)
+
+class RankedLeaderboard:
+    """
+    The spots of one leaderboard as a sorted array of (-value, user_id).
+    rank() is a binary search, page() is a slice, and update() moves one spot with a delete and an insort.
+    Readers take the same lock as writers, so they never see a spot between its delete and its insort.
+    """
+
+    def __init__(self, leaderboard: dict, spots: List[Tuple[int, float]], users: Dict[int, dict]):
+        self.leaderboard = leaderboard
+        self.values = dict(spots)
+        self.keys = sorted(_sort_key(user_id, value) for user_id, value in spots)
+        self.users = users
+        self.lock = threading.RLock()
+        self.loaded_at = time.monotonic()
+        # Wall clock time truncated to seconds, since MySQL DATETIME columns drop the fraction
+        self.loaded_on = datetime.datetime.now().replace(microsecond=0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rank(self, user_id: int) -> int or None:
+        """
+        1-based rank of a user, or None if they are not on the leaderboard
+        """
+        with self.lock:
+            if user_id not in self.values:
+                return None
+            return bisect.bisect_left(self.keys, _sort_key(user_id, self.values[user_id])) + 1
+
+    def page(self, offset: int = 0, limit: int = None) -> List[dict]:
+        """
+        The spots ranked offset + 1 to offset + limit. Raises ValueError for a negative offset or a limit below 1.
+        """
+        if offset < 0 or (limit is not None and limit < 1):
+            raise ValueError('offset must be at least 0 and limit at least 1')
+        end = None if limit is None else offset + limit
+        with self.lock:
+            return [{"rank": offset + i + 1, "value": self.values[user_id], "user_id": user_id} | self.users.get(user_id, {})
+                    for i, (_, user_id) in enumerate(self.keys[offset:end])]
+
+    def update(self, user_id: int, value: float) -> bool:
+        """
+        Moves a spot to its new value. Returns False for users the index doesn't know, since their display fields are missing.
+        """
+        with self.lock:
+            if user_id not in self.values:
+                return False
+            old = _sort_key(user_id, self.values[user_id])
+            del self.keys[bisect.bisect_left(self.keys, old)]
+            bisect.insort(self.keys, _sort_key(user_id, value))
+            self.values[user_id] = value
+            return True
+
+_indexes: Dict[int, RankedLeaderboard] = {}
+_names: Dict[str, int] = {}
+_lock = threading.Lock()
+
+def load_index(session: Session, leaderboard_id: int) -> RankedLeaderboard:
+    """
+    Builds the index of a leaderboard. Raises NoResultFound if it does not exist.
+    """
+    leaderboard = session.scalars(select(Leaderboard).options(joinedload(Leaderboard.creator))
+                                  .filter(Leaderboard.leaderboard_id == leaderboard_id)).one()
+    info = leaderboard.to_dict() | {"creator": {"username": leaderboard.creator.username,
+                                                "user_id": leaderboard.creator.user_id,
+                                                "avatar_url": leaderboard.creator.avatar_url}}
+    stmt = (select(LeaderboardSpot.user_id, LeaderboardSpot.value, RegisteredUser.username, RegisteredUser.avatar_url)
+            .join(RegisteredUser, RegisteredUser.user_id == LeaderboardSpot.user_id)
+            .filter(LeaderboardSpot.leaderboard_id == leaderboard_id))
+    rows = session.execute(stmt).all()
+    users = {user_id: {"username": username, "avatar_url": avatar_url} for user_id, _, username, avatar_url in rows}
+    return RankedLeaderboard(info, [(user_id, value) for user_id, value, _, _ in rows], users)
+
+def get_index(session: Session, leaderboard_id: int = None, leaderboard_name: str = None,
+              last_updated: datetime.datetime = None) -> RankedLeaderboard:
+    """
+    Returns the index of a leaderboard by id or name, loading it if it is missing or older than INDEX_TTL, or if
+    last_updated (Leaderboard.last_updated) is not older than the index
+    """
+    if leaderboard_id is None:
+        leaderboard_id = _names.get(leaderboard_name)
+        if leaderboard_id is None:
+            leaderboard_id = session.scalars(select(Leaderboard.leaderboard_id).filter(Leaderboard.name == leaderboard_name)).one()
+    index = _indexes.get(leaderboard_id)
+    if (index is None or time.monotonic() - index.loaded_at > INDEX_TTL
+            or (last_updated is not None and last_updated >= index.loaded_on)):
+        index = load_index(session, leaderboard_id)
+        with _lock:
+            _indexes[leaderboard_id] = index
+            _names[index.leaderboard["name"]] = leaderboard_id
+    return index
+
+def update_spots(leaderboard_id: int, values: Dict[int, float]) -> None:
+    """
+    Applies written spot values to a loaded index. An unknown user means the membership changed, so the index is dropped.
+    """
+    index = _indexes.get(leaderboard_id)
+    if index is None:
+        return
+    # Readers see either none or all of the values
+    with index.lock:
+        for user_id, value in values.items():
+            if not index.update(user_id, value):
+                with _lock:
+                    _indexes.pop(leaderboard_id, None)
+                return
+
+def forget(leaderboard_id: int) -> None:
+    """
+    Drops a leaderboard's index, e.g. after its members or settings changed
+    """
+    with _lock:
+        index = _indexes.pop(leaderboard_id, None)
+        if index is not None:
+            _names.pop(index.leaderboard["name"], None)
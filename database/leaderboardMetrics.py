@@ -0,0 +1,160 @@
+"""
+The metrics a leaderboard can rank by. Each metric computes the value of every member of a leaderboard in one grouped
+query; leaderboardService looks metrics up by LeaderboardMetricEnum name and never loops over users itself.
+
+Most metrics are an AggregateMetric: a per-score expression and the SQL aggregate applied to it per user. On unique
+leaderboards the expression is first reduced to the best value per (user, beatmap), so e.g. total_score is the sum of
+each user's best score on every beatmap. Adding a metric is a register() call plus a LeaderboardMetricEnum member.
+
+Metrics that can also be updated from single scores in memory set incremental and implement load_state, apply and
+state_value (see leaderboardService.apply_new_scores). The others are recomputed by the leaderboard scheduler.
+
+filters is always (mod_filters, score_filters, beatmap_filters, beatmapset_filters), as parsed by the util.parse_* functions.
+"""
+from typing import Callable, Dict, List, Sequence
+from sqlalchemy import select, func, case
+from sqlalchemy.orm import Session
+from database.models import Score
+from database.scoreService import plan_score_query, get_profile_pp_batch
+from database.timelineService import ProfilePpTracker
+from database.util import get_mode_table, supports_window_functions, BONUS_PP
+
+def _plan(mode: str, filters: tuple, extra_filters: tuple, columns: tuple):
+    mod_filters, score_filters, beatmap_filters, beatmapset_filters = filters
+    return plan_score_query(mode, mod_filters, tuple(extra_filters) + tuple(score_filters), beatmap_filters, beatmapset_filters, columns=columns)
+
+class LeaderboardMetric:
+    name: str = None
+    # The value of a member without any matching score
+    default: float = 0
+    incremental: bool = False
+
+    def values(self, session: Session, mode: str, member_ids: List[int], unique: bool, filters: tuple) -> Dict[int, float]:
+        """
+        {user_id: value} for the members that have at least one matching score
+        """
+        raise NotImplementedError
+
+    def load_state(self, session: Session, mode: str, user_id: int, filters: tuple):
+        raise NotImplementedError
+
+    def apply(self, state, scores: Sequence[Score]) -> bool:
+        """
+        Adds matching scores to a state. Returns True if the value changed.
+        """
+        raise NotImplementedError
+
+    def state_value(self, state) -> float:
+        raise NotImplementedError
+
+class AggregateMetric(LeaderboardMetric):
+
+    def __init__(self, name: str, expression: Callable, aggregate: Callable = func.sum, best: Callable = func.max,
+                 score_filters: Callable = None, default: float = 0):
+        """
+        - expression:    table -> the per-score value
+        - aggregate:     SQL aggregate over a user's values
+        - best:          SQL aggregate reducing a beatmap's values on unique leaderboards
+        - score_filters: table -> extra filters, e.g. to skip scores without pp
+        """
+        self.name = name
+        self.expression = expression
+        self.aggregate = aggregate
+        self.best = best
+        self.score_filters = score_filters
+        self.default = default
+
+    def values(self, session: Session, mode: str, member_ids: List[int], unique: bool, filters: tuple) -> Dict[int, float]:
+        table = get_mode_table(mode)
+        extra_filters = (table.user_id.in_(member_ids),) + (self.score_filters(table) if self.score_filters else ())
+        if not unique:
+            stmt = _plan(mode, filters, extra_filters, (table.user_id, self.aggregate(self.expression(table))))
+            return dict(session.execute(stmt.group_by(table.user_id)).all())
+        best = _plan(mode, filters, extra_filters, (table.user_id, self.best(self.expression(table)).label('best')))
+        best = best.group_by(table.user_id, table.beatmap_id).subquery()
+        stmt = select(best.c.user_id, self.aggregate(best.c.best)).group_by(best.c.user_id)
+        return dict(session.execute(stmt).all())
+
+class WeightedPpMetric(LeaderboardMetric):
+    """
+    Profile pp: the best pp per beatmap, ranked per user and weighted by 0.95^(rank-1), plus bonus pp
+    """
+    name = 'weighted_pp'
+    default = BONUS_PP
+    incremental = True
+
+    def values(self, session: Session, mode: str, member_ids: List[int], unique: bool, filters: tuple) -> Dict[int, float]:
+        if not supports_window_functions(session):
+            return get_profile_pp_batch(session, member_ids, mode, 100, True, *filters)
+        table = get_mode_table(mode)
+        best = _plan(mode, filters, (table.user_id.in_(member_ids), table.pp.is_not(None)),
+                     (table.user_id, func.max(table.pp).label('best')))
+        best = best.group_by(table.user_id, table.beatmap_id).subquery()
+        ranked = select(best.c.user_id, best.c.best,
+                        func.row_number().over(partition_by=best.c.user_id, order_by=best.c.best.desc()).label('position')).subquery()
+        stmt = (select(ranked.c.user_id, func.sum(ranked.c.best * func.pow(0.95, ranked.c.position - 1)))
+                .filter(ranked.c.position <= 100)
+                .group_by(ranked.c.user_id))
+        return {user_id: BONUS_PP + total for user_id, total in session.execute(stmt)}
+
+    def load_state(self, session: Session, mode: str, user_id: int, filters: tuple) -> ProfilePpTracker:
+        table = get_mode_table(mode)
+        tracker = ProfilePpTracker()
+        stmt = _plan(mode, filters, (table.user_id == user_id, table.pp.is_not(None)), (table.beatmap_id, func.max(table.pp)))
+        stmt = stmt.group_by(table.beatmap_id).order_by(func.max(table.pp).desc()).limit(tracker.n)
+        for beatmap_id, best in session.execute(stmt):
+            tracker.add(beatmap_id, best)
+        return tracker
+
+    def apply(self, state: ProfilePpTracker, scores: Sequence[Score]) -> bool:
+        changed = False
+        for score in scores:
+            changed |= state.add(score.beatmap_id, score.pp)
+        return changed
+
+    def state_value(self, state: ProfilePpTracker) -> float:
+        return state.total()
+
+class UniqueBeatmapsMetric(AggregateMetric):
+    """
+    The number of distinct beatmaps with a matching score. The incremental state is the set of those beatmap ids.
+    """
+    incremental = True
+
+    def __init__(self):
+        super().__init__('count_unique_beatmaps', lambda table: table.beatmap_id, lambda column: func.count(column.distinct()))
+
+    def load_state(self, session: Session, mode: str, user_id: int, filters: tuple) -> set:
+        table = get_mode_table(mode)
+        stmt = _plan(mode, filters, (table.user_id == user_id,), (table.beatmap_id,))
+        return set(session.scalars(stmt.distinct()))
+
+    def apply(self, state: set, scores: Sequence[Score]) -> bool:
+        size = len(state)
+        state.update(score.beatmap_id for score in scores)
+        return len(state) != size
+
+    def state_value(self, state: set) -> float:
+        return len(state)
+
+metrics: Dict[str, LeaderboardMetric] = {}
+
+def register(metric: LeaderboardMetric) -> LeaderboardMetric:
+    metrics[metric.name] = metric
+    return metric
+
+def get_metric(name) -> LeaderboardMetric or None:
+    """
+    Looks a metric up by name or LeaderboardMetricEnum member
+    """
+    return metrics.get(getattr(name, 'name', name))
+
+register(WeightedPpMetric())
+register(UniqueBeatmapsMetric())
+# Ranked score: the best lazer score on each beatmap on unique leaderboards, every score otherwise
+register(AggregateMetric('total_score', lambda table: table.lazer_score))
+register(AggregateMetric('count_ss', lambda table: case((table.rank.in_(('X', 'XH')), 1), else_=0)))
+register(AggregateMetric('total_max_combo', lambda table: table.maxcombo))
+register(AggregateMetric('total_pp', lambda table: table.pp, score_filters=lambda table: (table.pp.is_not(None),)))
+# Every play counts once, so users are compared by the accuracy they usually play at
+register(AggregateMetric('average_accuracy', lambda table: table.accuracy, aggregate=func.avg))
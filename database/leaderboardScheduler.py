@@ -0,0 +1,197 @@
+"""
+Recomputes leaderboard spots in the background instead of on every write.
+Writers mark (leaderboard, user) pairs dirty. A mark only becomes due once the pair has not been marked again for
+`debounce` seconds (or has waited `max_delay` seconds), so a fetch inserting thousands of scores for one user causes
+one recomputation instead of thousands. Due pairs are taken highest priority first, grouped per leaderboard and
+recomputed with leaderboardService.recalculate_leaderboard, with at most `max_concurrency` batches running at once.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import select
+from database.models import LeaderboardSpot
+
+# A mark for every leaderboard the user is in
+ALL_LEADERBOARDS = None
+# Recomputations a spot may fail before its mark is dropped
+MAX_ATTEMPTS = 5
+
+class LeaderboardScheduler:
+
+    def __init__(self, sessionmaker, debounce: float = 10, max_delay: float = 120, batch_size: int = 1000, max_concurrency: int = 2):
+        self.sessionmaker = sessionmaker
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+
+        # (leaderboard_id or ALL_LEADERBOARDS, user_id) -> [priority, first marked, last marked]
+        self.pending: Dict[Tuple[int, int], list] = {}
+        # (leaderboard_id or ALL_LEADERBOARDS, user_id) -> failed recomputations so far
+        self.attempts: Dict[Tuple[int, int], int] = {}
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='leaderboard-scheduler')
+        self.thread = None
+
+        self.marked = 0
+        self.recomputed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_batch_seconds = None
+
+    def mark(self, leaderboard_id: int or None, user_ids: Iterable[int], priority: int = 0) -> None:
+        """
+        Marks spots dirty. leaderboard_id=ALL_LEADERBOARDS marks every leaderboard the users are in.
+        Marking an already pending spot pushes its deadline back and keeps the highest priority.
+        """
+        now = time.monotonic()
+        with self.condition:
+            for user_id in user_ids:
+                self.marked += 1
+                entry = self.pending.get((leaderboard_id, user_id))
+                if entry is None:
+                    self.pending[(leaderboard_id, user_id)] = [priority, now, now]
+                else:
+                    entry[0] = max(entry[0], priority)
+                    entry[2] = now
+            self._start()
+            self.condition.notify()
+
+    def mark_users(self, user_ids: Iterable[int], priority: int = 0) -> None:
+        self.mark(ALL_LEADERBOARDS, user_ids, priority)
+
+    def _start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='leaderboard-scheduler', daemon=True)
+            self.thread.start()
+
+    def _due(self, now: float) -> Tuple[List[Tuple[int, int]], float]:
+        """
+        Removes and returns the next batch of due spots, and how long to sleep when nothing is due
+        """
+        due = []
+        wait = self.debounce
+        for key, (priority, first, last) in self.pending.items():
+            deadline = min(last + self.debounce, first + self.max_delay)
+            if deadline <= now:
+                due.append((-priority, first, key))
+            else:
+                wait = min(wait, deadline - now)
+        due.sort()
+        batch = [key for _, _, key in due[:self.batch_size]]
+        for key in batch:
+            del self.pending[key]
+        return batch, wait
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            with self.condition:
+                batch, wait = self._due(time.monotonic())
+                while not batch:
+                    self.condition.wait(wait)
+                    batch, wait = self._due(time.monotonic())
+                self.in_flight += len(batch)
+            self.pool.submit(self._recompute, batch)
+
+    def _recompute(self, batch: List[Tuple[int, int]]):
+        from database.leaderboardService import recalculate_leaderboard
+
+        start = time.monotonic()
+        session = self.sessionmaker()
+        failed = set()
+        try:
+            # leaderboard_id -> {user_id: the pending keys it came from}
+            by_leaderboard = {}
+            everything = [user_id for leaderboard_id, user_id in batch if leaderboard_id is ALL_LEADERBOARDS]
+            try:
+                if everything:
+                    stmt = select(LeaderboardSpot.leaderboard_id, LeaderboardSpot.user_id).filter(LeaderboardSpot.user_id.in_(everything))
+                    for leaderboard_id, user_id in session.execute(stmt):
+                        by_leaderboard.setdefault(leaderboard_id, {}).setdefault(user_id, set()).add((ALL_LEADERBOARDS, user_id))
+            except Exception as e:
+                session.rollback()
+                print('Could not find the leaderboards of %s users' % len(everything))
+                print(e)
+                failed.update((ALL_LEADERBOARDS, user_id) for user_id in everything)
+            for leaderboard_id, user_id in batch:
+                if leaderboard_id is not ALL_LEADERBOARDS:
+                    by_leaderboard.setdefault(leaderboard_id, {}).setdefault(user_id, set()).add((leaderboard_id, user_id))
+
+            # A failing leaderboard (e.g. a metric whose query errors) does not hold back the others
+            for leaderboard_id, users in by_leaderboard.items():
+                try:
+                    recalculate_leaderboard(session, leaderboard_id, list(users))
+                except Exception as e:
+                    session.rollback()
+                    print('Recalculating leaderboard %s failed' % leaderboard_id)
+                    print(e)
+                    for keys in users.values():
+                        failed.update(keys)
+            self._settle(batch, failed)
+        finally:
+            session.close()
+            with self.condition:
+                self.in_flight -= len(batch)
+                self.batches += 1
+                self.last_batch_seconds = time.monotonic() - start
+            self.slots.release()
+
+    def _settle(self, batch: List[Tuple[int, int]], failed: set) -> None:
+        """
+        Counts a batch's results. Failed spots are marked again until they have failed MAX_ATTEMPTS times.
+        """
+        retry = []
+        with self.condition:
+            self.recomputed += len(batch) - len(failed)
+            if failed:
+                self.failures += 1
+            for key in batch:
+                if key not in failed:
+                    self.attempts.pop(key, None)
+                    continue
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+                if self.attempts[key] >= MAX_ATTEMPTS:
+                    del self.attempts[key]
+                    self.dropped += 1
+                else:
+                    retry.append(key)
+        if retry:
+            print('Marking %s spots again' % len(retry))
+        for leaderboard_id, user_id in retry:
+            self.mark(leaderboard_id, [user_id])
+
+    def stats(self) -> dict:
+        """
+        Backlog metrics
+        """
+        now = time.monotonic()
+        with self.condition:
+            oldest = min((first for _, first, _ in self.pending.values()), default=None)
+            return {
+                'pending': len(self.pending),
+                'in_flight': self.in_flight,
+                'oldest_pending_seconds': None if oldest is None else round(now - oldest, 3),
+                'marked': self.marked,
+                'recomputed': self.recomputed,
+                'batches': self.batches,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'last_batch_seconds': self.last_batch_seconds,
+                'max_concurrency': self.max_concurrency,
+            }
+
+_schedulers: Dict[object, LeaderboardScheduler] = {}
+
+def get_scheduler(sessionmaker) -> LeaderboardScheduler:
+    """
+    One scheduler per database, shared by everything in the process that writes to it
+    """
+    bind = sessionmaker.kw.get('bind')
+    if bind not in _schedulers:
+        _schedulers[bind] = LeaderboardScheduler(sessionmaker)
+    return _schedulers[bind]
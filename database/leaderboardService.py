@@ -1,47 +1,256 @@
 import datetime
 
-from sqlalchemy import select, and_, func, Date
-from sqlalchemy.orm import Session
-from database.util import get_mode_table, parse_score_filters, parse_beatmap_filters, parse_beatmapset_filters, parse_user_filters, parse_mod_filters
-from typing import List, Any
-from ossapi import Score
-from database.models import RegisteredUser, Leaderboard, LeaderboardSpot, LeaderboardMetricEnum
-from database.scoreService import get_scores, count_scores, get_top_n, weighted_pp_sum
+from sqlalchemy import select, and_, func, Date, or_, update
+from sqlalchemy.orm import Session, joinedload, sessionmaker
+from database.util import supports_window_functions, get_mode_table, parse_score_filters, parse_beatmap_filters, parse_beatmapset_filters, parse_user_filters, parse_mod_filters
+from typing import List, Any, Sequence
+from database.models import RegisteredUser, Leaderboard, LeaderboardSpot, LeaderboardMetricEnum, Beatmap, Score
+from database.leaderboardMetrics import get_metric
+from database.serializers import table_projection
+from database.scoreMatcher import ScoreMatcher
+import database.events as events
+import database.leaderboardIndex as leaderboardIndex
+from database.cache import generations, LRUCache
 
 
-# Probably shouldn't have this as a route, but we will see.
-def pp_record_history(session: Session, users: List[int], mode: str or int) -> List[dict[str, Any]]:
+def get_leaderboards(session: Session) -> Sequence[Leaderboard]:
     """
-    Given a list of users, calculate the pp history.
+    Returns every leaderboard with its creator loaded
+    """
+    stmt = select(Leaderboard).options(joinedload(Leaderboard.creator))
+    return session.scalars(stmt).all()
+
+def get_leaderboard(session: Session, leaderboard_id: int = None, leaderboard_name: str = None) -> Leaderboard:
+    """
+    Returns a leaderboard by id or name with its creator loaded. Raises NoResultFound if it does not exist.
+    """
+    stmt = select(Leaderboard).options(joinedload(Leaderboard.creator)).filter(or_(
+        Leaderboard.leaderboard_id == leaderboard_id,
+        Leaderboard.name == leaderboard_name
+    ))
+    return session.scalars(stmt).one()
+
+def pp_record_history(session: Session, users: List[int], mode: str or int, per_user: bool = False) -> List[dict[str, Any]]:
+    """
+    Given a list of users, return every score that was a pp record when it was set, in date order.
+    A score is a record if its pp is at least the highest pp set before it.
+    - per_user: track each user's own record instead of the record among all the given users
+
+    The running max is computed in SQL, so only the records leave the database.
     """
     table = get_mode_table(mode)
-    # For one hundred players, this loads about 100mb worth of data into memory
-    stmt = select(table.date, table.pp, table.score_id).filter(
-        and_(
-            getattr(table, 'pp').is_not(None),
-            getattr(table, 'user_id').in_(users)
-        )
-    ).order_by(getattr(table, 'date'))
-
-    scores = session.execute(stmt).all()
-
-    pp_record = 0
-    pp_records = []
-    for score in scores:
-        if score[1] >= pp_record:
-            pp_records.append(score[2])
-            pp_record = score[1]
+    header, columns = table_projection(table)
+
+    if not supports_window_functions(session):
+        return _pp_record_history_streamed(session, users, mode, per_user)
 
-    stmt = select(table, RegisteredUser).join_from(table, RegisteredUser, RegisteredUser.user_id == table.user_id).filter(table.score_id.in_(pp_records))
+    running_max = func.max(table.pp).over(partition_by=table.user_id if per_user else None,
+                                          order_by=(table.date, table.score_id),
+                                          rows=(None, -1))
+    subq = (select(*columns, running_max.label('previous_record'))
+            .filter(table.pp.is_not(None), table.user_id.in_(users))
+            .subquery())
+    stmt = (select(*(subq.c[name] for name in header), RegisteredUser.username)
+            .join(RegisteredUser, RegisteredUser.user_id == subq.c.user_id)
+            .filter(or_(subq.c.previous_record.is_(None), subq.c.pp >= subq.c.previous_record))
+            .order_by(subq.c.date, subq.c.score_id))
+
+    return [{'username': row[-1], 'score': dict(zip(header, row[:-1]))} for row in session.execute(stmt)]
+
+def _pp_record_history_streamed(session: Session, users: List[int], mode: str or int, per_user: bool, chunk_size: int = 10000) -> List[dict[str, Any]]:
+    """
+    pp_record_history for databases without window functions.
+    Streams (user_id, pp, score_id) through a server-side cursor and keeps only the record ids.
+    """
+    table = get_mode_table(mode)
+    header, columns = table_projection(table)
+
+    stmt = (select(table.user_id, table.pp, table.score_id)
+            .filter(table.pp.is_not(None), table.user_id.in_(users))
+            .order_by(table.date, table.score_id)
+            .execution_options(stream_results=True, yield_per=chunk_size))
+
+    records = {}
+    record_ids = []
+    for user_id, pp, score_id in session.execute(stmt):
+        key = user_id if per_user else None
+        if pp >= records.get(key, 0):
+            records[key] = pp
+            record_ids.append(score_id)
 
     pp_history = []
-    for row in session.execute(stmt):
-        pp_history.append({
-            'username': row[1].username,
-            'score': row[0].to_dict()
-        })
+    for i in range(0, len(record_ids), chunk_size):
+        stmt = (select(*columns, RegisteredUser.username)
+                .join(RegisteredUser, RegisteredUser.user_id == table.user_id)
+                .filter(table.score_id.in_(record_ids[i:i + chunk_size]))
+                .order_by(table.date, table.score_id))
+        pp_history += [{'username': row[-1], 'score': dict(zip(header, row[:-1]))} for row in session.execute(stmt)]
     return pp_history
 
+def compile_leaderboard_filters(leaderboard: Leaderboard) -> (str, tuple, tuple, tuple, tuple):
+    """
+    Parses a leaderboard's filter strings. Returns (mode, mod_filters, score_filters, beatmap_filters, beatmapset_filters)
+    """
+    mode = leaderboard.mode.name
+    return (mode,
+            tuple(parse_mod_filters(mode, leaderboard.mod_filters or None)),
+            parse_score_filters(mode, leaderboard.score_filters or None),
+            parse_beatmap_filters(leaderboard.beatmap_filters or None),
+            parse_beatmapset_filters(leaderboard.beatmapset_filters or None))
+
+def recalculate_leaderboard(session: Session, leaderboard: Leaderboard | int, user_ids: List[int] = None) -> dict[int, float]:
+    """
+    Recomputes LeaderboardSpot.value for every member of a leaderboard (or only user_ids) with the metric's grouped query,
+    then writes all spots back in one bulk UPDATE. Returns {user_id: value}.
+    """
+    if isinstance(leaderboard, int):
+        leaderboard = session.get(Leaderboard, leaderboard)
+        # Deleted since its spots were marked
+        if leaderboard is None:
+            return {}
+    metric = get_metric(leaderboard.metric)
+    if metric is None:
+        return {}
+    mode, *filters = compile_leaderboard_filters(leaderboard)
+
+    members = select(LeaderboardSpot.user_id).filter(LeaderboardSpot.leaderboard_id == leaderboard.leaderboard_id)
+    if user_ids is not None:
+        members = members.filter(LeaderboardSpot.user_id.in_(user_ids))
+    member_ids = session.scalars(members).all()
+    if not member_ids:
+        return {}
+    values = metric.values(session, mode, member_ids, leaderboard.unique, tuple(filters))
+
+    # Members without any matching score (or only NULLs) get the metric's empty value
+    now = datetime.datetime.now()
+    values = {user_id: float(values[user_id]) if values.get(user_id) is not None else float(metric.default) for user_id in member_ids}
+    session.execute(update(LeaderboardSpot), [{'leaderboard_id': leaderboard.leaderboard_id, 'user_id': user_id, 'value': value, 'last_updated': now}
+                                               for user_id, value in values.items()])
+    session.execute(update(Leaderboard).filter(Leaderboard.leaderboard_id == leaderboard.leaderboard_id).values(last_updated=now))
+    session.commit()
+    for user_id in values:
+        _spot_states.delete((leaderboard.leaderboard_id, user_id))
+    leaderboardIndex.update_spots(leaderboard.leaderboard_id, values)
+    generations.bump([('leaderboard', leaderboard.leaderboard_id)])
+    return values
+
+def recalculate_leaderboards(session: Session, user_ids: List[int] = None) -> dict[int, dict[int, float]]:
+    """
+    Recomputes every leaderboard, or only the leaderboards and spots of the given users.
+    Returns {leaderboard_id: {user_id: value}}.
+    """
+    stmt = select(Leaderboard)
+    if user_ids is not None:
+        stmt = stmt.filter(Leaderboard.leaderboard_id.in_(
+            select(LeaderboardSpot.leaderboard_id).filter(LeaderboardSpot.user_id.in_(user_ids))))
+    return {leaderboard.leaderboard_id: recalculate_leaderboard(session, leaderboard, user_ids)
+            for leaderboard in session.scalars(stmt).all()}
+
+# (leaderboard_id, user_id) -> (metric state, last_updated written with it). A spot whose last_updated no longer matches
+# was rewritten elsewhere (a full recalculation, another process), so its state is reloaded. Only recently active
+# spots are kept: an evicted state is loaded again from the database.
+_spot_states = LRUCache(maxsize=10000, ttl=3600)
+# leaderboard_id -> (filter strings, ScoreMatcher)
+_matchers = LRUCache(maxsize=1024)
+
+def _leaderboard_matcher(leaderboard: Leaderboard) -> ScoreMatcher:
+    key = (leaderboard.mode, leaderboard.mod_filters, leaderboard.score_filters, leaderboard.beatmap_filters, leaderboard.beatmapset_filters)
+    cached = _matchers.get(leaderboard.leaderboard_id)
+    if cached is None or cached[0] != key:
+        cached = (key, ScoreMatcher(*compile_leaderboard_filters(leaderboard)))
+        _matchers.set(leaderboard.leaderboard_id, cached)
+    return cached[1]
+
+def apply_new_scores(session: Session, scores: Sequence[Score]) -> int:
+    """
+    Adjusts the leaderboard spots affected by newly written scores, without recomputing anyone else.
+    Each score is matched in memory against the filters of the leaderboards its user is in. A matching score
+    updates the spot's cached metric state (e.g. the top 100 for weighted_pp), and only spots whose value changed
+    are written, in one bulk UPDATE. Spots of metrics without incremental support are handed to the scheduler.
+    Returns the number of spots written.
+
+    Scores are expected to be committed already: a spot without cached state is loaded from the database, new scores included.
+    """
+    by_user = {}
+    for score in scores:
+        by_user.setdefault((score.get_mode(), score.user_id), []).append(score)
+    if not by_user:
+        return 0
+
+    stmt = (select(LeaderboardSpot, Leaderboard).join(LeaderboardSpot.leaderboard)
+            .filter(LeaderboardSpot.user_id.in_({user_id for _, user_id in by_user})))
+    beatmaps = None
+    dirty = []
+    # Truncated so it compares equal after a round trip through DATETIME
+    now = datetime.datetime.now().replace(microsecond=0)
+    updates = []
+    for spot, leaderboard in session.execute(stmt).all():
+        user_scores = by_user.get((leaderboard.mode.name, spot.user_id))
+        if not user_scores:
+            continue
+        key = (leaderboard.leaderboard_id, spot.user_id)
+        metric = get_metric(leaderboard.metric)
+        if metric is None:
+            continue
+        try:
+            matcher = _leaderboard_matcher(leaderboard)
+        except NotImplementedError:
+            matcher = None
+        if matcher is None:
+            dirty.append(key)
+            continue
+        if matcher.needs_beatmap and beatmaps is None:
+            beatmap_stmt = (select(Beatmap).options(joinedload(Beatmap.beatmapset))
+                            .filter(Beatmap.beatmap_id.in_({score.beatmap_id for score in scores})))
+            beatmaps = {beatmap.beatmap_id: beatmap for beatmap in session.scalars(beatmap_stmt)}
+        matched = [score for score in user_scores if matcher(score, beatmaps.get(score.beatmap_id) if matcher.needs_beatmap else None)]
+        if not matched:
+            continue
+        if not metric.incremental:
+            dirty.append(key)
+            continue
+
+        cached = _spot_states.get(key)
+        if cached is None or cached[1] != spot.last_updated:
+            mode, *filters = compile_leaderboard_filters(leaderboard)
+            state = metric.load_state(session, mode, spot.user_id, tuple(filters))
+            changed = True
+        else:
+            state = cached[0]
+            changed = metric.apply(state, matched)
+        if not changed:
+            continue
+        value = metric.state_value(state)
+        _spot_states.set(key, (state, now))
+        updates.append({'leaderboard_id': leaderboard.leaderboard_id, 'user_id': spot.user_id, 'value': float(value), 'last_updated': now})
+
+    if updates:
+        session.execute(update(LeaderboardSpot), updates)
+        session.execute(update(Leaderboard).filter(Leaderboard.leaderboard_id.in_({spot['leaderboard_id'] for spot in updates}))
+                        .values(last_updated=now))
+        session.commit()
+        for spot in updates:
+            leaderboardIndex.update_spots(spot['leaderboard_id'], {spot['user_id']: spot['value']})
+        generations.bump(('leaderboard', spot['leaderboard_id']) for spot in updates)
+    if dirty:
+        from database.leaderboardScheduler import get_scheduler
+        scheduler = get_scheduler(sessionmaker(bind=session.get_bind()))
+        for leaderboard_id, user_id in dirty:
+            scheduler.mark(leaderboard_id, [user_id])
+    return len(updates)
+
+# Larger batches are handed to the background scheduler instead of being applied score by score
+INCREMENTAL_BATCH_LIMIT = 200
+
+def on_scores_inserted(session: Session, scores: Sequence[Score]) -> None:
+    if len(scores) <= INCREMENTAL_BATCH_LIMIT:
+        apply_new_scores(session, scores)
+        return
+    from database.leaderboardScheduler import get_scheduler
+    get_scheduler(sessionmaker(bind=session.get_bind())).mark_users({score.user_id for score in scores})
+
+events.subscribe(events.SCORES_INSERTED, on_scores_inserted)
+
 async def recalculate_user(session: Session, user_id: int, leaderboard_id: int = None, leaderboard_name: str = None):
     """
     Given a leaderboard and a user, update LeaderboardSpot.value
@@ -49,33 +258,8 @@ async def recalculate_user(session: Session, user_id: int, leaderboard_id: int =
     if not leaderboard_id and not leaderboard_name:
         return False
 
-    if leaderboard_id:
-        stmt = select(Leaderboard).filter(Leaderboard.leaderboard_id == leaderboard_id)
-    else:
-        stmt = select(Leaderboard).filter(Leaderboard.name == leaderboard_name)
-    leaderboard = session.scalars(stmt).one()
-
-    leaderboard_spot = list(filter(lambda x: x.user_id == user_id, leaderboard.leaderboard_spots))[0]
-
-    mode = leaderboard.mode.name
-    mod_filters = parse_mod_filters(mode, leaderboard.mod_filters)
-    score_filters = parse_score_filters(mode, leaderboard.score_filters)
-    beatmap_filters = parse_beatmap_filters(leaderboard.beatmap_filters)
-    beatmapset_filters = parse_beatmapset_filters(leaderboard.beatmapset_filters)
-
-    new_value = 0
-
-    if leaderboard.metric.name == LeaderboardMetricEnum.weighted_pp.name:
-        scores_list = await get_top_n(session, user_id, mode, 'pp', True, 100, True, mod_filters, score_filters, beatmap_filters, beatmapset_filters)
-        new_value = weighted_pp_sum(list(scores_list))
-        leaderboard_spot.value = new_value
-    elif leaderboard.metric.name == LeaderboardMetricEnum.count_unique_beatmaps:
-        user_filter = parse_user_filters(mode, leaderboard_spot.user_id)
-        new_value = count_scores(session, mode, 'beatmap_id', True, 1, mod_filters, score_filters+user_filter, beatmap_filters, beatmapset_filters)
-        leaderboard_spot.value = new_value
-    leaderboard_spot.last_updated = datetime.datetime.now()
-    session.commit()
-    return new_value
+    leaderboard = get_leaderboard(session, leaderboard_id, leaderboard_name)
+    return recalculate_leaderboard(session, leaderboard, [user_id]).get(user_id, 0)
 
 if __name__ == "__main__":
     from database.ORM import ORM
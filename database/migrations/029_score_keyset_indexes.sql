@@ -0,0 +1,19 @@
+-- Keyset pages of a user's scores ordered by pp, date or lazer_score (get_scores, get_top_n, export).
+-- Without these the pages are read by scanning the user's scores and sorting them.
+-- Creating an index does not block reads or writes on MySQL 8 (ALGORITHM=INPLACE, LOCK=NONE).
+
+CREATE INDEX ix_registered_scores_osu_user_pp ON registered_scores_osu (user_id, pp, score_id);
+CREATE INDEX ix_registered_scores_osu_user_date ON registered_scores_osu (user_id, date, score_id);
+CREATE INDEX ix_registered_scores_osu_user_lazer_score ON registered_scores_osu (user_id, lazer_score, score_id);
+
+CREATE INDEX ix_registered_scores_taiko_user_pp ON registered_scores_taiko (user_id, pp, score_id);
+CREATE INDEX ix_registered_scores_taiko_user_date ON registered_scores_taiko (user_id, date, score_id);
+CREATE INDEX ix_registered_scores_taiko_user_lazer_score ON registered_scores_taiko (user_id, lazer_score, score_id);
+
+CREATE INDEX ix_registered_scores_catch_user_pp ON registered_scores_catch (user_id, pp, score_id);
+CREATE INDEX ix_registered_scores_catch_user_date ON registered_scores_catch (user_id, date, score_id);
+CREATE INDEX ix_registered_scores_catch_user_lazer_score ON registered_scores_catch (user_id, lazer_score, score_id);
+
+CREATE INDEX ix_registered_scores_mania_user_pp ON registered_scores_mania (user_id, pp, score_id);
+CREATE INDEX ix_registered_scores_mania_user_date ON registered_scores_mania (user_id, date, score_id);
+CREATE INDEX ix_registered_scores_mania_user_lazer_score ON registered_scores_mania (user_id, lazer_score, score_id);
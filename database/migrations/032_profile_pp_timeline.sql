@@ -0,0 +1,14 @@
+-- Profile pp timeline points, written by timelineService whenever inserted scores change a user's weighted total.
+-- Score ingestion writes to this table, so it must exist before the fetcher and the websocket listener are deployed.
+
+CREATE TABLE profile_pp_timeline (
+    user_id INTEGER NOT NULL,
+    mode ENUM('osu','taiko','fruits','mania') NOT NULL,
+    score_id INTEGER NOT NULL,
+    date DATETIME,
+    pp FLOAT,
+    PRIMARY KEY (user_id, mode, score_id),
+    FOREIGN KEY (user_id) REFERENCES registered_users (user_id)
+);
+
+CREATE INDEX ix_profile_pp_timeline_user_mode_date ON profile_pp_timeline (user_id, mode, date);
@@ -0,0 +1,13 @@
+-- Compact leaderboard snapshots, written by snapshotLeaderboards.py and read by /leaderboard_rank_history and
+-- /leaderboard_at. The arrays are zlib-compressed, LargeBinary(2**24) in the model.
+
+CREATE TABLE leaderboard_snapshots (
+    leaderboard_id INTEGER NOT NULL,
+    taken_at DATETIME NOT NULL,
+    num_spots INTEGER,
+    user_ids MEDIUMBLOB,
+    ranks MEDIUMBLOB,
+    spot_values MEDIUMBLOB,
+    PRIMARY KEY (leaderboard_id, taken_at),
+    FOREIGN KEY (leaderboard_id) REFERENCES leaderboards (leaderboard_id)
+);
@@ -0,0 +1,4 @@
+-- The metrics added to LeaderboardMetricEnum. Without them, creating a leaderboard with one of the new metrics fails
+-- in strict mode. The new members are appended after the existing ones, so MySQL changes only the table's metadata.
+
+ALTER TABLE leaderboards MODIFY metric ENUM('weighted_pp','count_unique_beatmaps','total_score','count_ss','total_max_combo','total_pp','average_accuracy');
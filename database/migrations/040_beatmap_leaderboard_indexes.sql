@@ -0,0 +1,15 @@
+-- Per-beatmap leaderboards of registered users (/stats/beatmap_leaderboard), ordered by pp or lazer_score.
+-- Without these every request scans the beatmap's scores and sorts them.
+-- Creating an index does not block reads or writes on MySQL 8 (ALGORITHM=INPLACE, LOCK=NONE).
+
+CREATE INDEX ix_registered_scores_osu_beatmap_pp ON registered_scores_osu (beatmap_id, pp, score_id);
+CREATE INDEX ix_registered_scores_osu_beatmap_lazer_score ON registered_scores_osu (beatmap_id, lazer_score, score_id);
+
+CREATE INDEX ix_registered_scores_taiko_beatmap_pp ON registered_scores_taiko (beatmap_id, pp, score_id);
+CREATE INDEX ix_registered_scores_taiko_beatmap_lazer_score ON registered_scores_taiko (beatmap_id, lazer_score, score_id);
+
+CREATE INDEX ix_registered_scores_catch_beatmap_pp ON registered_scores_catch (beatmap_id, pp, score_id);
+CREATE INDEX ix_registered_scores_catch_beatmap_lazer_score ON registered_scores_catch (beatmap_id, lazer_score, score_id);
+
+CREATE INDEX ix_registered_scores_mania_beatmap_pp ON registered_scores_mania (beatmap_id, pp, score_id);
+CREATE INDEX ix_registered_scores_mania_beatmap_lazer_score ON registered_scores_mania (beatmap_id, lazer_score, score_id);
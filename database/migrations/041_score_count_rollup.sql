@@ -0,0 +1,14 @@
+-- The number of scores each user set per day and mode, maintained by activityService for the activity summaries.
+-- Score ingestion (insert_scores) adds to this table, so it must exist before the fetcher and the websocket listener
+-- are deployed. Fill it with `python reconcileActivity.py --all` once it exists.
+
+CREATE TABLE score_count_rollup (
+    date DATE NOT NULL,
+    mode ENUM('osu','taiko','fruits','mania') NOT NULL,
+    user_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (date, mode, user_id),
+    FOREIGN KEY (user_id) REFERENCES registered_users (user_id)
+);
+
+CREATE INDEX ix_score_count_rollup_user_date ON score_count_rollup (user_id, date);
@@ -0,0 +1,5 @@
+-- When any of a leaderboard's spots was last written. /get_leaderboard_info builds its ETag from it and the ranked
+-- index reloads when it changes. The web app and the leaderboard scheduler read and write the column, so it must
+-- exist before either is deployed.
+
+ALTER TABLE leaderboards ADD COLUMN last_updated DATETIME;
@@ -2,7 +2,7 @@ import datetime
 from typing import List
 from sqlalchemy.ext.declarative import AbstractConcreteBase
 from sqlalchemy.orm import DeclarativeBase, registry, relationship, Mapped, declared_attr, declarative_base
-from sqlalchemy import Column, String, Integer, Float, Date, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, Date, Boolean, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.types import JSON
 from sqlalchemy.ext.declarative import ConcreteBase
 import enum
@@ -14,7 +14,12 @@ mapper_registry = registry()
 
 class Base(DeclarativeBase):
     def to_dict(self):
-        return {field.name: getattr(self, field.name) for field in self.__table__.c}
+        cls = type(self)
+        keys = cls.__dict__.get('_dict_keys')
+        if keys is None:
+            keys = tuple(field.key for field in self.__table__.c)
+            cls._dict_keys = keys
+        return {key: getattr(self, key) for key in keys}
 
 '''
 class User(Base):
@@ -54,6 +59,11 @@ class PlaymodeEnum(enum.Enum):
 class LeaderboardMetricEnum(enum.Enum):
     weighted_pp = 'weighted_pp'
     count_unique_beatmaps = 'count_unique_beatmaps'
+    total_score = 'total_score'
+    count_ss = 'count_ss'
+    total_max_combo = 'total_max_combo'
+    total_pp = 'total_pp'
+    average_accuracy = 'average_accuracy'
 
 class Score(AbstractConcreteBase, Base):
     strict_attrs = True
@@ -75,6 +85,18 @@ class Score(AbstractConcreteBase, Base):
     pp = Column(Float)
     replay = Column(Boolean)
 
+    @declared_attr.directive
+    def __table_args__(cls):
+        # Sort-order indexes for keyset pagination. The trailing score_id is the tiebreaker in every cursor.
+        if '__tablename__' not in cls.__dict__:
+            return ()
+        # The beatmap indexes serve per-beatmap leaderboards (scoreService.get_beatmap_leaderboard)
+        return (Index('ix_%s_user_pp' % cls.__tablename__, 'user_id', 'pp', 'score_id'),
+                Index('ix_%s_user_date' % cls.__tablename__, 'user_id', 'date', 'score_id'),
+                Index('ix_%s_user_lazer_score' % cls.__tablename__, 'user_id', 'lazer_score', 'score_id'),
+                Index('ix_%s_beatmap_pp' % cls.__tablename__, 'beatmap_id', 'pp', 'score_id'),
+                Index('ix_%s_beatmap_lazer_score' % cls.__tablename__, 'beatmap_id', 'lazer_score', 'score_id'),)
+
     @declared_attr
     def beatmap_id(cls):
         return Column(Integer, ForeignKey('osu_beatmaps.beatmap_id'))
@@ -385,6 +407,8 @@ class Leaderboard(Base):
     """
     unique = Column(Boolean)
     private = Column(Boolean)
+    # When any of the leaderboard's spots was last written. Clients use it (through the ETag) to tell if the standings changed.
+    last_updated = Column(DateTime)
 
     @declared_attr
     def creator_id(cls):
@@ -408,4 +432,57 @@ class LeaderboardSpot(Base):
     last_updated = Column(DateTime)
 
     leaderboard: Mapped["Leaderboard"] = relationship(back_populates="leaderboard_spots")
-    user: Mapped["RegisteredUser"] = relationship(back_populates="leaderboard_spots")
\ No newline at end of file
+    user: Mapped["RegisteredUser"] = relationship(back_populates="leaderboard_spots")
+
+class ProfilePpPoint(Base):
+    """
+    One point of a user's profile pp timeline. A point is written whenever a score changes the weighted total.
+    Maintained by timelineService.
+    """
+    __tablename__ = 'profile_pp_timeline'
+
+    @declared_attr
+    def user_id(cls):
+        return Column(Integer, ForeignKey('registered_users.user_id'), primary_key=True)
+
+    mode = Column(Enum(PlaymodeEnum), primary_key=True)
+    score_id = Column(Integer, primary_key=True) # The score that changed the total
+    date = Column(DateTime)
+    pp = Column(Float)
+
+    __table_args__ = (Index('ix_profile_pp_timeline_user_mode_date', 'user_id', 'mode', 'date'),)
+
+class LeaderboardSnapshot(Base):
+    """
+    The ordered spots of a leaderboard at one point in time. Maintained by snapshotService.
+    Each snapshot is self-contained, so reading one is a single row fetch. The spots are sorted by user id and stored
+    as zlib-compressed arrays: user ids as deltas (uint32), ranks (uint32) and values (float64).
+    """
+    __tablename__ = 'leaderboard_snapshots'
+
+    @declared_attr
+    def leaderboard_id(cls):
+        return Column(Integer, ForeignKey('leaderboards.leaderboard_id'), primary_key=True)
+
+    taken_at = Column(DateTime, primary_key=True)
+    num_spots = Column(Integer)
+    user_ids = Column(LargeBinary(length=2 ** 24))
+    ranks = Column(LargeBinary(length=2 ** 24))
+    spot_values = Column(LargeBinary(length=2 ** 24))
+
+class ScoreCountRollup(Base):
+    """
+    The number of scores each user set per day and mode, by score date. Maintained by activityService.
+    """
+    __tablename__ = 'score_count_rollup'
+
+    date = Column(Date, primary_key=True)
+    mode = Column(Enum(PlaymodeEnum), primary_key=True)
+
+    @declared_attr
+    def user_id(cls):
+        return Column(Integer, ForeignKey('registered_users.user_id'), primary_key=True)
+
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index('ix_score_count_rollup_user_date', 'user_id', 'date'),)
@@ -1,4 +1,4 @@
-from ossapi import Ossapi
+from functools import cache
 from dotenv import load_dotenv
 import os
 from ratelimit import limits, sleep_and_retry
@@ -14,7 +14,14 @@ CALLS = 60
 load_dotenv()
 client_id = os.getenv('CLIENT_ID')
 client_secret = os.getenv('CLIENT_SECRET')
-osu_api = Ossapi(client_id, client_secret)
+
+@cache
+def get_osu_api():
+    """
+    The client, created on first use so importing this module does not build it
+    """
+    from ossapi import Ossapi
+    return Ossapi(client_id, client_secret)
 
 # Gets a list of all ranked, approved, and loved maps a user has played
 # The user_beatmaps endpoint can grab 100 at a time.
@@ -24,7 +31,7 @@ osu_api = Ossapi(client_id, client_secret)
 @sleep_and_retry
 @limits(calls=CALLS, period=ONE_MINUTE)
 def get_user_maps(user_id, offset, limit):
-    return osu_api.user_beatmaps(user_id, "most_played", limit=limit, offset=offset)
+    return get_osu_api().user_beatmaps(user_id, "most_played", limit=limit, offset=offset)
 
 def get_most_played(user_id):
     map_list = []
@@ -41,12 +48,12 @@ def get_most_played(user_id):
 @sleep_and_retry
 @limits(calls=CALLS, period=ONE_MINUTE)
 def get_user_info(user_id):
-    return osu_api.user(user_id)
+    return get_osu_api().user(user_id)
 
 @sleep_and_retry
 @limits(calls=CALLS, period=ONE_MINUTE)
 def get_score_info(score_id):
-    return osu_api.score(score_id)
+    return get_osu_api().score(score_id)
 
 def parse_modlist(modlist):
     if not modlist:
@@ -75,9 +82,9 @@ def parse_modlist(modlist):
 def get_user_scores_on_map(beatmap_id, user_id, multiple = True, mode = None):
     try:
         if multiple:
-            score_infos = osu_api.beatmap_user_scores(beatmap_id, user_id, mode = mode)
+            score_infos = get_osu_api().beatmap_user_scores(beatmap_id, user_id, mode = mode)
         else:
-            score_infos = [osu_api.beatmap_user_score(beatmap_id, user_id, mode = mode).score]
+            score_infos = [get_osu_api().beatmap_user_score(beatmap_id, user_id, mode = mode).score]
     except ValueError as ve:
         print(ve)
         print('Map probably has an issue or has no leaderboard')
@@ -92,7 +99,7 @@ def get_user_recent_scores(user_id):
     offset = 0
     limit = 100
     for mode in modes:
-        while b := osu_api.user_scores(user_id, 'recent', mode=mode, offset=offset, limit=limit):
+        while b := get_osu_api().user_scores(user_id, 'recent', mode=mode, offset=offset, limit=limit):
             scores += b
             offset += limit
         offset = 0
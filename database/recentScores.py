@@ -0,0 +1,150 @@
+"""
+The most recently fetched scores of every mode, kept in memory with their beatmap, beatmapset and user already joined,
+so /recent_scores and its event stream never query the score tables.
+
+The buffer is filled once from the database when it is first used, then kept current two ways:
+- scores written in this process arrive through events.SCORES_INSERTED
+- scores written by other processes (the fetcher, the websocket listener) are picked up by a thread that reads the
+  highest score_id of each mode every POLL_INTERVAL seconds and only loads the rows above what it has seen
+
+Like the old query, each mode holds its highest score ids, and the most recent scores are the newest of those by date.
+"""
+import asyncio
+import threading
+import time
+from typing import Dict, List, Sequence
+from database.scoreService import get_recent_scores, latest_score_ids
+from database.serializers import recent_score_projection, rows_to_dicts
+from database.models import Score
+import database.events as events
+
+MODES = ('osu', 'taiko', 'fruits', 'mania')
+POLL_INTERVAL = 1
+# Scores kept per mode
+BUFFER_SIZE = 100
+# Scores a slow stream listener may fall behind by before newer ones are dropped for it
+LISTENER_BACKLOG = 1000
+
+class RecentScores:
+
+    def __init__(self, sessionmaker, size: int = BUFFER_SIZE, poll_interval: float = POLL_INTERVAL):
+        self.sessionmaker = sessionmaker
+        self.size = size
+        self.poll_interval = poll_interval
+        # mode -> {score_id: score dict}
+        self.scores: Dict[str, Dict[int, dict]] = {mode: {} for mode in MODES}
+        # The highest score_id of each mode added so far
+        self.seen: Dict[str, int] = {mode: 0 for mode in MODES}
+        self.ordered: List[dict] = []
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self) -> None:
+        """
+        Loads the newest scores of every mode and starts following new ones
+        """
+        session = self.sessionmaker()
+        try:
+            for mode in MODES:
+                self.add(mode, self._load(session, mode, self.size))
+        finally:
+            session.close()
+        events.subscribe(events.SCORES_INSERTED, self.on_scores_inserted)
+        self.thread = threading.Thread(target=self._poll, name='recent-scores', daemon=True)
+        self.thread.start()
+
+    def _load(self, session, mode: str, n: int, **filters) -> List[dict]:
+        header, columns = recent_score_projection(mode)
+        # Scores on beatmaps missing from osu_beatmaps, or of users missing from registered_users, are skipped
+        username = header.index('username')
+        rows = [row for row in get_recent_scores(session, mode, n, columns, **filters)
+                if row[0] is not None and row[username] is not None]
+        return rows_to_dicts(header, rows)
+
+    def add(self, mode: str, scores: Sequence[dict]) -> None:
+        """
+        Adds score dicts of one mode, keeping the mode's `size` highest score ids, and notifies stream listeners
+        """
+        if not scores:
+            return
+        with self.lock:
+            buffer = self.scores[mode]
+            for score in scores:
+                buffer[score['score_id']] = score
+                self.seen[mode] = max(self.seen[mode], score['score_id'])
+            for score_id in sorted(buffer)[:-self.size]:
+                del buffer[score_id]
+            added = [score for score in scores if score['score_id'] in buffer]
+            self.ordered = sorted((score for buffer in self.scores.values() for score in buffer.values()),
+                                  key=lambda x: x['date'], reverse=True)
+            listeners = list(self.listeners) if added else []
+        for loop, queue in listeners:
+            loop.call_soon_threadsafe(_offer, queue, added)
+
+    def latest(self, n: int) -> List[dict]:
+        return self.ordered[:n]
+
+    def on_scores_inserted(self, session, scores: Sequence[Score]) -> None:
+        by_mode = {}
+        for score in scores:
+            by_mode.setdefault(score.get_mode(), []).append(score.score_id)
+        for mode, score_ids in by_mode.items():
+            self.add(mode, self._load(session, mode, len(score_ids), score_ids=score_ids))
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.poll()
+
+    def poll(self) -> None:
+        """
+        Adds the scores other processes wrote since the last poll
+        """
+        session = self.sessionmaker()
+        try:
+            for mode, latest in zip(MODES, latest_score_ids(session, MODES)):
+                if latest is not None and latest > self.seen[mode]:
+                    self.add(mode, self._load(session, mode, self.size, after=self.seen[mode]))
+                    # Also skips the scores _load leaves out, so they are not read again
+                    with self.lock:
+                        self.seen[mode] = max(self.seen[mode], latest)
+        except Exception as e:
+            print('Could not read recent scores')
+            print(e)
+        finally:
+            session.close()
+
+    def listen(self) -> asyncio.Queue:
+        """
+        A queue receiving each list of newly added scores. Must be called from the event loop that reads it.
+        """
+        queue = asyncio.Queue(LISTENER_BACKLOG)
+        with self.lock:
+            self.listeners.append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def stop_listening(self, queue: asyncio.Queue) -> None:
+        with self.lock:
+            self.listeners = [(loop, q) for loop, q in self.listeners if q is not queue]
+
+def _offer(queue: asyncio.Queue, scores: List[dict]) -> None:
+    try:
+        queue.put_nowait(scores)
+    except asyncio.QueueFull:
+        pass
+
+_buffers: Dict[object, RecentScores] = {}
+_buffers_lock = threading.Lock()
+
+def get_recent_scores_buffer(sessionmaker) -> RecentScores:
+    """
+    The buffer of a database, started on first use
+    """
+    bind = sessionmaker.kw.get('bind')
+    with _buffers_lock:
+        if bind not in _buffers:
+            buffer = RecentScores(sessionmaker)
+            buffer.start()
+            _buffers[bind] = buffer
+        return _buffers[bind]
@@ -0,0 +1,143 @@
+"""
+Evaluates the filters built by util.parse_*_filters against Score objects in memory.
+The parsers return SQLAlchemy expressions (column <op> value), so instead of parsing the filter strings a second time
+each expression is compiled once into a Python function with the same meaning as the SQL:
+- string values are coerced to the column's type ('pp>100' compares against 100.0, dates are parsed)
+- string comparisons ignore case, like MySQL's default collation
+- a comparison involving NULL never matches
+"""
+import datetime
+import enum
+import operator as op
+from typing import Any, Callable, Sequence
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, ColumnClause, ExpressionClauseList, Grouping
+from database.models import Beatmap, BeatmapSet
+from database.util import get_mode_table
+
+def _fold(value):
+    if isinstance(value, enum.Enum):
+        value = value.value
+    if isinstance(value, str):
+        return value.casefold()
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def _coerce(value, sql_type):
+    """
+    Turns a filter value, usually a string, into what the column holds in Python
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_coerce(v, sql_type) for v in value)
+    if not isinstance(value, str):
+        return _fold(value)
+    try:
+        python_type = sql_type.python_type
+    except NotImplementedError:
+        return _fold(value)
+    try:
+        if python_type is bool:
+            return value.lower() in ('1', 'true')
+        if python_type is int:
+            return int(float(value))
+        if python_type is float:
+            return float(value)
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        if python_type is datetime.date:
+            return datetime.date.fromisoformat(value)
+    except ValueError:
+        pass
+    return _fold(value)
+
+def _contains(a, b):
+    return b in a
+
+def _not_contains(a, b):
+    return b not in a
+
+def _in(a, b):
+    return a in b
+
+def _not_in(a, b):
+    return a not in b
+
+_PYTHON_OPERATORS = {
+    operators.eq: op.eq,
+    operators.ne: op.ne,
+    operators.gt: op.gt,
+    operators.lt: op.lt,
+    operators.ge: op.ge,
+    operators.le: op.le,
+    operators.add: op.add,
+    operators.sub: op.sub,
+    operators.mul: op.mul,
+    operators.in_op: _in,
+    operators.not_in_op: _not_in,
+    operators.contains_op: _contains,
+    operators.not_contains_op: _not_contains,
+    operators.icontains_op: _contains,
+    operators.not_icontains_op: _not_contains,
+}
+
+class ScoreMatcher:
+    """
+    Compiled mod/score/beatmap/beatmapset filters of one mode.
+    matcher(score, beatmap) is True if the score would be returned by plan_score_query with the same filters.
+    The beatmap (with its beatmapset loaded) is only needed when needs_beatmap is True.
+
+    Raises NotImplementedError for expressions it cannot evaluate, so callers can fall back to SQL.
+    """
+
+    def __init__(self, mode: str or int, mod_filters: Sequence = (), score_filters: Sequence = (),
+                 beatmap_filters: Sequence = (), beatmapset_filters: Sequence = ()):
+        # Position of each table's object in the tuple passed to the compiled functions
+        self.tables = {get_mode_table(mode).__table__: 0, Beatmap.__table__: 1, BeatmapSet.__table__: 2}
+        self.needs_beatmap = bool(beatmap_filters or beatmapset_filters)
+        self.predicates = [self._compile(clause) for clause in
+                           (*(mod_filters or ()), *(score_filters or ()), *(beatmap_filters or ()), *(beatmapset_filters or ()))]
+
+    def _compile(self, clause, sql_type=None) -> Callable[[tuple], Any]:
+        if isinstance(clause, Grouping):
+            return self._compile(clause.element, sql_type)
+        if isinstance(clause, ColumnClause):
+            if clause.table not in self.tables:
+                raise NotImplementedError('Cannot evaluate %s in memory' % clause)
+            i, key = self.tables[clause.table], clause.key
+            return lambda objects: _fold(getattr(objects[i], key, None)) if objects[i] is not None else None
+        if isinstance(clause, BindParameter):
+            value = _coerce(clause.effective_value, sql_type if sql_type is not None else clause.type)
+            return lambda objects: value
+        if isinstance(clause, ExpressionClauseList) and clause.operator in _PYTHON_OPERATORS:
+            function = _PYTHON_OPERATORS[clause.operator]
+            parts = [self._compile(c, sql_type) for c in clause.clauses]
+
+            def evaluate_list(objects):
+                values = [part(objects) for part in parts]
+                if any(v is None for v in values):
+                    return None
+                result = values[0]
+                for v in values[1:]:
+                    result = function(result, v)
+                return result
+            return evaluate_list
+        if isinstance(clause, BinaryExpression) and clause.operator in _PYTHON_OPERATORS:
+            function = _PYTHON_OPERATORS[clause.operator]
+            left = self._compile(clause.left)
+            right = self._compile(clause.right, clause.left.type)
+
+            def evaluate_binary(objects):
+                a, b = left(objects), right(objects)
+                if a is None or b is None:
+                    return None
+                return function(a, b)
+            return evaluate_binary
+        raise NotImplementedError('Cannot evaluate %s in memory' % clause)
+
+    def __call__(self, score, beatmap=None) -> bool:
+        if self.needs_beatmap and beatmap is None:
+            # plan_score_query inner joins the beatmap when it filters on it
+            return False
+        objects = (score, beatmap, beatmap.beatmapset if beatmap is not None and self.needs_beatmap else None)
+        return all(predicate(objects) for predicate in self.predicates)
@@ -5,31 +5,67 @@ Includes:
     - Calculating Metrics for users based on their Scores (weighted_sum_pp, group by count scores, etc.)
 """
 
+import base64
+import datetime
+import heapq
+import itertools
+import json
 from collections.abc import Sequence
-from sqlalchemy import select, and_, func
-from sqlalchemy.orm import Session
-from database.models import Beatmap, Score, BeatmapSet
-from database.util import parse_user_filters
-from util import get_mode_table
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from sqlalchemy import select, and_, or_, func, literal, union_all, Select, Row
+from sqlalchemy.orm import Session, contains_eager, sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.sql.visitors import replacement_traverse
+from database.models import Beatmap, Score, BeatmapSet, RegisteredUser
+from database.util import parse_user_filters, get_mode_table, supports_window_functions, for_mode, modes, with_timeout, connection_id, BONUS_PP, pp_weights
+import database.timelineService as timelineService
+import database.events as events
+import database.activityService as activityService
+from database.cache import LRUCache, generations
+from typing import List, Any, Callable, Iterator, Tuple
 from ossapi import Score as ossapiScore
 
-def insert_scores(session: Session, scores: List[ossapiScore]) -> bool:
+def insert_scores(session: Session, scores: List[ossapiScore], update_timeline: bool = True, notify: bool = True) -> bool:
+    """
+    Writes scores from the osu! api to the database.
+    - update_timeline: also update the profile pp timeline. Bulk fetches turn this off and backfill once at the end.
+    - notify:          emit events.SCORES_INSERTED (incremental leaderboard updates). Bulk fetches recalculate once at the end instead.
+    """
     if not scores:
         return False
     try:
+        new_scores = []
         for score in scores:
             new_score = get_mode_table(score.ruleset_id)()
             new_score.set_details(score)
+            new_scores.append(new_score)
+        # Scores fetched again are only updated, so they must not be counted twice in the activity rollup
+        existing = activityService.existing_score_ids(session, new_scores)
+        for new_score in new_scores:
             session.merge(new_score)
+        activityService.count_new_scores(session, [x for x in new_scores if x.score_id not in existing])
         session.commit()
-        return True
     except Exception as e:
         print(e)
         for score in scores:
             print(str(score))
         return False
 
+    if update_timeline:
+        try:
+            timelineService.record_scores(session, new_scores)
+        except Exception as e:
+            session.rollback()
+            print('Could not update the profile pp timeline')
+            print(e)
+    beatmap_leaderboard_cache.invalidate_tags({(score.get_mode(), score.beatmap_id) for score in new_scores})
+    generations.bump(('user', score.user_id) for score in new_scores)
+    if notify:
+        events.emit(events.SCORES_INSERTED, session, new_scores)
+    return True
+
 def get_user_scores(session: Session, beatmap_id: int, user_id: int, mode: str or int, filters: tuple = (), mods: tuple = (), metric: str = 'lazer_score') -> Sequence[Score]:
     """
     Given a user and a beatmap, get all the user's scores on that beatmap. Can also specify filters and metrics to sort by
@@ -43,15 +79,175 @@ def get_user_scores(session: Session, beatmap_id: int, user_id: int, mode: str o
     ).filter(*filters).filter(*mods).order_by(getattr(table, metric).desc())
     return session.scalars(stmt).all()
 
-async def get_scores(session: Session, mode: str or int, metric: str = 'lazer_score', desc: bool = True,
-               limit=100,
-               mod_filters: tuple = (),
-               score_filters: tuple = (),
-               beatmap_filters: tuple = None,
-               beatmapset_filters: tuple = None,
-               ) -> Sequence[Score]:
+_LIKE_OPERATORS = (operators.like_op, operators.not_like_op, operators.ilike_op, operators.not_ilike_op,
+                   operators.contains_op, operators.not_contains_op, operators.icontains_op, operators.not_icontains_op)
+
+def _score_predicate_cost(predicate) -> int:
     """
-    Select a list of scores based on some criteria
+    Rough selectivity rank of a predicate. Lower goes first in the WHERE clause.
+    """
+    operator = getattr(predicate, 'operator', None)
+    if operator in _LIKE_OPERATORS:
+        return 4
+    tables = find_tables(predicate, check_columns=True)
+    if BeatmapSet.__table__ in tables:
+        return 3
+    if Beatmap.__table__ in tables:
+        return 2
+    left = getattr(predicate, 'left', None)
+    if operator in (operators.eq, operators.in_op) and left is not None and \
+            getattr(left, 'name', None) in ('user_id', 'beatmap_id', 'score_id'):
+        return 0
+    return 1
+
+def plan_score_query(mode: str or int,
+                     mod_filters: tuple = (),
+                     score_filters: tuple = (),
+                     beatmap_filters: tuple = None,
+                     beatmapset_filters: tuple = None,
+                     columns: tuple = None,
+                     load_beatmap: bool = False,
+                     load_user: bool = False) -> Select:
+    """
+    Builds the single SELECT used by get_scores, count_scores and get_top_n.
+
+    - Filters on keys that also live on a cheaper table are rewritten onto it
+      (Beatmap.beatmap_id -> score.beatmap_id, BeatmapSet.beatmapset_id -> Beatmap.beatmapset_id)
+    - osu_beatmaps and osu_beatmapsets are only joined if a predicate or the projection needs them
+    - Predicates are ordered from most to least selective (indexed equality first, LIKE scans last)
+    - If load_beatmap or load_user is set, score.beatmap.beatmapset and score.user are populated from the same statement
+
+    :param columns      select these columns instead of score objects (ex. (func.count(table.score_id),))
+    :param load_beatmap eager load score.beatmap and score.beatmap.beatmapset
+    :param load_user    eager load score.user
+    """
+    table = get_mode_table(mode)
+
+    pushdown = {
+        Beatmap.__table__.c.beatmap_id: table.__table__.c.beatmap_id,
+        BeatmapSet.__table__.c.beatmapset_id: Beatmap.__table__.c.beatmapset_id,
+    }
+    predicates = [replacement_traverse(predicate, {}, lambda element: pushdown.get(element))
+                  for predicate in (*score_filters, *mod_filters, *(beatmap_filters or ()), *(beatmapset_filters or ()))]
+    predicates.sort(key=_score_predicate_cost)
+
+    filter_tables = set()
+    for predicate in predicates:
+        filter_tables.update(find_tables(predicate, check_columns=True))
+    projection_tables = set()
+    for column in columns or ():
+        column = column.__clause_element__() if hasattr(column, '__clause_element__') else column
+        projection_tables.update(find_tables(column, check_columns=True))
+    if load_beatmap:
+        projection_tables.update((Beatmap.__table__, BeatmapSet.__table__))
+
+    # Joins needed by a filter are inner joins. Joins only needed by the projection are outer joins, so that scores on
+    # beatmaps missing from osu_beatmaps are still returned.
+    needs_beatmapset = BeatmapSet.__table__ in filter_tables | projection_tables
+    needs_beatmap = needs_beatmapset or Beatmap.__table__ in filter_tables | projection_tables
+    beatmap_inner = Beatmap.__table__ in filter_tables or BeatmapSet.__table__ in filter_tables
+    beatmapset_inner = BeatmapSet.__table__ in filter_tables
+
+    stmt = select(*columns).select_from(table) if columns else select(table)
+    if needs_beatmap:
+        stmt = stmt.join(Beatmap, table.beatmap_id == Beatmap.beatmap_id, isouter=not beatmap_inner)
+    if needs_beatmapset:
+        stmt = stmt.join(BeatmapSet, Beatmap.beatmapset_id == BeatmapSet.beatmapset_id, isouter=not beatmapset_inner)
+    if load_beatmap and not columns:
+        stmt = stmt.options(contains_eager(table.beatmap).contains_eager(Beatmap.beatmapset))
+    if load_user or RegisteredUser.__table__ in projection_tables:
+        stmt = stmt.join(RegisteredUser, table.user_id == RegisteredUser.user_id, isouter=True)
+    if load_user and not columns:
+        stmt = stmt.options(contains_eager(table.user))
+
+    return stmt.filter(*predicates)
+
+# Units of estimate_query_cost: reading one user's scores through the user_id index costs 1
+FULL_SCAN_COST = 1000
+
+def estimate_query_cost(mode: str or int, user_count: int = None,
+                        mod_filters: tuple = (),
+                        score_filters: tuple = (),
+                        beatmap_filters: tuple = None,
+                        beatmapset_filters: tuple = None) -> float:
+    """
+    Rough relative cost of the statement plan_score_query builds for these filters, used for admission control.
+    Without a user filter every score of the mode is read. Joining the beatmap tables and every LIKE (mod and tag
+    filters), which MySQL cannot answer from an index, multiply it. Mode 'all' reads four tables.
+    """
+    mode_key = 'osu' if mode == 'all' else mode
+    predicates = [*for_mode(score_filters, mode_key), *for_mode(mod_filters, mode_key), *(beatmap_filters or ()), *(beatmapset_filters or ())]
+    tables = set()
+    for predicate in predicates:
+        tables.update(find_tables(predicate, check_columns=True))
+
+    cost = float(user_count) if user_count else float(FULL_SCAN_COST)
+    if Beatmap.__table__ in tables or BeatmapSet.__table__ in tables:
+        cost *= 2
+    if BeatmapSet.__table__ in tables:
+        cost *= 1.5
+    cost *= 1 + sum(getattr(predicate, 'operator', None) in _LIKE_OPERATORS for predicate in predicates)
+    if mode == 'all':
+        cost *= len(modes)
+    return cost
+
+def encode_cursor(value, score_id: int) -> str:
+    """
+    Opaque cursor for the row after which the next page starts
+    """
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, score_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str, metric: str) -> (Any, int):
+    """
+    Returns (sort value, score_id). Raises ValueError if the cursor was not made by encode_cursor
+    """
+    try:
+        value, score_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Invalid cursor %s' % cursor)
+    if metric == 'date' and value is not None:
+        value = datetime.datetime.fromisoformat(value)
+    return value, int(score_id)
+
+def next_cursor(scores: Sequence[Score] | Sequence[Row], metric: str, limit: int) -> str | None:
+    """
+    The cursor for the page after scores, or None if scores was the last page.
+    Works on Score objects and on rows that include score_id and the metric column.
+    """
+    if len(scores) < limit:
+        return None
+    last = scores[-1]
+    return encode_cursor(getattr(last, metric), last.score_id)
+
+def keyset_filter(sort_column, id_column, cursor: str, metric: str, desc: bool):
+    """
+    Predicate selecting the rows after a cursor when ordering by (sort_column, id_column).
+    MySQL puts NULLs first when ascending and last when descending, so the NULL tail is handled explicitly.
+    """
+    value, score_id = decode_cursor(cursor, metric)
+    if desc:
+        if value is None:
+            return and_(sort_column.is_(None), id_column < score_id)
+        return or_(sort_column < value, and_(sort_column == value, id_column < score_id), sort_column.is_(None))
+    if value is None:
+        return or_(sort_column.is_not(None), and_(sort_column.is_(None), id_column > score_id))
+    return or_(sort_column > value, and_(sort_column == value, id_column > score_id))
+
+def score_page_query(mode: str or int, metric: str = 'lazer_score', desc: bool = True,
+                     limit=100,
+                     mod_filters: tuple = (),
+                     score_filters: tuple = (),
+                     beatmap_filters: tuple = None,
+                     beatmapset_filters: tuple = None,
+                     load_beatmap: bool = False,
+                     load_user: bool = False,
+                     columns: tuple = None,
+                     cursor: str = None,
+                     timeout: float = None) -> Select:
+    """
+    The statement get_scores runs for one mode
     """
 
     # Get mode
@@ -59,32 +255,119 @@ async def get_scores(session: Session, mode: str or int, metric: str = 'lazer_sc
 
     # Parse order and metric
     sort_order = getattr(score_type_table, metric)
+    id_order = score_type_table.score_id
     if desc:
         sort_order = sort_order.desc()
+        id_order = id_order.desc()
 
     # Apply filters
-    stmt = select(score_type_table).filter(*score_filters).filter(*mod_filters)
-    if beatmap_filters:
-        stmt = stmt.join(Beatmap, score_type_table.beatmap_id == Beatmap.beatmap_id).filter(*beatmap_filters)
-    if beatmapset_filters:
-        if not beatmap_filters:
-            stmt = stmt.join(Beatmap, score_type_table.beatmap_id == Beatmap.beatmap_id)
-        stmt = stmt.join(BeatmapSet, Beatmap.beatmapset_id == BeatmapSet.beatmapset_id).filter(*beatmapset_filters)
+    stmt = plan_score_query(mode, mod_filters, score_filters, beatmap_filters, beatmapset_filters, columns, load_beatmap, load_user)
+    if cursor:
+        stmt = stmt.filter(keyset_filter(getattr(score_type_table, metric), score_type_table.score_id, cursor, metric, desc))
 
     # Order and limit results
-    stmt = stmt.order_by(sort_order).limit(limit)
-
+    return with_timeout(stmt.order_by(sort_order, id_order).limit(limit), timeout)
+
+def select_scores(session: Session, mode: str or int, metric: str = 'lazer_score', desc: bool = True,
+                  limit=100,
+                  mod_filters: tuple = (),
+                  score_filters: tuple = (),
+                  beatmap_filters: tuple = None,
+                  beatmapset_filters: tuple = None,
+                  load_beatmap: bool = False,
+                  load_user: bool = False,
+                  columns: tuple = None,
+                  cursor: str = None,
+                  timeout: float = None,
+                  ) -> Sequence[Score] | Sequence[Row]:
+    """
+    Select a list of scores based on some criteria
+    If columns are given, returns rows of those columns instead of Score objects
+    Pages are ordered by (metric, score_id). Pass next_cursor() of a page as cursor to get the next one.
+    mode can be 'all', see merge_modes
+    timeout stops the statement on the server after that many seconds (see with_timeout)
+    """
+    if mode == 'all':
+        return merge_modes(session, lambda m: score_page_query(
+            m, metric, desc, limit, for_mode(mod_filters, m), for_mode(score_filters, m), beatmap_filters, beatmapset_filters,
+            load_beatmap, load_user, for_mode(columns, m), cursor, timeout), metric, desc, limit, columns)
+
+    stmt = score_page_query(mode, metric, desc, limit, mod_filters, score_filters, beatmap_filters, beatmapset_filters,
+                            load_beatmap, load_user, columns, cursor, timeout)
+    if columns:
+        return session.execute(stmt).all()
     return session.scalars(stmt).all()
 
+async def get_scores(session: Session, mode: str or int, metric: str = 'lazer_score', desc: bool = True,
+               limit=100,
+               mod_filters: tuple = (),
+               score_filters: tuple = (),
+               beatmap_filters: tuple = None,
+               beatmapset_filters: tuple = None,
+               load_beatmap: bool = False,
+               load_user: bool = False,
+               columns: tuple = None,
+               cursor: str = None,
+               ) -> Sequence[Score] | Sequence[Row]:
+    """
+    select_scores for async callers
+    """
+    return select_scores(session, mode, metric, desc, limit, mod_filters, score_filters, beatmap_filters, beatmapset_filters,
+                         load_beatmap, load_user, columns, cursor)
+
+# Runs the per-table statements of mode 'all'
+_mode_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='mode-query')
+
+def _merge_key(metric: str):
+    # The order of ORDER BY metric, score_id in MySQL, which puts NULLs first when ascending
+    def key(row):
+        value = getattr(row, metric)
+        return value is not None, value if value is not None else 0, row.score_id
+    return key
+
+def merge_modes(session: Session, query: Callable[[str], Select], metric: str, desc: bool, limit: int,
+                columns: tuple | dict = None) -> List[Score] | List[Row]:
+    """
+    Runs query(mode) for every mode at once, each on its own connection, so the latency is that of the slowest table
+    instead of the sum. Each result is already sorted and limited, so a k-way merge of the four stops after limit rows.
+
+    Filters and columns given to the query for mode 'all' are dicts per mode (util.parse_per_mode). If columns are given,
+    each row gets a trailing 'mode' column, otherwise the Score objects tell their mode with get_mode().
+    If session.info has a 'connection_ids' list (admission.run_query), the server id of every per-mode connection is
+    added to it, so the statements can be killed.
+    """
+    factory = sessionmaker(bind=session.get_bind())
+    server_ids = session.info.get('connection_ids')
+
+    def run(mode: str):
+        mode_session = factory()
+        try:
+            if server_ids is not None:
+                server_ids.append(connection_id(mode_session))
+            stmt = query(mode)
+            if columns:
+                return mode_session.execute(stmt.add_columns(literal(mode).label('mode'))).all()
+            return mode_session.scalars(stmt).all()
+        finally:
+            mode_session.close()
+
+    results = list(_mode_pool.map(run, modes))
+    return list(itertools.islice(heapq.merge(*results, key=_merge_key(metric), reverse=desc), limit))
+
 async def count_scores(session: Session, mode: str or int, group_by: str | None = None, desc: bool = True, limit = 1000,
                          mod_filters: tuple = (),
                          score_filters: tuple = (),
                          beatmap_filters: tuple = None,
-                         beatmapset_filters: tuple = None) -> List[dict]:
+                         beatmapset_filters: tuple = None,
+                         timeout: float = None) -> List[dict]:
         """
         Returns the number of scores with the given filters
         If group by is None, do not group by anything and instead just count the total.
+        For mode 'all' the counts of every table are added up in one UNION ALL statement.
+        timeout stops the statement on the server after that many seconds (see with_timeout)
         """
+        if mode == 'all':
+            return _count_all_modes(session, group_by, desc, limit, mod_filters, score_filters, beatmap_filters, beatmapset_filters, timeout)
 
         score_type_table = get_mode_table(mode)
 
@@ -94,18 +377,12 @@ async def count_scores(session: Session, mode: str or int, group_by: str | None
 
         # Choose group by
         if group_by:
-            stmt = select(getattr(score_type_table, group_by), func.count(score_type_table.score_id))
+            columns = (getattr(score_type_table, group_by), func.count(score_type_table.score_id))
         else:
-            stmt = select(func.count(score_type_table.score_id))
+            columns = (func.count(score_type_table.score_id),)
 
         # Apply all WHERE clauses
-        stmt = stmt.filter(*score_filters).filter(*mod_filters)
-        if beatmap_filters:
-            stmt = stmt.join(Beatmap, score_type_table.beatmap_id == Beatmap.beatmap_id).filter(*beatmap_filters)
-        if beatmapset_filters:
-            if not beatmap_filters:
-                stmt = stmt.join(Beatmap, score_type_table.beatmap_id == Beatmap.beatmap_id)
-            stmt = stmt.join(BeatmapSet, Beatmap.beatmapset_id == BeatmapSet.beatmapset_id).filter(*beatmapset_filters)
+        stmt = plan_score_query(mode, mod_filters, score_filters, beatmap_filters, beatmapset_filters, columns=columns)
 
         # Group by field and sort
         if group_by:
@@ -114,7 +391,7 @@ async def count_scores(session: Session, mode: str or int, group_by: str | None
             stmt = stmt.order_by(sort_order)
 
         # Limit results
-        stmt = stmt.limit(limit)
+        stmt = with_timeout(stmt.limit(limit), timeout)
 
         # Parse and format response
         res = list(session.execute(stmt).fetchall())
@@ -123,37 +400,168 @@ async def count_scores(session: Session, mode: str or int, group_by: str | None
         else:
             return res[0][0]
 
-async def get_top_n(session: Session, user_id: int, mode: str or int, metric: str = 'pp', desc = True, limit: int = 100, unique: bool = True,
-              mod_filters: tuple = (),
-              score_filters: tuple = (),
-              beatmap_filters: tuple = None,
-              beatmapset_filters: tuple = None) -> Sequence[Score]:
+def _count_all_modes(session: Session, group_by: str | None, desc: bool, limit: int,
+                     mod_filters, score_filters, beatmap_filters, beatmapset_filters, timeout: float = None) -> List[dict] | int:
+    parts = []
+    for mode in modes:
+        table = get_mode_table(mode)
+        columns = (func.count(table.score_id).label('count'),)
+        if group_by:
+            columns = (getattr(table, group_by).label('group_key'),) + columns
+        part = plan_score_query(mode, for_mode(mod_filters, mode), for_mode(score_filters, mode), beatmap_filters,
+                                beatmapset_filters, columns=columns)
+        parts.append(part.group_by(getattr(table, group_by)) if group_by else part)
+    counts = union_all(*parts).subquery()
+    total = func.sum(counts.c.count)
+    if not group_by:
+        return int(session.scalar(with_timeout(select(total), timeout)) or 0)
+    stmt = select(counts.c.group_key, total).group_by(counts.c.group_key).order_by(total.desc() if desc else total).limit(limit)
+    return [{group_by: x[0], "count": int(x[1])} for x in session.execute(with_timeout(stmt, timeout))]
+
+def top_n_query(user_id: int, mode: str or int, metric: str = 'pp', desc = True, limit: int = 100, unique: bool = True,
+                mod_filters: tuple = (),
+                score_filters: tuple = (),
+                beatmap_filters: tuple = None,
+                beatmapset_filters: tuple = None,
+                load_beatmap: bool = False,
+                columns: tuple = None,
+                cursor: str = None) -> Select:
     """
-    For a user, get their top n plays by some metric and filters. Also has the option to return one score per beatmap
+    The statement get_top_n runs for one mode
     """
-
     score_type_table = get_mode_table(mode)
 
     sort_order = getattr(score_type_table, metric)
+    id_order = score_type_table.score_id
     if desc:
         sort_order = sort_order.desc()
+        id_order = id_order.desc()
     user_filter = parse_user_filters(mode, user_id)
 
     if not unique:
-        return await get_scores(session, mode, metric, desc, limit, mod_filters, user_filter + score_filters, beatmap_filters, beatmapset_filters)
-    else:
-        # Select the highest pp play for each beatmap
-        subq = select(score_type_table.beatmap_id, func.max(getattr(score_type_table, metric)).label('max_metric')).filter(*user_filter).filter(*mod_filters).filter(*score_filters).group_by(score_type_table.beatmap_id).subquery()
-        stmt = select(score_type_table).join(subq, (score_type_table.beatmap_id == subq.c.beatmap_id) & (getattr(score_type_table, metric) == subq.c.max_metric) ).filter(*user_filter).order_by(sort_order).limit(limit)
+        return score_page_query(mode, metric, desc, limit, mod_filters, user_filter + tuple(score_filters), beatmap_filters, beatmapset_filters, load_beatmap, columns=columns, cursor=cursor)
+
+    # Select the highest pp play for each beatmap
+    subq = plan_score_query(mode, mod_filters, user_filter + tuple(score_filters), beatmap_filters, beatmapset_filters,
+                            columns=(score_type_table.beatmap_id, func.max(getattr(score_type_table, metric)).label('max_metric')))
+    subq = subq.group_by(score_type_table.beatmap_id).subquery()
+    stmt = plan_score_query(mode, score_filters=user_filter, columns=columns, load_beatmap=load_beatmap)
+    stmt = stmt.join(subq, (score_type_table.beatmap_id == subq.c.beatmap_id) & (getattr(score_type_table, metric) == subq.c.max_metric))
+    if cursor:
+        stmt = stmt.filter(keyset_filter(getattr(score_type_table, metric), score_type_table.score_id, cursor, metric, desc))
+    return stmt.order_by(sort_order, id_order).limit(limit)
+
+def get_top_n(session: Session, user_id: int, mode: str or int, metric: str = 'pp', desc = True, limit: int = 100, unique: bool = True,
+              mod_filters: tuple = (),
+              score_filters: tuple = (),
+              beatmap_filters: tuple = None,
+              beatmapset_filters: tuple = None,
+              load_beatmap: bool = False,
+              columns: tuple = None,
+              cursor: str = None) -> Sequence[Score] | Sequence[Row]:
+    """
+    For a user, get their top n plays by some metric and filters. Also has the option to return one score per beatmap
+    If columns are given, returns rows of those columns instead of Score objects
+    Paginated the same way as get_scores. mode can be 'all', see merge_modes
+    """
+    if mode == 'all':
+        return merge_modes(session, lambda m: top_n_query(
+            user_id, m, metric, desc, limit, unique, for_mode(mod_filters, m), for_mode(score_filters, m), beatmap_filters,
+            beatmapset_filters, load_beatmap, for_mode(columns, m), cursor), metric, desc, limit, columns)
+
+    stmt = top_n_query(user_id, mode, metric, desc, limit, unique, mod_filters, score_filters, beatmap_filters, beatmapset_filters,
+                       load_beatmap, columns, cursor)
+    if columns:
+        return session.execute(stmt).all()
+    return session.scalars(stmt).all()
+
+def stream_scores(session: Session, mode: str or int, columns: tuple,
+                  mod_filters: tuple = (),
+                  score_filters: tuple = (),
+                  beatmap_filters: tuple = None,
+                  beatmapset_filters: tuple = None,
+                  chunk_size: int = 5000) -> Iterator[Sequence[Row]]:
+    """
+    Yields every matching score as partitions of chunk_size rows, ordered by score_id.
+    Uses a server-side cursor, so memory use does not depend on how many scores match.
+    """
+    stmt = plan_score_query(mode, mod_filters, score_filters, beatmap_filters, beatmapset_filters, columns)
+    stmt = stmt.order_by(get_mode_table(mode).score_id).execution_options(stream_results=True, yield_per=chunk_size)
+    yield from session.execute(stmt).partitions()
+
+def get_recent_scores(session: Session, mode: str or int, n: int = 15, columns: tuple = None,
+                      after: int = None, score_ids: Sequence[int] = None) -> Sequence[Score] | Sequence[Row]:
+    """
+    Returns the n most recently fetched scores in a mode, with their beatmap, beatmapset and user loaded
+    If columns are given, returns rows of those columns instead
+    - after:     only scores with a higher score_id
+    - score_ids: only these scores
+    """
+    table = get_mode_table(mode)
+    filters = ()
+    if after is not None:
+        filters += (table.score_id > after,)
+    if score_ids is not None:
+        filters += (table.score_id.in_(score_ids),)
+    stmt = plan_score_query(mode, score_filters=filters, columns=columns, load_beatmap=True, load_user=True)
+    stmt = stmt.order_by(table.score_id.desc()).limit(n)
+    if columns:
+        return session.execute(stmt).all()
+    return session.scalars(stmt).all()
+
+def latest_score_ids(session: Session, modes: Sequence[str] = ('osu', 'taiko', 'fruits', 'mania')) -> Tuple[int, ...]:
+    """
+    The highest score_id of each mode, read from the primary keys in one statement. Changes whenever a score is fetched.
+    """
+    stmt = select(*(select(func.max(get_mode_table(mode).score_id)).scalar_subquery() for mode in modes))
+    return tuple(session.execute(stmt).one())
+
+def latest_user_score_id(session: Session, user_id: int, mode: str or int) -> int or Tuple[int, ...] or None:
+    """
+    The highest score_id of a user in a mode (of each mode for 'all'), one lookup on the user_id index per table
+    """
+    if mode == 'all':
+        return tuple(session.execute(select(*(select(func.max(get_mode_table(m).score_id)).filter(get_mode_table(m).user_id == user_id)
+                                              .scalar_subquery() for m in modes))).one())
+    table = get_mode_table(mode)
+    return session.scalar(select(func.max(table.score_id)).filter(table.user_id == user_id))
 
-        if beatmap_filters:
-            stmt = stmt.join(Beatmap, score_type_table.beatmap_id == Beatmap.beatmap_id).filter(*beatmap_filters)
-        if beatmapset_filters:
-            if not beatmap_filters:
-                stmt = stmt.join(Beatmap, score_type_table.beatmap_id == Beatmap.beatmap_id)
-            stmt = stmt.join(BeatmapSet, Beatmap.beatmapset_id == BeatmapSet.beatmapset_id).filter(*beatmapset_filters)
+# Per-beatmap leaderboards, tagged with (mode, beatmap_id). insert_scores drops a beatmap's entries when it gets a new
+# score; the ttl covers scores written by other processes.
+beatmap_leaderboard_cache = LRUCache(maxsize=4096, ttl=60)
 
-        return session.scalars(stmt).all()
+def get_beatmap_leaderboard(session: Session, beatmap_id: int, mode: str or int, metric: str = 'lazer_score', limit: int = 50,
+                            mod_filters: tuple = (), score_filters: tuple = (), columns: tuple = None) -> Sequence[Row]:
+    """
+    Every registered user's best score on a beatmap, best first, as rows of columns (all score columns by default).
+    With window functions the best score per user is picked by ROW_NUMBER over the (beatmap_id, metric) index.
+    Otherwise the beatmap's scores are read in metric order and the first score of each user is kept.
+    """
+    table = get_mode_table(mode)
+    sort_column = getattr(table, metric)
+    columns = columns or tuple(getattr(table, column.key) for column in table.__table__.c)
+    filters = (table.beatmap_id == beatmap_id, sort_column.is_not(None), *mod_filters, *score_filters)
+    order = (sort_column.desc(), table.score_id)
+
+    if not supports_window_functions(session):
+        stmt = plan_score_query(mode, columns=(table.user_id,) + tuple(columns)).filter(*filters).order_by(*order)
+        rows, seen = [], set()
+        for row in session.execute(stmt):
+            if row[0] not in seen:
+                seen.add(row[0])
+                rows.append(row[1:])
+                if len(rows) == limit:
+                    break
+        return rows
+
+    best = (select(table.score_id, func.row_number().over(partition_by=table.user_id, order_by=order).label('position'))
+            .filter(*filters).subquery())
+    stmt = (plan_score_query(mode, columns=columns)
+            .join(best, best.c.score_id == table.score_id)
+            .filter(best.c.position == 1)
+            .order_by(*order)
+            .limit(limit))
+    return session.execute(stmt).all()
 
 def compact_scores_list(scores: List[Score] or Score, metric: str = 'lazer_score'):
     scores = [{"user id": x.user_id,
@@ -174,16 +582,68 @@ def format_scores_list(scores: List[Score] or Score, metric: str = 'lazer_score'
         print(score.to_dict())
     return scores
 
-def weighted_pp_sum(scores: List[Score]) -> int:
+def weighted_pp_sum(scores: List[Score]) -> float:
     """
     Returns profile pp for the top 100 scores.
     """
-    n = 100
-    total = 416.666666
-    scores = scores if n > len(scores) else scores[:n]
-    for i, score in enumerate(scores):
-        total += score.pp * 0.95**(i-1)
-    return total
+    pps = [score.pp for score in scores[:100]]
+    return BONUS_PP + float(numpy.dot(pps, pp_weights(len(pps))))
+
+def weighted_pp_sums(pp_matrix: numpy.ndarray, bonus: bool = True) -> numpy.ndarray:
+    """
+    Profile pp for many users at once.
+    pp_matrix has one row per user, holding their pp values sorted descending and padded with zeros.
+    """
+    totals = pp_matrix @ pp_weights(pp_matrix.shape[1])
+    return totals + BONUS_PP if bonus else totals
+
+def get_top_pp_matrix(session: Session, user_ids: List[int], mode: str or int, n: int = 100,
+                      mod_filters: tuple = (),
+                      score_filters: tuple = (),
+                      beatmap_filters: tuple = None,
+                      beatmapset_filters: tuple = None) -> numpy.ndarray:
+    """
+    Each user's best pp on each of their top n beatmaps, as a (len(user_ids), n) matrix in user_ids order.
+    One query for all users: best pp per (user, beatmap), ranked per user with ROW_NUMBER.
+    """
+    if not user_ids:
+        # No user filter would rank every user in the table
+        return numpy.zeros((0, n))
+    table = get_mode_table(mode)
+    best = plan_score_query(mode, mod_filters, parse_user_filters(mode, user_ids) + tuple(score_filters) + (table.pp.is_not(None),),
+                            beatmap_filters, beatmapset_filters,
+                            columns=(table.user_id, func.max(table.pp).label('best')))
+    best = best.group_by(table.user_id, table.beatmap_id).subquery()
+
+    if supports_window_functions(session):
+        ranked = select(best.c.user_id, best.c.best,
+                        func.row_number().over(partition_by=best.c.user_id, order_by=best.c.best.desc()).label('position')).subquery()
+        rows = session.execute(select(ranked.c.user_id, ranked.c.best, ranked.c.position).filter(ranked.c.position <= n)).all()
+    else:
+        rows, position, previous = [], 0, None
+        for user_id, pp in session.execute(select(best.c.user_id, best.c.best).order_by(best.c.user_id, best.c.best.desc())):
+            position = position + 1 if user_id == previous else 1
+            previous = user_id
+            if position <= n:
+                rows.append((user_id, pp, position))
+
+    pp_matrix = numpy.zeros((len(user_ids), n))
+    if rows:
+        index = {user_id: i for i, user_id in enumerate(user_ids)}
+        user_index, pps, positions = zip(*rows)
+        pp_matrix[numpy.fromiter((index[x] for x in user_index), int, len(rows)), numpy.array(positions) - 1] = pps
+    return pp_matrix
+
+def get_profile_pp_batch(session: Session, user_ids: List[int], mode: str or int, n: int = 100, bonus: bool = True,
+                         mod_filters: tuple = (),
+                         score_filters: tuple = (),
+                         beatmap_filters: tuple = None,
+                         beatmapset_filters: tuple = None) -> dict[int, float]:
+    """
+    Profile pp (one score per beatmap) for many users with one query
+    """
+    pp_matrix = get_top_pp_matrix(session, user_ids, mode, n, mod_filters, score_filters, beatmap_filters, beatmapset_filters)
+    return dict(zip(user_ids, weighted_pp_sums(pp_matrix, bonus).tolist()))
 
 if __name__ == '__main__':
 
@@ -0,0 +1,103 @@
+"""
+Builds response dicts straight from Core rows.
+Routes select only the columns they return, and the keys for those columns are computed once per (mode, format),
+so no ORM objects are hydrated and Base.to_dict is never called per row.
+
+Keys containing a '.' are nested, so 'beatmap.version' ends up as row['beatmap']['version'].
+"""
+from functools import lru_cache
+from typing import Sequence, List, Tuple
+from sqlalchemy import literal
+from database.models import Beatmap, BeatmapSet, RegisteredUser
+from database.util import get_mode_table, modes
+
+Projection = Tuple[Tuple[str, ...], tuple]
+
+def table_projection(model, prefix: str = '') -> Projection:
+    """
+    All columns of a mapped class, keyed by column name
+    """
+    columns = tuple(getattr(model, column.key) for column in model.__table__.c)
+    return tuple(prefix + column.key for column in model.__table__.c), columns
+
+def join_projections(*projections: Projection) -> Projection:
+    header, columns = (), ()
+    for h, c in projections:
+        header += h
+        columns += c
+    return header, columns
+
+@lru_cache
+def score_projection(mode: str or int, return_format: str, metric: str = 'lazer_score') -> Projection:
+    """
+    The columns needed to build each ScoreReturnFormat
+    - readable: beatmapset title and difficulty name, then every score column
+    - verbose:  every score column, with the beatmap nested under 'beatmap'
+    - minimal:  the same keys as scoreService.compact_scores_list
+    - compact:  every score column, sent as a header and a list of rows
+    """
+    table = get_mode_table(mode)
+    match return_format:
+        case 'minimal':
+            return (("user id", "score id", "beatmap id", "beatmap_title", "difficulty name", "date", "mods", "mods settings", metric),
+                    (table.user_id, table.score_id, table.beatmap_id, BeatmapSet.title, Beatmap.version, table.date,
+                     table.enabled_mods, table.enabled_mods_settings, getattr(table, metric)))
+        case 'verbose':
+            return join_projections(table_projection(table), table_projection(Beatmap, 'beatmap.'))
+        case 'compact':
+            return table_projection(table)
+        case _:
+            return join_projections((("title", "difficulty name"), (BeatmapSet.title, Beatmap.version)), table_projection(table))
+
+@lru_cache
+def recent_score_projection(mode: str) -> Projection:
+    """
+    The columns returned by /recent_scores. Later keys win, same as beatmapset | beatmap | score | user
+    """
+    return join_projections(table_projection(BeatmapSet), table_projection(Beatmap), table_projection(get_mode_table(mode)),
+                            (("mode", "username", "avatar_url"), (literal(mode), RegisteredUser.username, RegisteredUser.avatar_url)))
+
+def mode_score_projection(mode: str or int, return_format: str, metric: str = 'lazer_score') -> Projection:
+    """
+    score_projection, or for mode 'all' the columns of each mode and a trailing 'mode' key (see scoreService.merge_modes)
+    """
+    if mode != 'all':
+        return score_projection(mode, return_format, metric)
+    projections = {m: score_projection(m, return_format, metric) for m in modes}
+    return projections['osu'][0] + ('mode',), {m: columns for m, (_, columns) in projections.items()}
+
+@lru_cache
+def beatmap_leaderboard_projection(mode: str or int) -> Projection:
+    """
+    The columns returned by /stats/beatmap_leaderboard: every score column and who set it
+    """
+    return join_projections(table_projection(get_mode_table(mode)),
+                            (("username", "avatar_url"), (RegisteredUser.username, RegisteredUser.avatar_url)))
+
+@lru_cache
+def _nesting(header: Tuple[str, ...]):
+    nested = {}
+    flat = []
+    for i, key in enumerate(header):
+        if '.' in key:
+            group, field = key.split('.', 1)
+            nested.setdefault(group, []).append((i, field))
+        else:
+            flat.append((i, key))
+    return tuple(flat), tuple((group, tuple(fields)) for group, fields in nested.items())
+
+def rows_to_dicts(header: Tuple[str, ...], rows: Sequence[tuple]) -> List[dict]:
+    """
+    Turns rows into dicts keyed by header
+    """
+    flat, nested = _nesting(header)
+    if not nested:
+        return [dict(zip(header, row)) for row in rows]
+    return [{key: row[i] for i, key in flat} | {group: {key: row[i] for i, key in fields} for group, fields in nested}
+            for row in rows]
+
+def rows_to_compact(header: Tuple[str, ...], rows: Sequence[tuple]) -> dict:
+    """
+    A header and a list of rows, for clients that don't want keys repeated per score
+    """
+    return {"columns": list(header), "rows": [tuple(row) for row in rows]}
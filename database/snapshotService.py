@@ -0,0 +1,150 @@
+"""
+Takes, prunes and reads leaderboard snapshots (leaderboard_snapshots).
+A snapshot stores every spot of a leaderboard with its rank at the time it was taken, so rank history and past
+standings are read back from the snapshot rows instead of being recomputed from scores.
+"""
+import datetime
+import zlib
+import numpy
+from typing import List, Sequence, Tuple
+from sqlalchemy import select, delete, insert, tuple_
+from sqlalchemy.orm import Session
+from database.models import Leaderboard, LeaderboardSpot, LeaderboardSnapshot, RegisteredUser
+
+# Snapshots younger than the age are all kept, older ones are thinned to one per interval
+RETENTION: Tuple[Tuple[datetime.timedelta or None, datetime.timedelta or None], ...] = (
+    (datetime.timedelta(days=7), None),
+    (datetime.timedelta(days=90), datetime.timedelta(days=1)),
+    (None, datetime.timedelta(weeks=1)),
+)
+
+def _pack(array: numpy.ndarray) -> bytes:
+    return zlib.compress(array.tobytes())
+
+def _unpack(data: bytes, dtype) -> numpy.ndarray:
+    return numpy.frombuffer(zlib.decompress(data), dtype=dtype)
+
+def encode_spots(spots: Sequence[Tuple[int, float]]) -> dict:
+    """
+    Given (user_id, value) pairs ordered by rank, returns the snapshot columns
+    """
+    user_ids = numpy.array([user_id for user_id, _ in spots], dtype=numpy.int64)
+    values = numpy.array([value if value is not None else numpy.nan for _, value in spots], dtype=numpy.float64)
+    # The i-th spot is rank i + 1
+    order = numpy.argsort(user_ids, kind='stable')
+    return {
+        'num_spots': len(spots),
+        'user_ids': _pack(numpy.diff(user_ids[order], prepend=0).astype(numpy.uint32)),
+        'ranks': _pack((order + 1).astype(numpy.uint32)),
+        'spot_values': _pack(values[order]),
+    }
+
+def decode_snapshot(snapshot: LeaderboardSnapshot) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    Returns (user_ids, ranks, values), sorted by user id
+    """
+    user_ids = numpy.cumsum(_unpack(snapshot.user_ids, numpy.uint32), dtype=numpy.int64)
+    return user_ids, _unpack(snapshot.ranks, numpy.uint32), _unpack(snapshot.spot_values, numpy.float64)
+
+def take_snapshot(session: Session, leaderboard_id: int, taken_at: datetime.datetime = None) -> bool:
+    """
+    Snapshots one leaderboard. Nothing is written if the standings are the same as in the latest snapshot.
+    Returns True if a snapshot was written.
+    """
+    taken_at = taken_at or datetime.datetime.now()
+    stmt = (select(LeaderboardSpot.user_id, LeaderboardSpot.value)
+            .filter(LeaderboardSpot.leaderboard_id == leaderboard_id)
+            .order_by(LeaderboardSpot.value.desc(), LeaderboardSpot.user_id))
+    columns = encode_spots(session.execute(stmt).all())
+
+    latest = session.scalars(select(LeaderboardSnapshot)
+                             .filter(LeaderboardSnapshot.leaderboard_id == leaderboard_id)
+                             .order_by(LeaderboardSnapshot.taken_at.desc()).limit(1)).first()
+    if latest is not None and all(getattr(latest, key) == value for key, value in columns.items()):
+        return False
+    session.execute(insert(LeaderboardSnapshot).values(leaderboard_id=leaderboard_id, taken_at=taken_at, **columns))
+    session.commit()
+    return True
+
+def take_snapshots(session: Session, taken_at: datetime.datetime = None) -> int:
+    """
+    Snapshots every leaderboard at the same timestamp. Returns the number of snapshots written.
+    """
+    taken_at = taken_at or datetime.datetime.now()
+    leaderboard_ids = session.scalars(select(Leaderboard.leaderboard_id)).all()
+    return sum(take_snapshot(session, leaderboard_id, taken_at) for leaderboard_id in leaderboard_ids)
+
+def snapshots_to_prune(taken_at: Sequence[datetime.datetime], now: datetime.datetime) -> List[datetime.datetime]:
+    """
+    Applies RETENTION to the timestamps of one leaderboard's snapshots. The latest snapshot of each interval is kept.
+    """
+    prune = []
+    kept_buckets = set()
+    for timestamp in sorted(taken_at, reverse=True):
+        age = now - timestamp
+        for tier, (max_age, interval) in enumerate(RETENTION):
+            if max_age is None or age < max_age:
+                break
+        if interval is None:
+            continue
+        bucket = (tier, (timestamp - datetime.datetime.min) // interval)
+        if bucket in kept_buckets:
+            prune.append(timestamp)
+        else:
+            kept_buckets.add(bucket)
+    return prune
+
+def prune_snapshots(session: Session, now: datetime.datetime = None) -> int:
+    """
+    Deletes the snapshots RETENTION no longer keeps. Only timestamps are read. Returns the number deleted.
+    """
+    now = now or datetime.datetime.now()
+    by_leaderboard = {}
+    for leaderboard_id, taken_at in session.execute(select(LeaderboardSnapshot.leaderboard_id, LeaderboardSnapshot.taken_at)):
+        by_leaderboard.setdefault(leaderboard_id, []).append(taken_at)
+
+    keys = [(leaderboard_id, taken_at) for leaderboard_id, timestamps in by_leaderboard.items()
+            for taken_at in snapshots_to_prune(timestamps, now)]
+    for i in range(0, len(keys), 1000):
+        session.execute(delete(LeaderboardSnapshot).filter(
+            tuple_(LeaderboardSnapshot.leaderboard_id, LeaderboardSnapshot.taken_at).in_(keys[i:i + 1000])))
+    session.commit()
+    return len(keys)
+
+def get_rank_history(session: Session, leaderboard_id: int, user_id: int, start: datetime.datetime = None, end: datetime.datetime = None) -> List[dict]:
+    """
+    Returns the user's rank and value in each snapshot they appear in, oldest first
+    """
+    stmt = (select(LeaderboardSnapshot)
+            .filter(LeaderboardSnapshot.leaderboard_id == leaderboard_id)
+            .order_by(LeaderboardSnapshot.taken_at))
+    if start is not None:
+        stmt = stmt.filter(LeaderboardSnapshot.taken_at >= start)
+    if end is not None:
+        stmt = stmt.filter(LeaderboardSnapshot.taken_at <= end)
+
+    history = []
+    for snapshot in session.scalars(stmt):
+        user_ids, ranks, values = decode_snapshot(snapshot)
+        i = numpy.searchsorted(user_ids, user_id)
+        if i < len(user_ids) and user_ids[i] == user_id:
+            history.append({'date': snapshot.taken_at, 'rank': int(ranks[i]), 'value': float(values[i]), 'num_spots': snapshot.num_spots})
+    return history
+
+def get_leaderboard_at(session: Session, leaderboard_id: int, timestamp: datetime.datetime, limit: int = None) -> dict or None:
+    """
+    Returns the standings of the latest snapshot taken at or before a timestamp, best first, or None if there is none
+    """
+    snapshot = session.scalars(select(LeaderboardSnapshot)
+                               .filter(LeaderboardSnapshot.leaderboard_id == leaderboard_id, LeaderboardSnapshot.taken_at <= timestamp)
+                               .order_by(LeaderboardSnapshot.taken_at.desc()).limit(1)).first()
+    if snapshot is None:
+        return None
+
+    user_ids, ranks, values = decode_snapshot(snapshot)
+    order = numpy.argsort(ranks)[:limit]
+    users = dict(session.execute(select(RegisteredUser.user_id, RegisteredUser.username)
+                                 .filter(RegisteredUser.user_id.in_(user_ids[order].tolist()))).all())
+    spots = [{'rank': int(ranks[i]), 'user_id': int(user_ids[i]), 'username': users.get(int(user_ids[i])), 'value': float(values[i])}
+             for i in order]
+    return {'taken_at': snapshot.taken_at, 'num_spots': snapshot.num_spots, 'users': spots}
@@ -0,0 +1,180 @@
+"""
+Maintains the profile pp timeline (profile_pp_timeline) for each (user, mode).
+The weighted total only depends on the user's best pp on each of their top 100 beatmaps, so the timeline can be
+built by replaying scores in date order through a ProfilePpTracker and writing a point whenever the total changes.
+"""
+import datetime
+import heapq
+import numpy
+from typing import List, Sequence, Dict, Tuple
+from sqlalchemy import select, func, delete, insert
+from sqlalchemy.orm import Session
+from database.models import ProfilePpPoint, Score
+from database.util import get_mode_table, get_mode_name, naive_utc, BONUS_PP, pp_weights
+from database.cache import LRUCache
+
+class ProfilePpTracker:
+    """
+    Keeps the top n unique-beatmap pp values of one user.
+    Per-beatmap bests only ever go up, so a beatmap that falls out of the top n can only come back with a new best.
+    That means only the top n beatmaps need to be remembered: a dict of their bests and a min-heap with lazy deletion.
+    """
+
+    def __init__(self, n: int = 100, bonus: bool = True):
+        self.n = n
+        self.bonus = bonus
+        self.top: Dict[int, float] = {}
+        self.heap: List[Tuple[float, int]] = []
+
+    def _threshold(self) -> Tuple[float, int]:
+        # Drop heap entries for beatmaps whose best has since gone up
+        while self.heap[0][0] != self.top.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+        return self.heap[0]
+
+    def add(self, beatmap_id: int, pp: float) -> bool:
+        """
+        Adds a score. Returns True if the top n changed.
+        """
+        if pp is None:
+            return False
+        if beatmap_id in self.top:
+            if pp <= self.top[beatmap_id]:
+                return False
+        elif len(self.top) >= self.n:
+            lowest_pp, lowest_beatmap_id = self._threshold()
+            if pp <= lowest_pp:
+                return False
+            heapq.heappop(self.heap)
+            del self.top[lowest_beatmap_id]
+        self.top[beatmap_id] = pp
+        heapq.heappush(self.heap, (pp, beatmap_id))
+        return True
+
+    def total(self) -> float:
+        top = sorted(self.top.values(), reverse=True)
+        return (BONUS_PP if self.bonus else 0) + float(numpy.dot(top, pp_weights(len(top))))
+
+# (user_id, mode) -> (tracker, (date, score_id) of the last score applied, score_id of the user's last point).
+# Other processes (a fetch backfill, another listener) also write timelines. Any change to the top 100 writes a point,
+# so a tracker whose last point is no longer the stored last point is stale and is rebuilt.
+_trackers = LRUCache(maxsize=10000, ttl=3600)
+
+def last_point(session: Session, user_id: int, mode_name: str) -> int or None:
+    """
+    The score_id of the user's latest timeline point. One indexed read.
+    """
+    stmt = (select(ProfilePpPoint.score_id)
+            .filter(ProfilePpPoint.user_id == user_id, ProfilePpPoint.mode == mode_name)
+            .order_by(ProfilePpPoint.date.desc(), ProfilePpPoint.score_id.desc()).limit(1))
+    return session.scalar(stmt)
+
+def load_tracker(session: Session, user_id: int, mode: str or int, before: datetime.datetime = None) -> ProfilePpTracker:
+    """
+    Builds a tracker from the user's best pp per beatmap, optionally only counting scores set before a date.
+    Reads at most 100 rows.
+    """
+    table = get_mode_table(mode)
+    tracker = ProfilePpTracker()
+    stmt = select(table.beatmap_id, func.max(table.pp).label('best')).filter(table.user_id == user_id, table.pp.is_not(None))
+    if before is not None:
+        stmt = stmt.filter(table.date < before)
+    stmt = stmt.group_by(table.beatmap_id).order_by(func.max(table.pp).desc()).limit(tracker.n)
+    for beatmap_id, best in session.execute(stmt):
+        tracker.add(beatmap_id, best)
+    return tracker
+
+def backfill_timeline(session: Session, user_id: int, mode: str or int, since: datetime.datetime = None, chunk_size: int = 5000) -> int:
+    """
+    Rebuilds a user's timeline from a date onwards (or entirely), replaying their scores in date order.
+    Returns the number of points written.
+    """
+    table = get_mode_table(mode)
+    mode_name = get_mode_name(mode)
+    since = naive_utc(since)
+
+    clear = delete(ProfilePpPoint).filter(ProfilePpPoint.user_id == user_id, ProfilePpPoint.mode == mode_name)
+    if since is not None:
+        clear = clear.filter(ProfilePpPoint.date >= since)
+    session.execute(clear)
+
+    tracker = load_tracker(session, user_id, mode, since) if since is not None else ProfilePpTracker()
+    previous_total = tracker.total()
+    last = None
+
+    stmt = (select(table.score_id, table.beatmap_id, table.pp, table.date)
+            .filter(table.user_id == user_id, table.pp.is_not(None))
+            .order_by(table.date, table.score_id)
+            .execution_options(stream_results=True, yield_per=chunk_size))
+    if since is not None:
+        stmt = stmt.filter(table.date >= since)
+
+    points = []
+    written = 0
+    for score_id, beatmap_id, pp, date in session.execute(stmt):
+        last = (date, score_id)
+        if tracker.add(beatmap_id, pp):
+            total = tracker.total()
+            if total != previous_total:
+                points.append({'user_id': user_id, 'mode': mode_name, 'score_id': score_id, 'date': date, 'pp': total})
+                previous_total = total
+        if len(points) >= chunk_size:
+            session.execute(insert(ProfilePpPoint), points)
+            written += len(points)
+            points = []
+    if points:
+        session.execute(insert(ProfilePpPoint), points)
+        written += len(points)
+    session.commit()
+
+    if last is not None or since is None:
+        _trackers.set((user_id, mode_name), (tracker, last or (datetime.datetime.min, 0), last_point(session, user_id, mode_name)))
+    return written
+
+def record_scores(session: Session, scores: Sequence[Score]) -> None:
+    """
+    Updates timelines after scores were written.
+    Scores newer than everything the cached tracker has seen are applied in memory. Anything else
+    (a cold cache, a timeline another process has written to since, or an older score arriving late) replays the
+    timeline from the earliest new score.
+    """
+    by_user = {}
+    for score in scores:
+        by_user.setdefault((score.user_id, score.get_mode()), []).append(score)
+
+    for (user_id, mode_name), new_scores in by_user.items():
+        new_scores.sort(key=lambda x: (naive_utc(x.date), x.score_id))
+        first = (naive_utc(new_scores[0].date), new_scores[0].score_id)
+        cached = _trackers.get((user_id, mode_name))
+
+        if cached is None or first <= cached[1] or cached[2] != last_point(session, user_id, mode_name):
+            backfill_timeline(session, user_id, mode_name, since=first[0])
+            continue
+
+        tracker, _, point = cached
+        previous_total = tracker.total()
+        points = []
+        for score in new_scores:
+            if tracker.add(score.beatmap_id, score.pp):
+                total = tracker.total()
+                if total != previous_total:
+                    points.append({'user_id': user_id, 'mode': mode_name, 'score_id': score.score_id, 'date': naive_utc(score.date), 'pp': total})
+                    previous_total = total
+        if points:
+            session.execute(insert(ProfilePpPoint), points)
+            session.commit()
+            point = points[-1]['score_id']
+        _trackers.set((user_id, mode_name), (tracker, (naive_utc(new_scores[-1].date), new_scores[-1].score_id), point))
+
+def get_timeline(session: Session, user_id: int, mode: str or int, start: datetime.datetime = None, end: datetime.datetime = None) -> List[dict]:
+    """
+    A user's profile pp timeline between two dates. One indexed range read.
+    """
+    stmt = (select(ProfilePpPoint.date, ProfilePpPoint.pp, ProfilePpPoint.score_id)
+            .filter(ProfilePpPoint.user_id == user_id, ProfilePpPoint.mode == get_mode_name(mode)))
+    if start is not None:
+        stmt = stmt.filter(ProfilePpPoint.date >= start)
+    if end is not None:
+        stmt = stmt.filter(ProfilePpPoint.date <= end)
+    stmt = stmt.order_by(ProfilePpPoint.date, ProfilePpPoint.score_id)
+    return [{'date': date, 'pp': pp, 'score_id': score_id} for date, pp, score_id in session.execute(stmt)]
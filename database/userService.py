@@ -5,8 +5,9 @@ Post and registration methods return True or False depending on if the operation
 """
 import datetime
 import os
+import numpy
 from typing import Sequence, List
-from database.util import get_mode_table
+from database.util import get_mode_table, BONUS_PP, pp_weights
 from osuApi import get_user_info
 from sqlalchemy import select, func, Date
 from sqlalchemy.orm import Session
@@ -94,11 +95,8 @@ def get_profile_pp(scores: Sequence[Score], bonus = True, n = 100) -> int:
     """
     Returns profile pp with only that list of scores considered
     """
-    total = 416.666666 if bonus else 0
-    scores = scores if n > len(scores) else scores[:n]
-    for i, score in enumerate(scores):
-        total += score.pp * 0.95**(i-1)
-    return total
+    pps = [score.pp for score in scores[:n]]
+    return (BONUS_PP if bonus else 0) + float(numpy.dot(pps, pp_weights(len(pps))))
 
 def top_play_per_day(session: Session, user_id: int, mode: str or int, filters: tuple = (), mods: tuple = (), minimal: bool = True):
     """
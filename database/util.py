@@ -1,17 +1,59 @@
 """
 Contains helper functions which will be used in more than one service
 """
+import datetime
 import operator as op
 import re
+from contextlib import contextmanager
 from typing import List
+import numpy
 import ossapi
 import sqlalchemy.sql.operators
+from sqlalchemy import event
 
 modes = ['osu', 'taiko', 'fruits', 'mania']
 
+# Profile pp: the i-th best score (0-indexed) is weighted by 0.95^i, plus the maximum bonus pp
+# https://osu.ppy.sh/wiki/en/Performance_points/Weighting_system
+BONUS_PP = 416.666666
+PP_WEIGHTS = 0.95 ** numpy.arange(100)
+
+def pp_weights(n: int) -> numpy.ndarray:
+    """
+    The weights of the first n positions
+    """
+    return PP_WEIGHTS[:n] if n <= len(PP_WEIGHTS) else 0.95 ** numpy.arange(n)
+
+def supports_window_functions(session) -> bool:
+    """
+    MySQL got window functions in 8.0 and MariaDB in 10.2
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name not in ('mysql', 'mariadb'):
+        return True
+    version = dialect.server_version_info or ()
+    if getattr(dialect, 'is_mariadb', False):
+        return version >= (10, 2)
+    return version >= (8, 0)
+
+def parse_per_mode(parser, mode: str or int, *args):
+    """
+    parser(mode, *args), or for mode 'all' a dict of its result for every mode.
+    Parsed filters are bound to one mode's table, so the scoreService functions take such dicts for mode 'all'.
+    """
+    if mode == 'all':
+        return {m: parser(m, *args) for m in modes}
+    return parser(mode, *args)
+
+def for_mode(value, mode: str):
+    """
+    The value of an argument for one mode, if it was given per mode (see parse_per_mode)
+    """
+    return value[mode] if isinstance(value, dict) else value
+
 # Given a mode, return the corresponding table
 def get_mode_table(mode: str or int):
-    from models import OsuScore, TaikoScore, CatchScore, ManiaScore
+    from database.models import OsuScore, TaikoScore, CatchScore, ManiaScore
     match mode:
         case 'osu' | 0:
             return OsuScore
@@ -22,6 +64,63 @@ def get_mode_table(mode: str or int):
         case 'mania' | 3:
             return ManiaScore
 
+@contextmanager
+def count_statements(engine):
+    """
+    Counts the SQL statements sent through an engine while the block runs.
+    Use it to check that an endpoint does not lazy load per row.
+
+    with count_statements(orm.engine) as statements:
+        ...
+    assert len(statements) == 1
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def with_timeout(stmt, timeout: float = None):
+    """
+    Makes MySQL stop a SELECT after timeout seconds with a MAX_EXECUTION_TIME optimizer hint.
+    Other databases ignore it: MariaDB reads the hint as a comment and other dialects don't render it.
+    """
+    if not timeout:
+        return stmt
+    return stmt.prefix_with('/*+ MAX_EXECUTION_TIME(%d) */' % int(timeout * 1000), dialect='mysql')
+
+def connection_id(session) -> int or None:
+    """
+    The server's id for the connection a session is using, which kill_query takes. None if the database has none.
+    """
+    if session.get_bind().dialect.name not in ('mysql', 'mariadb'):
+        return None
+    return session.execute(sqlalchemy.text('SELECT CONNECTION_ID()')).scalar()
+
+def kill_query(engine, connection_id: int) -> None:
+    """
+    Stops the statement running on another connection, which then fails with 'Query execution was interrupted'
+    """
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text('KILL QUERY %d' % int(connection_id)))
+
+# Given a mode, return its name as used in PlaymodeEnum
+def get_mode_name(mode: str or int) -> str:
+    if isinstance(mode, int):
+        return modes[mode]
+    return getattr(mode, 'value', mode)
+
+# Scores from the api have timezone-aware UTC dates, the database stores naive ones
+def naive_utc(date: datetime.datetime) -> datetime.datetime:
+    if date is not None and date.tzinfo is not None:
+        return date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
 # Parses the mod list from the Ossapi score object
 def parse_modlist(modlist: List[ossapi.models.NonLegacyMod]):
     if not modlist:
@@ -277,7 +376,7 @@ def parse_beatmap_filters(filters: str):
         "mapper_id": Beatmap.mapper_id,
         "total_length": Beatmap.total_length,
         "hit_length": Beatmap.hit_length,
-        "count_total": Beatmap.count_total,
+        "count_total": Beatmap.count_normal + Beatmap.count_slider + Beatmap.count_spinner,
         "count_normal": Beatmap.count_normal,
         "count_slider": Beatmap.count_slider,
         "count_spinner": Beatmap.count_spinner,
@@ -0,0 +1,37 @@
+"""
+Exports all of a user's scores in a mode to a file. Filters use the same syntax as the api.
+
+python exportScores.py 10651409 osu scores.parquet --format parquet --score_filters "pp>100"
+"""
+import argparse
+from database.ORM import ORM
+from database.exporters import export_rows
+from database.scoreService import stream_scores
+from database.serializers import score_projection
+from database.util import parse_mod_filters, parse_score_filters, parse_beatmap_filters, parse_beatmapset_filters, parse_user_filters
+
+parser = argparse.ArgumentParser(description='Export a user\'s scores')
+parser.add_argument('user_id', type=int)
+parser.add_argument('mode', choices=['osu', 'taiko', 'fruits', 'mania'])
+parser.add_argument('output')
+parser.add_argument('--format', choices=['ndjson', 'csv', 'parquet'], default='ndjson')
+parser.add_argument('--mod_filters')
+parser.add_argument('--score_filters')
+parser.add_argument('--beatmap_filters')
+parser.add_argument('--beatmapset_filters')
+args = parser.parse_args()
+
+orm = ORM()
+session = orm.sessionmaker()
+header, columns = score_projection(args.mode, 'readable')
+partitions = stream_scores(session, args.mode, columns,
+                           parse_mod_filters(args.mode, args.mod_filters),
+                           parse_score_filters(args.mode, args.score_filters) + parse_user_filters(args.mode, args.user_id),
+                           parse_beatmap_filters(args.beatmap_filters),
+                           parse_beatmapset_filters(args.beatmapset_filters))
+
+with open(args.output, 'wb') as f:
+    for chunk in export_rows(args.format, header, columns, partitions):
+        f.write(chunk)
+session.close()
+print('Exported scores for %s to %s' % (args.user_id, args.output))
@@ -0,0 +1,26 @@
+"""
+Recounts the activity rollup (score_count_rollup) from the score tables.
+By default only the last few days are recounted, which is cheap enough to run from cron every night:
+    0 4 * * * cd /path/to/osu-Ladder && python reconcileActivity.py --days 3
+Run it with --all once after creating the table.
+"""
+import argparse
+import datetime
+import time
+from database.ORM import ORM
+from database.activityService import reconcile_rollup
+
+parser = argparse.ArgumentParser(description='Recount the activity rollup')
+parser.add_argument('--days', type=int, default=3, help='recount this many days back')
+parser.add_argument('--all', action='store_true', help='recount everything')
+args = parser.parse_args()
+
+orm = ORM()
+session = orm.sessionmaker()
+
+start = time.time()
+since = None if args.all else datetime.date.today() - datetime.timedelta(days=args.days)
+written = reconcile_rollup(session, since)
+session.close()
+print('%s rollup rows written' % written)
+print('Elapsed time: ' + str(time.time() - start))
@@ -5,6 +5,9 @@ import queue
 from database.userService import refresh_tokens
 from database.osuApiAuthService import OsuApiAuthService
 from database.scoreService import insert_scores
+from database.timelineService import backfill_timeline
+from database.leaderboardScheduler import get_scheduler
+from database.util import modes
 from database.ORM import ORM
 import os
 import dotenv
@@ -19,6 +22,7 @@ class TaskQueue:
         self.sessionmaker = sessionmaker
         self.q = queue.PriorityQueue()
         self.pool = multiprocessing.pool.ThreadPool(processes=NUM_THREADS)
+        self.leaderboard_scheduler = get_scheduler(sessionmaker)
         self.current = []
         # {'user_id': user.user_id,
         #   'username': user.username,
@@ -112,8 +116,11 @@ class TaskQueue:
                 if converts and beatmap['mode'] == 'osu':
                     new_scores += auth_osu_api.get_user_scores_on_map(beatmap['beatmap_id'], mode='fruits')
                 temp_session = self.sessionmaker()
-                insert_scores(temp_session, new_scores)
+                insert_scores(temp_session, new_scores, update_timeline=False, notify=False)
                 temp_session.close()
+                # Debounced, so the user's leaderboards are recomputed every few minutes rather than per beatmap
+                if new_scores:
+                    self.leaderboard_scheduler.mark_users([user.user_id])
 
                 # Update the task
                 for task in self.current:
@@ -123,6 +130,9 @@ class TaskQueue:
             session = self.sessionmaker()
             new_user = session.get(RegisteredUser, user.user_id)
             new_user.last_updated = datetime.datetime.now()
+            # Scores were fetched in beatmap order, so the timeline is rebuilt once at the end
+            for mode in modes:
+                backfill_timeline(session, user.user_id, mode)
             session.close()
             # Task finished
 
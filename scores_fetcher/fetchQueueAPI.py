@@ -2,19 +2,74 @@
 This is the api for the fetch queue. It does two things: add people to queue and display the queue
 This runs in its own container.
 """
-from fastapi import FastAPI, Query, status, Depends
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query, status, Depends, HTTPException
 from typing import Annotated
+from sqlalchemy import select
 from database.ORM import ORM
 from database.models import RegisteredUser
 from database.osuApiAuthService import OsuApiAuthService
 from web.dependencies import verify_token, verify_admin, RegisteredUserCompact
 from scores_fetcher.fetchQueue import TaskQueue
+from web.responses import ORJSONResponse
+
+# Seconds between attempts to reach the database at startup
+WARMUP_RETRY = 5
 
-fetchapp = FastAPI(docs_url="/docs", redoc_url=None)
 orm = ORM()
-tq = TaskQueue(orm.sessionmaker)
+# Created by the warm-up when the app starts, not when this module is imported
+tq: TaskQueue = None
+database_ready = False
+
+def warm_up():
+    global tq, database_ready
+    if tq is None:
+        tq = TaskQueue(orm.sessionmaker)
+    with orm.engine.connect() as connection:
+        connection.execute(select(1))
+    database_ready = True
+
+async def keep_warming_up():
+    while True:
+        try:
+            await asyncio.to_thread(warm_up)
+            return
+        except Exception as e:
+            print('Warm-up failed, retrying in %s seconds' % WARMUP_RETRY)
+            print(e)
+            await asyncio.sleep(WARMUP_RETRY)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup = asyncio.create_task(keep_warming_up())
+    yield
+    warmup.cancel()
+    if tq is not None:
+        tq.pool.close()
+
+fetchapp = FastAPI(docs_url="/docs", redoc_url=None, lifespan=lifespan)
+
+def get_queue() -> TaskQueue:
+    """
+    The fetch queue, or a 503 while the warm-up has not created it yet
+    """
+    if tq is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='The fetch queue is starting, try again later',
+                            headers={'Retry-After': str(WARMUP_RETRY)})
+    return tq
+
+@fetchapp.get("/ready", status_code=status.HTTP_200_OK)
+def get_readiness():
+    """
+    Returns 200 once the fetch queue is running and the database can be reached, 503 until then
+    """
+    ready = tq is not None and database_ready
+    return ORJSONResponse({'ready': ready, 'queue': tq is not None, 'database': database_ready},
+                          status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
 
 def enqueue_user(user_id: int, get_non_converts: bool, catch_converts: bool, override_api_auth: bool = False):
+    tq = get_queue()
     # Verify that the user can be fetched
     user_queue = [x[1].user_id for x in tq.q.queue]
     session = orm.sessionmaker()
@@ -42,6 +97,7 @@ def get_fetch_queue():
     Returns the fetch queue
     """
     import copy
+    tq = get_queue()
     if tq.current is None:
         return {'current': None, 'in queue': None}
     user_queue = tq.q.queue
@@ -52,6 +108,13 @@ def get_fetch_queue():
                                                                 'num_maps': 'Calculating',
                                                                 'total_map': 'Calculating'} for x in user_queue]}
 
+@fetchapp.get("/leaderboard_backlog", status_code=status.HTTP_200_OK)
+def get_leaderboard_backlog():
+    """
+    Returns how many leaderboard spots are waiting to be recomputed
+    """
+    return get_queue().leaderboard_scheduler.stats()
+
 @fetchapp.post("/enqueue_self", status_code=status.HTTP_202_ACCEPTED)
 def initial_fetch(token: Annotated[RegisteredUserCompact, Depends(verify_token)], catch_converts: Annotated[ bool , Query(description='Fetch ctb converts?')] = False):
     """
@@ -69,6 +132,7 @@ def initial_fetch_user(token: Annotated[RegisteredUserCompact, Depends(verify_ad
 
 @fetchapp.post("/remove_from_queue", status_code=status.HTTP_202_ACCEPTED)
 def remove_from_queue(token: Annotated[RegisteredUserCompact, Depends(verify_admin)], user_id: int):
+    tq = get_queue()
     try:
         print(tq.current)
         print(tq.q.queue)
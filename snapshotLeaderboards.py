@@ -0,0 +1,18 @@
+"""
+Snapshots every leaderboard, then deletes the snapshots the retention policy no longer keeps.
+Meant to run from cron, e.g. every hour:
+    0 * * * * cd /path/to/osu-Ladder && python snapshotLeaderboards.py
+"""
+import time
+from database.ORM import ORM
+from database.snapshotService import take_snapshots, prune_snapshots
+
+orm = ORM()
+session = orm.sessionmaker()
+
+start = time.time()
+written = take_snapshots(session)
+pruned = prune_snapshots(session)
+session.close()
+print('%s snapshots written, %s pruned' % (written, pruned))
+print('Elapsed time: ' + str(time.time() - start))
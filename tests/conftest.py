@@ -0,0 +1,57 @@
+"""
+Fixtures shared by the tests: an in-memory SQLite database with the real schema and a few users, beatmaps and scores.
+The apps run with the repository, web and database directories on the path, and so do the tests.
+"""
+import datetime
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'web'), os.path.join(ROOT, 'database')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from database.models import Base, BeatmapSet, Beatmap, RegisteredUser, OsuScore, Leaderboard, LeaderboardSpot, \
+    LeaderboardMetricEnum, PlaymodeEnum
+
+USERS = (1, 2, 3)
+BEATMAPS = (10, 11, 12, 13)
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def session(engine):
+    """
+    A session on a database with USERS, BEATMAPS, ten osu scores per user (pp 10, 20, ... 100 by score order) and a
+    leaderboard of every user created by user 1
+    """
+    session = sessionmaker(engine)()
+    session.add(BeatmapSet(beatmapset_id=1, title='Set', tags='tags', language_id=2))
+    for beatmap_id in BEATMAPS:
+        session.add(Beatmap(beatmap_id=beatmap_id, beatmapset_id=1, version='Diff %s' % beatmap_id, stars=beatmap_id / 2))
+    for user_id in USERS:
+        # RegisteredUser.__init__ takes an osu! api User
+        session.execute(RegisteredUser.__table__.insert().values(user_id=user_id, username='user%s' % user_id, avatar_url='avatar%s' % user_id))
+    score_id = 0
+    for user_id in USERS:
+        for i in range(10):
+            score_id += 1
+            session.add(OsuScore(score_id=score_id, user_id=user_id, beatmap_id=BEATMAPS[i % len(BEATMAPS)],
+                                 pp=float(10 * (i + 1)), lazer_score=1000 * score_id, enabled_mods='HD', rank='A',
+                                 date=datetime.datetime(2024, 1, 1) + datetime.timedelta(days=score_id)))
+    session.add(Leaderboard(leaderboard_id=1, name='everyone', mode=PlaymodeEnum.osu,
+                            metric=LeaderboardMetricEnum.weighted_pp, unique=True, private=False, creator_id=1))
+    for user_id in USERS:
+        session.add(LeaderboardSpot(leaderboard_id=1, user_id=user_id, value=float(user_id)))
+    session.commit()
+    yield session
+    session.close()
@@ -0,0 +1,45 @@
+import datetime
+from types import SimpleNamespace
+from sqlalchemy import select
+from database.activityService import reconcile_rollup, get_daily_counts, get_mode_totals
+from database.models import ScoreCountRollup
+from database.scoreService import insert_scores
+
+MAY_1 = datetime.date(2024, 5, 1)
+
+def api_score(score_id: int, user_id: int, ruleset_id: int, ended_at: datetime.datetime):
+    """
+    The fields of an osu! api score that Score.set_details reads
+    """
+    return SimpleNamespace(id=score_id, beatmap_id=10, user_id=user_id, ruleset_id=ruleset_id, legacy_total_score=0,
+                           total_score=1000, classic_total_score=0, accuracy=0.9, max_combo=100, rank=SimpleNamespace(value='A'),
+                           is_perfect_combo=False, statistics=SimpleNamespace(meh=0, ok=1, great=99, miss=0), mods=[],
+                           ended_at=ended_at, pp=50.0, replay=False)
+
+def rollup(session):
+    return sorted(session.execute(select(ScoreCountRollup.date, ScoreCountRollup.mode, ScoreCountRollup.user_id,
+                                         ScoreCountRollup.count)).all())
+
+def test_refetched_scores_are_counted_once(session):
+    scores = [api_score(1001, 1, 0, datetime.datetime(2024, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+              api_score(1002, 1, 0, datetime.datetime(2024, 5, 1, 23, 30, tzinfo=datetime.timezone.utc)),
+              api_score(1003, 2, 1, datetime.datetime(2024, 5, 2, 1, tzinfo=datetime.timezone.utc))]
+    assert insert_scores(session, scores, update_timeline=False, notify=False)
+    assert insert_scores(session, scores, update_timeline=False, notify=False)
+    # A new score in the same batch as re-fetched ones is still counted
+    assert insert_scores(session, scores + [api_score(1004, 2, 1, datetime.datetime(2024, 5, 2, 2, tzinfo=datetime.timezone.utc))],
+                         update_timeline=False, notify=False)
+
+    counts = get_daily_counts(session, MAY_1, MAY_1 + datetime.timedelta(days=1))
+    assert counts == {MAY_1: {'osu': 2, 'taiko': 0, 'fruits': 0, 'mania': 0},
+                      MAY_1 + datetime.timedelta(days=1): {'osu': 0, 'taiko': 2, 'fruits': 0, 'mania': 0}}
+    assert get_daily_counts(session, MAY_1, MAY_1, user_id=2)[MAY_1]['osu'] == 0
+
+    # Recounting from the score tables gives the rows the write path kept
+    written = rollup(session)
+    assert reconcile_rollup(session, MAY_1) == 2
+    assert rollup(session) == written
+
+    # The fixture's scores were written without the rollup, a full recount adds them
+    reconcile_rollup(session)
+    assert get_mode_totals(session) == {'osu': 32, 'taiko': 2, 'fruits': 0, 'mania': 0}
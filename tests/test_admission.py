@@ -0,0 +1,22 @@
+import asyncio
+from database.scoreService import select_scores
+from database.util import parse_per_mode, parse_user_filters
+from web.admission import run_query
+
+class ConnectedRequest:
+
+    async def is_disconnected(self):
+        return False
+
+def test_run_query_collects_every_connection_of_mode_all(session):
+    # The request's own connection and one per mode, so a disconnect can kill all of them
+    collected = []
+
+    def query():
+        collected.append(session.info['connection_ids'])
+        return select_scores(session, 'all', 'pp', limit=3, score_filters=parse_per_mode(parse_user_filters, 'all', [1]))
+
+    scores = asyncio.run(run_query(ConnectedRequest(), session, query))
+    assert [score.pp for score in scores] == [100, 90, 80]
+    assert len(collected[0]) == 5
+    assert 'connection_ids' not in session.info
@@ -0,0 +1,70 @@
+import inspect
+import os
+import pytest
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+import database.ORM as ORM_module
+from database.ORM import ORM
+import web.batch as batch
+from web.apiModels import BatchOperation
+from web.batch import batch_paths
+from web.dependencies import create_access_token
+from web.webapi import app
+from routers import stats
+
+# Async batchable routes that never query the database on the event loop
+OFF_LOOP = {'/stats/get_scores': 'runs its statements with run_query',
+            '/recent_scores': 'served from memory',
+            '/user_summary': 'does nothing'}
+
+def test_batchable_routes_do_not_block_the_event_loop():
+    # Sub-queries only overlap if no async route runs its statements on the loop
+    endpoints = {route.path: route.endpoint for route in app.router.routes if isinstance(route, APIRoute)}
+    endpoints |= {'/stats' + route.path: route.endpoint for route in stats.router.routes}
+    blocking = [path for path in batch_paths.values()
+                if inspect.iscoroutinefunction(endpoints[path]) and path not in OFF_LOOP]
+    assert blocking == []
+
+@pytest.fixture
+def client(engine, session, monkeypatch):
+    """
+    A client of the web app on the test database, with user 1's session cookie
+    """
+    monkeypatch.setenv('JWTSECRET', 'test secret')
+    monkeypatch.setitem(ORM_module._engines, (ORM().config, os.getpid()), (engine, sessionmaker(engine)))
+    client = TestClient(app)
+    client.cookies.set('session_token', create_access_token({'user_id': 1, 'username': 'user1', 'avatar_url': '', 'apikey': ''}))
+    return client
+
+def test_batch(client, monkeypatch):
+    calls = []
+    subrequest = batch.subrequest
+
+    async def counted(request, path, query):
+        calls.append((path, query))
+        return await subrequest(request, path, query)
+
+    monkeypatch.setattr(batch, 'subrequest', counted)
+    # A route answering with HTML stands in for a non-JSON response
+    monkeypatch.setitem(batch.batch_paths, BatchOperation.user_summary, '/docs')
+    response = client.post('/stats/batch', json={'queries': {
+        'top': {'op': 'top', 'params': {'user_id': 1, 'limit': 2}},
+        'same top': {'op': 'top', 'params': {'limit': 2, 'user_id': 1}},
+        'scores': {'op': 'get_scores', 'params': {'users': [1], 'limit': 2, 'metric': 'pp'}},
+        'invalid': {'op': 'top', 'params': {'user_id': 'abc'}},
+        'html': {'op': 'user_summary'},
+    }})
+    assert response.status_code == 200
+    results = response.json()
+    assert list(results) == ['top', 'same top', 'scores', 'invalid', 'html']
+    # Identical sub-queries run once and share their result
+    assert len(calls) == 4
+    assert results['top'] == results['same top']
+    assert [play['pp'] for play in results['top']['body']['top plays']] == [100, 90]
+    # The session cookie is passed on to routes that need it
+    assert results['scores']['status'] == 200
+    assert [score['pp'] for score in results['scores']['body']['scores']] == [100, 90]
+    # A failing sub-query only fails its own entry
+    assert results['invalid']['status'] == 422
+    assert results['html']['status'] == 200 and '<html>' in results['html']['body']
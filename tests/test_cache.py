@@ -0,0 +1,68 @@
+import pytest
+import database.cache as cache
+from database.cache import LRUCache, ResponseCache, MISSING, generations
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    monkeypatch.delenv('REDIS_URL', raising=False)
+    monkeypatch.setattr(cache, '_redis', None)
+
+def test_lru_evicts_the_least_recently_used():
+    lru = LRUCache(maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, None, 3)
+    assert lru.stats()['size'] == 2
+
+def test_lru_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    lru = LRUCache(ttl=10)
+    lru.set('a', 1)
+    now[0] += 10
+    assert lru.get('a') == 1
+    now[0] += 1
+    assert lru.get('a', MISSING) is MISSING
+    assert lru.stats()['size'] == 0
+
+def test_get_or_load_loads_once():
+    lru = LRUCache()
+    loads = []
+    for _ in range(2):
+        assert lru.get_or_load('a', lambda: loads.append(1) or 'value') == 'value'
+    assert loads == [1]
+
+def test_invalidate_tags():
+    lru = LRUCache()
+    lru.set('a', 1, tags=[('osu', 10)])
+    lru.set('b', 2, tags=[('osu', 10), ('osu', 11)])
+    lru.set('c', 3, tags=[('osu', 11)])
+    assert lru.invalidate_tags([('osu', 10)]) == 2
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (None, None, 3)
+    assert lru.tags == {('osu', 11): {'c'}}
+
+def test_delete():
+    lru = LRUCache()
+    lru.set('a', 1, tags=['tag'])
+    lru.delete('a')
+    lru.delete('missing')
+    assert lru.get('a') is None and lru.tags == {}
+
+def test_generation_bump_hides_older_responses():
+    responses = ResponseCache('test', ttl=300)
+    params = {'user_id': 42, 'mode': 'osu'}
+    key, cached = responses.lookup(params, [('test user', 42)])
+    assert cached is MISSING
+    responses.store(key, {'total': 1})
+    assert responses.lookup({'mode': 'osu', 'user_id': 42}, [('test user', 42)]) == (key, {'total': 1})
+
+    generations.bump([('test user', 42)])
+    new_key, cached = responses.lookup(params, [('test user', 42)])
+    assert new_key != key and cached is MISSING
+    # Other users' responses are unaffected
+    other_key, _ = responses.lookup({'user_id': 7}, [('test user', 7)])
+    responses.store(other_key, {'total': 7})
+    generations.bump([('test user', 42)])
+    assert responses.lookup({'user_id': 7}, [('test user', 7)])[1] == {'total': 7}
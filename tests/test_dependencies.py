@@ -0,0 +1,54 @@
+import time
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+import web.dependencies as dependencies
+from web.dependencies import create_access_token, decode_token, service_identity, verify_token
+
+PAYLOAD = {'user_id': 1, 'username': 'user1', 'avatar_url': '', 'apikey': ''}
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setenv('JWTSECRET', 'test secret')
+    dependencies.token_cache.clear()
+    yield
+    dependencies.token_cache.clear()
+
+def request(headers=None, cookies=None):
+    raw = [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    if cookies:
+        raw.append((b'cookie', '; '.join(f'{name}={value}' for name, value in cookies.items()).encode()))
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': raw})
+
+def test_decode_token_caches_the_payload():
+    token = create_access_token(PAYLOAD)
+    assert decode_token(token)['user_id'] == 1
+    assert dependencies.token_cache.stats()['size'] == 1
+    assert decode_token(token)['username'] == 'user1'
+
+def test_cached_payload_is_rejected_once_expired(monkeypatch):
+    token = create_access_token(PAYLOAD)
+    exp = decode_token(token)['exp']
+    monkeypatch.setattr(dependencies.time, 'time', lambda: exp)
+    with pytest.raises(HTTPException) as error:
+        decode_token(token)
+    assert error.value.status_code == 401
+
+def test_invalid_token_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        decode_token('not a token')
+    assert error.value.status_code == 401
+
+def test_missing_header_does_not_match_an_unset_key(monkeypatch):
+    monkeypatch.delenv('HARUHIME_KEY', raising=False)
+    assert service_identity(request()) is None
+    with pytest.raises(HTTPException) as error:
+        verify_token(request())
+    assert error.value.status_code == 401
+
+def test_verify_token_falls_back_to_the_cookie(monkeypatch):
+    monkeypatch.setenv('HARUHIME_KEY', 'service key')
+    token = create_access_token(PAYLOAD)
+    assert service_identity(request({'X-Authorization': 'wrong key'})) is None
+    assert verify_token(request({'X-Authorization': 'wrong key'}, {'session_token': token}))['user_id'] == 1
+    assert time.time() < verify_token(request(cookies={'session_token': token}))['exp']
@@ -0,0 +1,12 @@
+import os
+os.environ.setdefault('NUM_THREADS', '1')
+from fastapi.testclient import TestClient
+from scores_fetcher import fetchQueueAPI
+
+def test_queue_routes_answer_503_before_warm_up(monkeypatch):
+    monkeypatch.setattr(fetchQueueAPI, 'tq', None)
+    client = TestClient(fetchQueueAPI.fetchapp)
+    for path in ('/queue', '/leaderboard_backlog'):
+        response = client.get(path)
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(fetchQueueAPI.WARMUP_RETRY)
@@ -0,0 +1,9 @@
+import pytest
+from checkImportTime import BUDGETS, import_time
+
+@pytest.mark.parametrize('module', BUDGETS)
+def test_import_within_budget(module, monkeypatch):
+    # The fetch queue reads NUM_THREADS when it is imported
+    monkeypatch.setenv('NUM_THREADS', '1')
+    total, slowest = import_time(module)
+    assert total <= BUDGETS[module], slowest
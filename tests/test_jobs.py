@@ -0,0 +1,35 @@
+import os
+import time
+from sqlalchemy.orm import sessionmaker
+from database.jobs import Job, JobRunner, sweep_results
+
+def test_finished_jobs_have_finished_at(engine, tmp_path):
+    runner = JobRunner(sessionmaker(engine), directory=str(tmp_path))
+    done = runner.submit('test', {}, 1, lambda session, job: ('text/plain', [b'ok']))
+    failed = runner.submit('test', {}, 1, lambda session, job: 1 / 0)
+    runner.pool.shutdown(wait=True)
+    assert (done.status, failed.status) == ('done', 'failed')
+    assert done.finished_at is not None and failed.finished_at is not None
+    assert open(done.path, 'rb').read() == b'ok'
+    assert runner.stats() == {'queued': 0, 'running': 0, 'done': 1, 'failed': 1}
+    # Expired jobs are forgotten and their results deleted
+    runner.ttl = -1
+    runner.cleanup()
+    assert runner.stats()['done'] == 0 and not os.path.exists(done.path)
+
+def test_record_round_trip():
+    job = Job('export', {'user_id': 1}, 1)
+    assert Job.from_record(dict(job.__dict__)).to_dict() == job.to_dict()
+
+def test_sweep_removes_only_old_results(tmp_path):
+    old, recent = tmp_path / 'old', tmp_path / 'recent.part'
+    old.write_bytes(b'x')
+    recent.write_bytes(b'x')
+    os.utime(old, (time.time() - 7200, time.time() - 7200))
+    sweep_results(str(tmp_path), ttl=3600)
+    assert sorted(os.listdir(tmp_path)) == ['recent.part']
+
+def test_job_stats_route():
+    from fastapi.testclient import TestClient
+    from web.webapi import app
+    assert TestClient(app).get('/job_stats').json() == {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
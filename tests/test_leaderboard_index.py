@@ -0,0 +1,52 @@
+import pytest
+from fastapi.testclient import TestClient
+import database.leaderboardIndex as leaderboardIndex
+from database.leaderboardIndex import RankedLeaderboard
+
+@pytest.fixture
+def index(session):
+    leaderboardIndex._indexes.clear()
+    leaderboardIndex._names.clear()
+    yield leaderboardIndex.get_index(session, 1)
+    leaderboardIndex._indexes.clear()
+    leaderboardIndex._names.clear()
+
+def test_rank(index):
+    assert [index.rank(user_id) for user_id in (3, 2, 1)] == [1, 2, 3]
+    assert index.rank(99) is None
+
+def test_ties_and_missing_values_are_ranked_last():
+    index = RankedLeaderboard({}, [(1, 5.0), (2, None), (3, 5.0), (4, 9.0)], {})
+    assert [spot['user_id'] for spot in index.page()] == [4, 1, 3, 2]
+    assert [index.rank(user_id) for user_id in (4, 1, 3, 2)] == [1, 2, 3, 4]
+
+def test_page(index):
+    assert [(spot['rank'], spot['user_id'], spot['username']) for spot in index.page(1, 1)] == [(2, 2, 'user2')]
+    assert [spot['rank'] for spot in index.page(1)] == [2, 3]
+    assert index.page(5, 10) == []
+    with pytest.raises(ValueError):
+        index.page(-2)
+    with pytest.raises(ValueError):
+        index.page(0, 0)
+
+def test_update_spots_moves_a_spot(index):
+    leaderboardIndex.update_spots(1, {1: 10.0})
+    assert leaderboardIndex._indexes[1] is index
+    assert [spot['user_id'] for spot in index.page()] == [1, 3, 2]
+    assert index.rank(1) == 1 and index.values[1] == 10.0
+
+def test_update_spots_with_unknown_user_drops_the_index(session, index):
+    leaderboardIndex.update_spots(1, {99: 10.0})
+    assert 1 not in leaderboardIndex._indexes
+    assert leaderboardIndex.get_index(session, 1) is not index
+
+def test_forget(session, index):
+    leaderboardIndex.forget(1)
+    assert 1 not in leaderboardIndex._indexes and 'everyone' not in leaderboardIndex._names
+    assert leaderboardIndex.get_index(session, leaderboard_name='everyone').rank(3) == 1
+
+@pytest.mark.parametrize('query', ['offset=-1', 'limit=0'])
+def test_get_leaderboard_info_rejects_bad_pages(query):
+    from web.webapi import app
+    response = TestClient(app).get('/get_leaderboard_info?leaderboard_id=1&' + query)
+    assert response.status_code == 422
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import update
+from database.leaderboardMetrics import metrics
+from database.leaderboardService import recalculate_leaderboard
+from database.models import OsuScore, Leaderboard, LeaderboardSpot, LeaderboardMetricEnum, PlaymodeEnum
+from database.util import BONUS_PP
+from conftest import USERS
+
+# Each user's best per beatmap is 100, 90, 80 and 70 pp
+WEIGHTED_PP = BONUS_PP + 100 + 90 * 0.95 + 80 * 0.95 ** 2 + 70 * 0.95 ** 3
+
+# metric -> (unique values, non-unique values) of users 1, 2 and 3
+EXPECTED = {
+    'weighted_pp': ((WEIGHTED_PP,) * 3, (WEIGHTED_PP,) * 3),
+    'count_unique_beatmaps': ((4, 4, 4), (4, 4, 4)),
+    'total_score': ((34000, 74000, 114000), (55000, 155000, 255000)),
+    # Two of user 2's scores on beatmap 10 are SS
+    'count_ss': ((0, 1, 0), (0, 2, 0)),
+    'total_max_combo': ((34, 74, 114), (55, 155, 255)),
+    'total_pp': ((340, 340, 340), (550, 550, 550)),
+    'average_accuracy': ((0.85, 0.85, 0.85), (0.55, 0.55, 0.55)),
+}
+
+def add_leaderboard(session, metric: str, unique: bool, score_filters: str = None) -> int:
+    session.add(Leaderboard(leaderboard_id=2, name=metric, mode=PlaymodeEnum.osu, metric=LeaderboardMetricEnum[metric],
+                            unique=unique, private=False, creator_id=1, score_filters=score_filters))
+    session.add_all([LeaderboardSpot(leaderboard_id=2, user_id=user_id, value=-1.0) for user_id in USERS])
+    session.commit()
+    return 2
+
+def test_every_metric_is_tested():
+    assert set(EXPECTED) == set(metrics) == {metric.name for metric in LeaderboardMetricEnum}
+
+@pytest.mark.parametrize('unique', [True, False])
+@pytest.mark.parametrize('metric', sorted(EXPECTED))
+def test_metric_values(session, metric, unique):
+    session.execute(update(OsuScore).values(maxcombo=OsuScore.score_id, accuracy=OsuScore.pp / 100))
+    session.execute(update(OsuScore).filter(OsuScore.score_id.in_((11, 15))).values(rank='X'))
+    values = recalculate_leaderboard(session, add_leaderboard(session, metric, unique))
+    expected = EXPECTED[metric][0 if unique else 1]
+    assert [values[user_id] for user_id in USERS] == pytest.approx(expected)
+
+@pytest.mark.parametrize('metric', sorted(EXPECTED))
+def test_members_without_matching_scores_get_the_default(session, metric):
+    values = recalculate_leaderboard(session, add_leaderboard(session, metric, True, 'pp>1000'))
+    assert values == {user_id: metrics[metric].default for user_id in USERS}
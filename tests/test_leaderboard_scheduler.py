@@ -0,0 +1,39 @@
+from sqlalchemy.orm import sessionmaker
+import database.leaderboardService as leaderboardService
+from database.leaderboardScheduler import LeaderboardScheduler, MAX_ATTEMPTS
+
+def recompute(scheduler, batch):
+    # _recompute releases the slot _run acquired for it
+    scheduler.slots.acquire()
+    scheduler._recompute(batch)
+
+def test_deleted_leaderboard_is_skipped(session):
+    assert leaderboardService.recalculate_leaderboard(session, 999, [1]) == {}
+
+def test_failing_spots_are_dropped_after_max_attempts(engine, session, monkeypatch):
+    def fail(session, leaderboard_id, user_ids):
+        raise RuntimeError('metric query failed')
+    monkeypatch.setattr(leaderboardService, 'recalculate_leaderboard', fail)
+    scheduler = LeaderboardScheduler(sessionmaker(engine), debounce=3600)
+
+    for attempt in range(1, MAX_ATTEMPTS):
+        recompute(scheduler, [(1, 1)])
+        assert list(scheduler.pending) == [(1, 1)]
+        del scheduler.pending[(1, 1)]
+    recompute(scheduler, [(1, 1)])
+    assert scheduler.pending == {}
+    assert scheduler.stats()['dropped'] == 1
+
+def test_one_failing_leaderboard_does_not_retry_the_others(engine, session, monkeypatch):
+    recalculated = []
+    def recalculate(session, leaderboard_id, user_ids):
+        if leaderboard_id == 2:
+            raise RuntimeError('metric query failed')
+        recalculated.append((leaderboard_id, sorted(user_ids)))
+    monkeypatch.setattr(leaderboardService, 'recalculate_leaderboard', recalculate)
+    scheduler = LeaderboardScheduler(sessionmaker(engine), debounce=3600)
+
+    recompute(scheduler, [(1, 1), (1, 2), (2, 3)])
+    assert recalculated == [(1, [1, 2])]
+    assert list(scheduler.pending) == [(2, 3)]
+    assert scheduler.stats()['recomputed'] == 2
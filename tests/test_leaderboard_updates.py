@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+import database.leaderboardScheduler as leaderboardScheduler
+import database.leaderboardService as leaderboardService
+from database.models import OsuScore, Beatmap, Leaderboard, LeaderboardSpot, LeaderboardMetricEnum, PlaymodeEnum
+from database.scoreMatcher import ScoreMatcher
+from database.scoreService import plan_score_query
+from database.util import parse_mod_filters, parse_score_filters, parse_beatmap_filters, parse_beatmapset_filters
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    leaderboardService._spot_states.clear()
+    leaderboardService._matchers.clear()
+
+@pytest.mark.parametrize('mods, score_filters, beatmap_filters, beatmapset_filters', [
+    (None, 'pp>50', None, None),
+    (None, 'pp>=30 pp<=70', None, None),
+    ('+HD', 'pp<=20', None, None),
+    (None, None, 'stars>5.5', None),
+    (None, 'pp<40', None, 'language_id=2'),
+])
+def test_matcher_agrees_with_sql(session, mods, score_filters, beatmap_filters, beatmapset_filters):
+    filters = (parse_mod_filters('osu', mods), parse_score_filters('osu', score_filters),
+               parse_beatmap_filters(beatmap_filters), parse_beatmapset_filters(beatmapset_filters))
+    expected = set(session.scalars(plan_score_query('osu', *filters, columns=(OsuScore.score_id,))))
+    matcher = ScoreMatcher('osu', *filters)
+    beatmaps = {beatmap.beatmap_id: beatmap for beatmap in session.scalars(select(Beatmap).options(joinedload(Beatmap.beatmapset)))}
+    matched = {score.score_id for score in session.scalars(select(OsuScore)) if matcher(score, beatmaps[score.beatmap_id])}
+    assert matched == expected and 0 < len(expected) < 30
+
+def new_score(session, score_id, user_id, beatmap_id, pp):
+    score = OsuScore(score_id=score_id, user_id=user_id, beatmap_id=beatmap_id, pp=pp, lazer_score=1, enabled_mods='HD', rank='A')
+    session.add(score)
+    session.commit()
+    return score
+
+def spot_values(session, leaderboard_id):
+    return dict(session.execute(select(LeaderboardSpot.user_id, LeaderboardSpot.value)
+                                .filter(LeaderboardSpot.leaderboard_id == leaderboard_id)).all())
+
+def test_apply_updates_only_matching_spots(session):
+    session.add(Leaderboard(leaderboard_id=2, name='high pp', mode=PlaymodeEnum.osu, metric=LeaderboardMetricEnum.weighted_pp,
+                            unique=True, private=False, creator_id=1, score_filters='pp>200'))
+    session.add_all([LeaderboardSpot(leaderboard_id=2, user_id=user_id, value=0.0) for user_id in (1, 2)])
+    session.commit()
+
+    written = leaderboardService.apply_new_scores(session, [new_score(session, 100, 1, 10, 150.0)])
+    # The score only passes the filters of leaderboard 1, and only user 1's spot changes
+    assert written == 1
+    assert spot_values(session, 2) == {1: 0.0, 2: 0.0}
+    values = spot_values(session, 1)
+    assert (values[2], values[3]) == (2.0, 3.0)
+    assert values[1] == pytest.approx(leaderboardService.recalculate_leaderboard(session, 1, [1])[1])
+
+    # Applied to the cached state this time, not reloaded
+    written = leaderboardService.apply_new_scores(session, [new_score(session, 101, 1, 11, 300.0)])
+    assert written == 2
+    for leaderboard_id in (1, 2):
+        assert spot_values(session, leaderboard_id)[1] == pytest.approx(
+            leaderboardService.recalculate_leaderboard(session, leaderboard_id, [1])[1])
+
+def test_apply_marks_spots_of_other_metrics_dirty(session, monkeypatch):
+    marked = []
+
+    class Scheduler:
+        def mark(self, leaderboard_id, user_ids):
+            marked.append((leaderboard_id, tuple(user_ids)))
+
+    monkeypatch.setattr(leaderboardScheduler, 'get_scheduler', lambda sessionmaker: Scheduler())
+    session.add(Leaderboard(leaderboard_id=2, name='score', mode=PlaymodeEnum.osu, metric=LeaderboardMetricEnum.total_score,
+                            unique=True, private=False, creator_id=1))
+    session.add_all([LeaderboardSpot(leaderboard_id=2, user_id=user_id, value=0.0) for user_id in (1, 2)])
+    session.commit()
+
+    leaderboardService.apply_new_scores(session, [new_score(session, 100, 2, 10, 1.0)])
+    # total_score has no incremental state, so user 2's spot is left to the scheduler
+    assert marked == [(2, (2,))]
+    assert spot_values(session, 2) == {1: 0.0, 2: 0.0}
@@ -0,0 +1,44 @@
+"""
+Profile pp against the osu! weighting formula (https://osu.ppy.sh/wiki/en/Performance_points/Weighting_system):
+the i-th best score counts pp_i * 0.95^(i-1), with i starting at 1, plus the bonus pp.
+"""
+from types import SimpleNamespace
+import numpy
+import pytest
+from database.util import BONUS_PP
+from database.userService import get_profile_pp
+import database.scoreService as scoreService
+from conftest import USERS
+
+def osu_formula(pps, bonus=True):
+    return (BONUS_PP if bonus else 0) + sum(pp * 0.95 ** (i - 1) for i, pp in enumerate(pps, start=1))
+
+def test_best_score_counts_in_full():
+    assert scoreService.weighted_pp_sums(numpy.array([[100.0, 50.0]]), bonus=False)[0] == pytest.approx(100 + 50 * 0.95)
+
+@pytest.mark.parametrize('n', [1, 100, 150])
+def test_weighted_pp_sums(n):
+    pp_matrix = -numpy.sort(-numpy.random.default_rng(n).uniform(0, 800, (3, n)), axis=1)
+    expected = [osu_formula(row) for row in pp_matrix.tolist()]
+    assert scoreService.weighted_pp_sums(pp_matrix) == pytest.approx(expected)
+
+@pytest.mark.parametrize('n', [100, 150])
+def test_get_profile_pp(n):
+    scores = [SimpleNamespace(pp=float(1000 - i)) for i in range(200)]
+    assert get_profile_pp(scores, n=n) == pytest.approx(osu_formula([score.pp for score in scores[:n]]))
+    assert get_profile_pp(scores, bonus=False, n=n) == pytest.approx(osu_formula([score.pp for score in scores[:n]], False))
+
+def test_weighted_pp_sum_uses_top_100():
+    scores = [SimpleNamespace(pp=float(1000 - i)) for i in range(150)]
+    assert scoreService.weighted_pp_sum(scores) == pytest.approx(osu_formula([score.pp for score in scores[:100]]))
+
+def test_profile_pp_batch(session):
+    # Every user's best per beatmap is 100, 90, 80 and 70 (see conftest)
+    expected = osu_formula([100, 90, 80, 70])
+    assert scoreService.get_profile_pp_batch(session, list(USERS), 'osu') == pytest.approx({user_id: expected for user_id in USERS})
+    assert scoreService.get_profile_pp_batch(session, [1], 'osu', n=150) == pytest.approx({1: expected})
+    assert scoreService.get_profile_pp_batch(session, [1], 'osu', n=2) == pytest.approx({1: osu_formula([100, 90])})
+
+def test_profile_pp_batch_without_users(session):
+    assert scoreService.get_top_pp_matrix(session, [], 'osu').shape == (0, 100)
+    assert scoreService.get_profile_pp_batch(session, [], 'osu') == {}
@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+from sqlalchemy.orm import sessionmaker
+import database.recentScores as recentScores
+from database.models import OsuScore
+from database.recentScores import RecentScores
+
+def test_skips_scores_of_missing_users(session):
+    # Like the old /recent_scores, a score whose user is not registered is left out
+    session.add(OsuScore(score_id=1000, user_id=99, beatmap_id=10, pp=1.0, lazer_score=1, enabled_mods='', rank='A'))
+    session.commit()
+    loaded = RecentScores(None)._load(session, 'osu', 5)
+    assert [score['score_id'] for score in loaded] == [30, 29, 28, 27]
+
+def score(score_id: int, day: int = 1) -> dict:
+    return {'score_id': score_id, 'date': datetime.datetime(2024, 1, day)}
+
+def test_add_keeps_the_highest_score_ids_of_each_mode():
+    buffer = RecentScores(None, size=2)
+    buffer.add('osu', [score(1), score(3, 3), score(2, 2)])
+    buffer.add('taiko', [score(10)])
+    assert sorted(buffer.scores['osu']) == [2, 3]
+    assert [x['score_id'] for x in buffer.latest(5)] == [3, 2, 10]
+    assert buffer.seen == {'osu': 3, 'taiko': 10, 'fruits': 0, 'mania': 0}
+
+def test_poll_advances_past_skipped_scores(engine, session):
+    buffer = RecentScores(sessionmaker(engine), size=5)
+    buffer.poll()
+    assert buffer.seen['osu'] == 30
+    assert sorted(buffer.scores['osu']) == [26, 27, 28, 29, 30]
+
+    # A score of an unregistered user is not added, but is not read again either
+    session.add(OsuScore(score_id=31, user_id=99, beatmap_id=10, pp=1.0, lazer_score=1, enabled_mods='', rank='A'))
+    session.add(OsuScore(score_id=32, user_id=1, beatmap_id=10, pp=1.0, lazer_score=1, enabled_mods='', rank='A',
+                         date=datetime.datetime(2025, 1, 1)))
+    session.commit()
+    buffer.poll()
+    assert buffer.seen['osu'] == 32
+    assert sorted(buffer.scores['osu']) == [27, 28, 29, 30, 32]
+    assert buffer.latest(1)[0]['score_id'] == 32
+
+def test_full_listener_queue_drops_newer_batches(monkeypatch):
+    monkeypatch.setattr(recentScores, 'LISTENER_BACKLOG', 2)
+    buffer = RecentScores(None)
+
+    async def listen():
+        queue = buffer.listen()
+        for score_id in (1, 2, 3):
+            buffer.add('osu', [score(score_id)])
+        # The batches are handed over on the loop
+        await asyncio.sleep(0)
+        batches = [queue.get_nowait() for _ in range(queue.qsize())]
+        buffer.stop_listening(queue)
+        buffer.add('osu', [score(4)])
+        await asyncio.sleep(0)
+        return batches, queue.qsize()
+
+    batches, left = asyncio.run(listen())
+    assert [[x['score_id'] for x in batch] for batch in batches] == [[1], [2]]
+    assert left == 0
+
+def test_routes_answer_503_until_the_buffer_is_loaded(monkeypatch):
+    from fastapi.testclient import TestClient
+    import web.webapi as webapi
+    monkeypatch.setitem(webapi.readiness, 'recent_scores', False)
+    client = TestClient(webapi.app)
+    for path in ('/recent_scores', '/recent_scores/stream'):
+        response = client.get(path)
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(webapi.WARMUP_RETRY)
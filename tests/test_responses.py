@@ -0,0 +1,24 @@
+import pytest
+from starlette.requests import Request
+from web.responses import make_etag, not_modified
+
+def request(if_none_match: str = None) -> Request:
+    headers = [] if if_none_match is None else [(b'if-none-match', if_none_match.encode())]
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers})
+
+ETAG = make_etag('stats/top', 10, 3)
+
+def test_etag_changes_with_any_version():
+    assert ETAG.startswith('"') and ETAG.endswith('"')
+    assert ETAG == make_etag('stats/top', 10, 3)
+    assert ETAG != make_etag('stats/top', 11, 3)
+
+@pytest.mark.parametrize('header', [ETAG, 'W/' + ETAG, '*', '"other", ' + ETAG])
+def test_matching_if_none_match_is_304(header):
+    response = not_modified(request(header), ETAG)
+    assert response.status_code == 304
+    assert response.headers['ETag'] == ETAG
+
+@pytest.mark.parametrize('header', [None, '"other"', ETAG.strip('"')])
+def test_other_requests_are_answered(header):
+    assert not_modified(request(header), ETAG) is None
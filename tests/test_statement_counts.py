@@ -0,0 +1,69 @@
+"""
+The number of SQL statements each endpoint's service calls send, so lazy loads per row (N+1 queries) are caught.
+Each test touches every relationship the endpoint serializes inside count_statements.
+"""
+from database.util import count_statements
+from database.serializers import recent_score_projection, score_projection, beatmap_leaderboard_projection
+import database.scoreService as scoreService
+import database.leaderboardService as leaderboardService
+import database.leaderboardIndex as leaderboardIndex
+from conftest import USERS
+
+def test_get_leaderboards(engine, session):
+    with count_statements(engine) as statements:
+        creators = [leaderboard.creator.username for leaderboard in leaderboardService.get_leaderboards(session)]
+    assert creators == ['user1']
+    assert len(statements) == 1
+
+def test_get_leaderboard_info(engine, session):
+    with count_statements(engine) as statements:
+        index = leaderboardIndex.load_index(session, 1)
+        users = [(spot['username'], spot['value']) for spot in index.page()]
+    assert index.leaderboard['creator']['username'] == 'user1'
+    assert users == [('user3', 3.0), ('user2', 2.0), ('user1', 1.0)]
+    assert len(statements) == 2
+
+def test_recent_scores(engine, session):
+    header, columns = recent_score_projection('osu')
+    with count_statements(engine) as statements:
+        rows = scoreService.get_recent_scores(session, 'osu', 15, columns)
+    assert len(rows) == 15
+    assert len(statements) == 1
+
+def test_recent_scores_objects(engine, session):
+    with count_statements(engine) as statements:
+        scores = scoreService.get_recent_scores(session, 'osu', 15)
+        loaded = [(score.beatmap.beatmapset.title, score.user.username) for score in scores]
+    assert len(loaded) == 15
+    assert len(statements) == 1
+
+def test_get_scores_page(engine, session):
+    header, columns = score_projection('osu', 'readable')
+    score_filters = scoreService.parse_user_filters('osu', list(USERS))
+    with count_statements(engine) as statements:
+        rows = scoreService.select_scores(session, 'osu', 'pp', True, 5, score_filters=score_filters, columns=columns)
+        cursor = scoreService.next_cursor(rows, 'pp', 5)
+        scoreService.select_scores(session, 'osu', 'pp', True, 5, score_filters=score_filters, columns=columns, cursor=cursor)
+    assert len(rows) == 5
+    assert len(statements) == 2
+
+def test_top_n_with_beatmaps(engine, session):
+    with count_statements(engine) as statements:
+        scores = scoreService.get_top_n(session, 1, 'osu', load_beatmap=True)
+        titles = [(score.beatmap.version, score.beatmap.beatmapset.title) for score in scores]
+    # One score per beatmap
+    assert len(titles) == 4
+    assert len(statements) == 1
+
+def test_beatmap_leaderboard(engine, session):
+    header, columns = beatmap_leaderboard_projection('osu')
+    with count_statements(engine) as statements:
+        rows = scoreService.get_beatmap_leaderboard(session, 10, 'osu', 'pp', columns=columns)
+    assert len(rows) == len(USERS)
+    assert len(statements) == 1
+
+def test_profile_pp_batch(engine, session):
+    with count_statements(engine) as statements:
+        profile_pp = scoreService.get_profile_pp_batch(session, list(USERS), 'osu')
+    assert set(profile_pp) == set(USERS)
+    assert len(statements) == 1
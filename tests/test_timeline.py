@@ -0,0 +1,43 @@
+import datetime
+import database.timelineService as timelineService
+from database.models import OsuScore
+
+def new_score(score_id, beatmap_id, pp, days):
+    return OsuScore(score_id=score_id, user_id=1, beatmap_id=beatmap_id, pp=pp, lazer_score=1, enabled_mods='', rank='A',
+                    date=datetime.datetime(2025, 1, 1) + datetime.timedelta(days=days))
+
+def timeline(session):
+    return [(point['score_id'], round(point['pp'], 3)) for point in timelineService.get_timeline(session, 1, 'osu')]
+
+def test_record_scores_matches_backfill(session):
+    timelineService._trackers.clear()
+    timelineService.backfill_timeline(session, 1, 'osu')
+    scores = [new_score(100, 12, 500.0, 1), new_score(101, 13, 600.0, 2)]
+    session.add_all(scores)
+    session.commit()
+    timelineService.record_scores(session, scores)
+    recorded = timeline(session)
+
+    timelineService.backfill_timeline(session, 1, 'osu')
+    assert recorded == timeline(session)
+
+def test_rebuilds_a_tracker_another_process_wrote_past(session):
+    timelineService._trackers.clear()
+    timelineService.backfill_timeline(session, 1, 'osu')
+    cached = timelineService._trackers.get((1, 'osu'))
+
+    # Another process ingests a score and writes its point; this process keeps its older tracker
+    other = new_score(100, 12, 500.0, 1)
+    session.add(other)
+    session.commit()
+    timelineService.backfill_timeline(session, 1, 'osu', since=other.date)
+    timelineService._trackers.set((1, 'osu'), cached)
+
+    score = new_score(101, 13, 600.0, 2)
+    session.add(score)
+    session.commit()
+    timelineService.record_scores(session, [score])
+    recorded = timeline(session)
+
+    timelineService.backfill_timeline(session, 1, 'osu')
+    assert recorded == timeline(session)
@@ -0,0 +1,147 @@
+"""
+Admission control for expensive analytics routes, so a few heavy queries cannot tie up MySQL for the fetch queue and
+the cheap endpoints. A request is
+- priced with scoreService.estimate_query_cost from its parsed filters and number of users
+- rejected (400) if it costs more than the route allows at all
+- charged to its user's token bucket (429 with Retry-After when the bucket is empty)
+- queued behind the route's concurrency limit (503 if no slot frees up in time)
+- run in a worker thread with a server-side statement timeout, and killed if the client disconnects
+"""
+import asyncio
+import math
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, TypeVar
+from fastapi import HTTPException, Request, status
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from database.util import connection_id, kill_query
+
+T = TypeVar('T')
+
+# How often a running query checks whether its client is still there
+DISCONNECT_POLL = 0.5
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float) -> float:
+        """
+        Takes cost tokens. Returns 0 if they were taken, otherwise the seconds until there will be enough.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+class RouteLimit:
+    """
+    The limits of one route
+    - max_concurrent: queries of the route running at once
+    - max_cost:       the most a single request may cost, at most burst
+    - rate, burst:    each user's token bucket, in cost units per second and in total
+    - timeout:        seconds a query may run on the server
+    - queue_timeout:  seconds a request waits for a free slot
+    """
+
+    def __init__(self, name: str, max_concurrent: int = 4, max_cost: float = 2000, rate: float = 100, burst: float = 2000,
+                 timeout: float = 10, queue_timeout: float = 5):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_cost = min(max_cost, burst)
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.lock = threading.Lock()
+        self.running = 0
+        self.admitted = 0
+        self.rejected = {'too_expensive': 0, 'rate_limited': 0, 'busy': 0}
+        route_limits[name] = self
+
+    def charge(self, user_id: int, cost: float) -> None:
+        """
+        Rejects a request costing more than max_cost (400), or charges it to the user's token bucket (429 if empty)
+        """
+        if cost > self.max_cost:
+            self.rejected['too_expensive'] += 1
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='This request is too expensive (cost %d, limit %d). Filter on fewer users or '
+                                       'remove text filters.' % (cost, self.max_cost))
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take(cost)
+        if wait:
+            self.rejected['rate_limited'] += 1
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Too many expensive requests',
+                                headers={'Retry-After': str(math.ceil(wait))})
+
+    @asynccontextmanager
+    async def admit(self, user_id: int, cost: float):
+        self.charge(user_id, cost)
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected['busy'] += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='The server is busy, try again later',
+                                headers={'Retry-After': str(math.ceil(self.queue_timeout))})
+        self.running += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+    def stats(self) -> dict:
+        return {'running': self.running, 'max_concurrent': self.max_concurrent, 'admitted': self.admitted,
+                'rejected': dict(self.rejected), 'users': len(self.buckets)}
+
+route_limits: Dict[str, RouteLimit] = {}
+
+async def run_query(request: Request, session: Session, query: Callable[[], T]) -> T:
+    """
+    Runs query() in a worker thread, so the event loop keeps serving other requests. If the client disconnects,
+    the statements running on the session's connection, and on the per-mode connections merge_modes opens for
+    mode 'all', are killed. A statement stopped by the server's timeout or killed becomes a 503 (or 499 for a client
+    that is gone).
+    """
+    # The server ids of every connection the query runs on. merge_modes adds its per-mode connections to it.
+    server_ids = session.info['connection_ids'] = []
+
+    def run() -> T:
+        server_ids.append(connection_id(session))
+        return query()
+
+    task = asyncio.ensure_future(asyncio.to_thread(run))
+    disconnected = False
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL)
+        if not task.done() and not disconnected and await request.is_disconnected():
+            disconnected = True
+            for server_id in list(server_ids):
+                if server_id is not None:
+                    await asyncio.to_thread(kill_query, session.get_bind(), server_id)
+    session.info.pop('connection_ids', None)
+    try:
+        return task.result()
+    except OperationalError as e:
+        session.rollback()
+        if disconnected:
+            raise HTTPException(status_code=499, detail='Client closed the request')
+        print(e)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='The query did not finish in time. Try narrower filters.')
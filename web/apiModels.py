@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Dict, List, Literal
 
 from pydantic import BaseModel, Field, ConfigDict
 from enum import Enum
@@ -35,6 +35,16 @@ class Mode(str or int, Enum):
     fruits = 'fruits' or 2
     mania = 'mania' or 3
 
+class ModeOrAll(str, Enum):
+    """
+    A mode, or 'all' to query the four score tables at once
+    """
+    osu = 'osu'
+    taiko = 'taiko'
+    fruits = 'fruits'
+    mania = 'mania'
+    all = 'all'
+
 class Metric(str, Enum):
     pp = 'pp'
     stable_score = 'stable_score'
@@ -47,6 +57,7 @@ class ScoreReturnFormat(str, Enum):
     verbose = 'verbose'
     readable = 'readable'
     minimal = 'minimal'
+    compact = 'compact'
     none = 'none'
 
 class ScoreGroupBy(str, Enum):
@@ -68,4 +79,30 @@ class SortBy(BaseModel):
 class FilterParams(BaseModel):
     limit: int = Field(100, gt=0, le=100)
     offset: int = Field(0, ge=0)
-    order_by: Literal["created_at", "updated_at"] = "created_at"
\ No newline at end of file
+    order_by: Literal["created_at", "updated_at"] = "created_at"
+class BatchOperation(str, Enum):
+    """
+    The read-only GET routes a batch may call, by name
+    """
+    top = 'top'
+    profile_pp = 'profile_pp'
+    score_history = 'score_history'
+    get_scores = 'get_scores'
+    beatmap_leaderboard = 'beatmap_leaderboard'
+    pp_record_history = 'pp_record_history'
+    profile_pp_timeline = 'profile_pp_timeline'
+    recent_scores = 'recent_scores'
+    recent_summary = 'recent_summary'
+    database_summary = 'database_summary'
+    user_summary = 'user_summary'
+    get_leaderboards = 'get_leaderboards'
+    get_leaderboard_info = 'get_leaderboard_info'
+    leaderboard_rank = 'leaderboard_rank'
+    leaderboard_rank_history = 'leaderboard_rank_history'
+
+class BatchQuery(BaseModel):
+    op: BatchOperation
+    params: Dict[str, str | int | float | bool | List[str | int | float | bool]] = Field(default_factory=dict, description='The query parameters of the route')
+
+class BatchRequest(BaseModel):
+    queries: Dict[str, BatchQuery] = Field(max_length=20, description='Sub-queries by the name their result is returned under')
@@ -0,0 +1,95 @@
+"""
+Runs several GET routes of the app for one request, so a page can load all of its stats in one round trip.
+
+Each sub-query is dispatched in-process through the app itself, so it gets the route's own validation, caching, ETags and
+admission control, and opens its session from the same connection pool. Identical sub-queries (same route and
+parameters) run once, and their JSON bodies are spliced into the combined response without being parsed again.
+
+The sub-queries are started together, but they only overlap if their routes keep database work off the event loop:
+the batchable routes are plain functions, which FastAPI runs in its thread pool, or hand their statements to
+admission.run_query. A batchable route must not be an async function that queries the database directly, or every
+sub-query after it waits for it.
+"""
+import asyncio
+from typing import Dict, List, Tuple
+from urllib.parse import urlencode
+import orjson
+from fastapi import Request
+from web.apiModels import BatchOperation, BatchQuery
+
+batch_paths = {
+    BatchOperation.top: '/stats/top',
+    BatchOperation.profile_pp: '/stats/profile_pp',
+    BatchOperation.score_history: '/stats/score_history',
+    BatchOperation.get_scores: '/stats/get_scores',
+    BatchOperation.beatmap_leaderboard: '/stats/beatmap_leaderboard',
+    BatchOperation.pp_record_history: '/stats/pp_record_history',
+    BatchOperation.profile_pp_timeline: '/stats/profile_pp_timeline',
+    BatchOperation.recent_scores: '/recent_scores',
+    BatchOperation.recent_summary: '/recent_summary',
+    BatchOperation.database_summary: '/database_summary',
+    BatchOperation.user_summary: '/user_summary',
+    BatchOperation.get_leaderboards: '/get_leaderboards',
+    BatchOperation.get_leaderboard_info: '/get_leaderboard_info',
+    BatchOperation.leaderboard_rank: '/leaderboard_rank',
+    BatchOperation.leaderboard_rank_history: '/leaderboard_rank_history',
+}
+
+# Request headers not passed on to sub-queries: they describe the batch's own body, or would change the sub-responses'
+HIDDEN_HEADERS = {b'content-length', b'content-type', b'transfer-encoding', b'accept-encoding', b'if-none-match', b'if-match'}
+
+def query_string(params: dict) -> str:
+    """
+    The query string of a sub-query, sorted so identical sub-queries have the same one
+    """
+    items = []
+    for key, value in sorted(params.items()):
+        for item in (value if isinstance(value, list) else [value]):
+            items.append((key, str(item).lower() if isinstance(item, bool) else item))
+    return urlencode(items)
+
+async def subrequest(request: Request, path: str, query: str) -> Tuple[int, bytes, bytes]:
+    """
+    Calls a GET route of the app with the batch request's cookies and headers. Returns the status, content type and body.
+    """
+    scope = {key: request.scope[key] for key in ('type', 'asgi', 'http_version', 'scheme', 'server', 'client', 'root_path')
+             if key in request.scope}
+    scope.update(method='GET', path=path, raw_path=path.encode(), query_string=query.encode(),
+                 headers=[(k, v) for k, v in request.scope['headers'] if k not in HIDDEN_HEADERS])
+    started = False
+
+    async def receive():
+        nonlocal started
+        if not started:
+            started = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Lets the sub-query notice that the batch's client disconnected
+        return await request.receive()
+
+    response = {'status': 500, 'content_type': b'', 'body': []}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['content_type'] = dict(message.get('headers', [])).get(b'content-type', b'')
+        elif message['type'] == 'http.response.body':
+            response['body'].append(message.get('body', b''))
+
+    await request.app(scope, receive, send)
+    return response['status'], response['content_type'], b''.join(response['body'])
+
+async def run_batch(request: Request, queries: Dict[str, BatchQuery]) -> bytes:
+    """
+    Runs the sub-queries and returns the JSON object {name: {"status": ..., "body": ...}}
+    """
+    keys = {name: (batch_paths[query.op], query_string(query.params)) for name, query in queries.items()}
+    unique: List[Tuple[str, str]] = list(dict.fromkeys(keys.values()))
+    results = dict(zip(unique, await asyncio.gather(*(subrequest(request, path, query) for path, query in unique))))
+
+    parts = []
+    for name, key in keys.items():
+        code, content_type, body = results[key]
+        if not content_type.startswith(b'application/json'):
+            body = orjson.dumps(body.decode(errors='replace'))
+        parts.append(orjson.dumps(name) + b':{"status":%d,"body":%s}' % (code, body or b'null'))
+    return b'{' + b','.join(parts) + b'}'
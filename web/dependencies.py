@@ -1,10 +1,15 @@
 import os
+import threading
+import time
 from datetime import timedelta, datetime
+from functools import cache
+from hashlib import sha256
 from typing import Annotated
 
 from fastapi import Request, HTTPException, status, Header
 from pydantic import BaseModel
 import jwt
+from database.cache import LRUCache
 
 class RegisteredUserCompact(BaseModel):
     user_id: int
@@ -25,47 +30,93 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, os.getenv('JWTSECRET'), algorithm="HS256")
     return encoded_jwt
 
+# The user the HARUHIME_KEY service key authenticates as
+SERVICE_USER_ID = 12231334
+
+# Decoded session tokens by the sha256 of the token, so each token is only verified once until it expires
+token_cache = LRUCache(maxsize=4096)
+_service_identity = None
+_service_identity_lock = threading.Lock()
+
+@cache
+def admin_ids() -> frozenset:
+    """
+    The user ids in ADMINS, read once
+    """
+    return frozenset(x.strip() for x in (os.getenv('ADMINS') or '').split(',') if x.strip())
+
+def resolve_service_identity(sessionmaker=None) -> dict | None:
+    """
+    The payload of the service user, looked up once. Called at startup with the app's sessionmaker.
+    """
+    global _service_identity
+    with _service_identity_lock:
+        if _service_identity is None:
+            if sessionmaker is None:
+                from database.ORM import ORM
+                sessionmaker = ORM().sessionmaker
+            from database.models import RegisteredUser
+            session = sessionmaker()
+            try:
+                haruhime = session.get(RegisteredUser, SERVICE_USER_ID)
+                if haruhime is None:
+                    return None
+                _service_identity = {'user_id': haruhime.user_id, 'username': haruhime.username, 'avatar_url': haruhime.avatar_url, 'apikey': haruhime.apikey, 'catch_playtime': 172800}
+            finally:
+                session.close()
+        return _service_identity
+
+def service_identity(req: Request) -> dict | None:
+    """
+    The service user's payload if the request carries the service key
+    """
+    key = os.getenv('HARUHIME_KEY')
+    if key is None or req.headers.get('X-Authorization') != key:
+        return None
+    identity = resolve_service_identity()
+    if identity is None:
+        raise credentials_exception
+    return dict(identity)
+
+def decode_token(token: str) -> dict:
+    """
+    Verifies a session token and returns its payload. Raises credentials_exception if it is invalid or expired.
+    """
+    key = sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, os.getenv('JWTSECRET'), algorithms="HS256")
+        except jwt.InvalidTokenError:
+            raise credentials_exception
+        token_cache.set(key, payload)
+    elif 'exp' in payload and payload['exp'] <= time.time():
+        raise credentials_exception
+    return dict(payload)
+
 def has_token(req: Request) -> RegisteredUserCompact | bool:
     token = req.cookies.get('session_token')
     if token is None:
         return False
-    try:
-        payload = jwt.decode(token, os.getenv('JWTSECRET'), algorithms="HS256")
-    except jwt.InvalidTokenError:
-        raise credentials_exception
-    return payload
+    return decode_token(token)
 
 def verify_token(req: Request) -> RegisteredUserCompact:
-    if req.headers.get('X-Authorization') == os.getenv('HARUHIME_KEY'):
-        from database.ORM import ORM
-        from database.models import RegisteredUser
-        orm = ORM()
-        haruhime = orm.session.get(RegisteredUser, 12231334)
-        return {'user_id': haruhime.user_id, 'username': haruhime.username, 'avatar_url': haruhime.avatar_url, 'apikey': haruhime.apikey, 'catch_playtime': 172800}
+    identity = service_identity(req)
+    if identity is not None:
+        return identity
     token = req.cookies.get('session_token')
     if token is None:
         raise credentials_exception
-    try:
-        payload = jwt.decode(token, os.getenv('JWTSECRET'), algorithms="HS256")
-    except jwt.InvalidTokenError:
-        raise credentials_exception
-    return payload
+    return decode_token(token)
 
 def verify_admin(req: Request) -> RegisteredUserCompact:
-    if req.headers.get('X-Authorization') == os.getenv('HARUHIME_KEY'):
-        from database.ORM import ORM
-        from database.models import RegisteredUser
-        orm = ORM()
-        haruhime = orm.session.get(RegisteredUser, 12231334)
-        return {'user_id': haruhime.user_id, 'username': haruhime.username, 'avatar_url': haruhime.avatar_url, 'apikey': haruhime.apikey, 'catch_playtime': 172800}
+    identity = service_identity(req)
+    if identity is not None:
+        return identity
     token = req.cookies.get('session_token')
     if token is None:
         raise credentials_exception
-    try:
-        payload = jwt.decode(token, os.getenv('JWTSECRET'), algorithms="HS256")
-        admin_ids = os.getenv('ADMINS').split(',')
-        if str(payload['user_id']) not in admin_ids:
-            raise jwt.InvalidTokenError
-    except jwt.InvalidTokenError:
+    payload = decode_token(token)
+    if str(payload['user_id']) not in admin_ids():
         raise credentials_exception
-    return payload
\ No newline at end of file
+    return payload
@@ -0,0 +1,35 @@
+import hashlib
+from typing import Any
+import orjson
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+class ORJSONResponse(JSONResponse):
+    """
+    Serializes with orjson. Return it directly from a route to skip FastAPI's jsonable_encoder pass,
+    which matters for routes that return hundreds of score dicts.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def make_etag(*versions) -> str:
+    """
+    A strong ETag from version markers that change whenever the response would (max score ids, last_updated
+    timestamps, generations), so it can be computed before running the query it stands for
+    """
+    data = orjson.dumps(versions, option=orjson.OPT_NON_STR_KEYS, default=str)
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+def not_modified(request: Request, etag: str) -> Response or None:
+    """
+    A 304 response if the request's If-None-Match matches the ETag, otherwise None
+    """
+    header = request.headers.get('if-none-match')
+    if header is None:
+        return None
+    tags = {tag.strip() for tag in header.split(',')}
+    if '*' in tags or etag in tags or 'W/' + etag in tags:
+        return Response(status_code=304, headers={'ETag': etag})
+    return None
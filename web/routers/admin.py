@@ -1,10 +1,8 @@
 from typing import Annotated
 from fastapi import APIRouter, Query, status, Response
-from sqlalchemy import select
 from database.ORM import ORM
 import database.userService as userService
-from database.models import RegisteredUser, LeaderboardSpot
-from database.leaderboardService import recalculate_user
+from database.leaderboardService import recalculate_leaderboards
 
 router = APIRouter()
 orm = ORM()
@@ -33,19 +31,21 @@ def test():
     return {"message": "hello from /admin/test (hopefully)"}
 
 @router.post("/update_player")
-async def update_players(user_ids: Annotated[list[int] | None, Query()]):
+async def update_players(user_ids: Annotated[list[int], Query(min_length=1)]):
+    """
+    Recomputes the given users' spots on every leaderboard they are in
+    """
     session = orm.sessionmaker()
-
-    for user_id in user_ids:
-        # Get all leaderboards user is in
-        stmt = select(LeaderboardSpot).filter(LeaderboardSpot.user_id == user_id)
-        leaderboard_spots = session.scalars(stmt).all()
-        for leaderboard_spot in leaderboard_spots:
-            await recalculate_user(session, user_id, leaderboard_spot.leaderboard_id)
+    recalculate_leaderboards(session, user_ids)
+    session.close()
     return {"message": "Success"}
 
 @router.post("/update_all_players")
 async def update_all_players():
+    """
+    Recomputes every leaderboard
+    """
     session = orm.sessionmaker()
-    all_ids = session.execute(select(LeaderboardSpot.user_id.distinct())).scalars().all()
-    return await update_players(all_ids)
\ No newline at end of file
+    recalculate_leaderboards(session)
+    session.close()
+    return {"message": "Success"}
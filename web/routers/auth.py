@@ -12,6 +12,8 @@ from database.models import RegisteredUser, Leaderboard, LeaderboardSpot, Leader
 from database.scoreService import get_user_scores
 from database.util import parse_score_filters, parse_mod_filters
 from database.leaderboardService import recalculate_user
+import database.leaderboardIndex as leaderboardIndex
+from database.cache import generations
 from web.apiModels import Mode
 
 router = APIRouter()
@@ -68,6 +70,7 @@ def create_leaderboard(token: Annotated[RegisteredUserCompact, Depends(verify_to
         new_leaderboard.score_filters = score_filters
         new_leaderboard.beatmap_filters = beatmap_filters
         new_leaderboard.beatmapset_filters = beatmapset_filters
+        new_leaderboard.last_updated = datetime.datetime.now()
         session.add(new_leaderboard)
         session.commit()
     except Exception as e:
@@ -85,8 +88,11 @@ def delete_leaderboard(token: Annotated[RegisteredUserCompact, Depends(verify_to
             Leaderboard.creator_id == token.user_id
         ))
         leaderboard = session.scalars(stmt).one()
+        leaderboard_id = leaderboard.leaderboard_id
         session.delete(leaderboard)
         session.commit()
+        leaderboardIndex.forget(leaderboard_id)
+        generations.bump([('leaderboard', leaderboard_id)])
     except:
         return {"message": f"Either the leaderboard {leaderboard_name} does not exist, or you are not the creator of it"}
     return {"message": f"{leaderboard_name} has been successfully deleted"}
@@ -0,0 +1,166 @@
+import asyncio
+from functools import cache
+import orjson
+from fastapi import APIRouter, status, Query, Request, HTTPException, Depends
+from typing import Annotated, Literal
+from starlette.responses import StreamingResponse, FileResponse
+
+from database.ORM import ORM
+from database.util import parse_score_filters, parse_mod_filters, parse_beatmap_filters, parse_beatmapset_filters, \
+    parse_user_filters, parse_per_mode
+from database.scoreService import count_scores, stream_scores, estimate_query_cost
+from database.leaderboardService import pp_record_history
+from database.exporters import export_rows, export_formats
+from database.serializers import score_projection
+from database.jobs import JobRunner, Job, TooManyJobs
+from web.apiModels import Mode, ModeOrAll, ScoreGroupBy
+from web.responses import ORJSONResponse
+from web.admission import RouteLimit
+from web.dependencies import verify_token
+
+router = APIRouter()
+orm = ORM()
+
+# Count jobs may scan every table, but are priced like get_scores so one user cannot queue full scans back to back.
+# Only the cost and the timeout apply: the job pool bounds how many run at once.
+count_scores_limit = RouteLimit('jobs/count_scores', max_cost=20000, rate=20, burst=20000, timeout=600)
+
+@cache
+def get_runner() -> JobRunner:
+    # Sessions are opened through the ORM when a job runs, so creating the runner does not connect
+    return JobRunner(lambda: orm.sessionmaker())
+
+# How often the progress stream checks its job
+JOB_EVENTS_INTERVAL = 0.5
+
+def submit(token: dict, kind: str, params: dict, work) -> ORJSONResponse:
+    try:
+        job = get_runner().submit(kind, params, token['user_id'], work)
+    except TooManyJobs as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    return ORJSONResponse(job.to_dict(), status_code=status.HTTP_202_ACCEPTED,
+                          headers={'Location': '/jobs/%s' % job.job_id})
+
+def get_job(job_id: str, token: dict) -> Job:
+    job = get_runner().get(job_id)
+    # Other users' jobs are reported as missing, not forbidden
+    if job is None or job.user_id != token['user_id']:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job %s not found' % job_id)
+    return job
+
+@router.post('/pp_record_history', status_code=status.HTTP_202_ACCEPTED)
+def submit_pp_record_history(token: Annotated[dict, Depends(verify_token)], users: Annotated[list[int], Query()],
+                             mode: Mode = 'osu', per_user: bool = False):
+    """
+    Runs /stats/pp_record_history as a job
+    """
+    def work(session, job):
+        records = pp_record_history(session, users, mode, per_user)
+        return 'application/json', [orjson.dumps({"users": users, "mode": mode.name, "per_user": per_user,
+                                                  "length": len(records), "records": records})]
+
+    return submit(token, 'pp_record_history', {'users': users, 'mode': mode.name, 'per_user': per_user}, work)
+
+@router.post('/export', status_code=status.HTTP_202_ACCEPTED)
+def submit_export(token: Annotated[dict, Depends(verify_token)], user_id: int, mode: Mode = 'osu',
+                  export_format: Literal['ndjson', 'csv', 'parquet'] = 'ndjson',
+                  mod_filters: str = None,
+                  score_filters: str = None,
+                  beatmap_filters: str = None,
+                  beatmapset_filters: str = None):
+    """
+    Runs /stats/export as a job. The job's progress is the number of scores written so far.
+    """
+    parsed_mods_filters = parse_mod_filters(mode, mod_filters)
+    parsed_score_filters = parse_score_filters(mode, score_filters) + parse_user_filters(mode, user_id)
+    parsed_beatmap_filters = parse_beatmap_filters(beatmap_filters)
+    parsed_beatmapset_filters = parse_beatmapset_filters(beatmapset_filters)
+    header, columns = score_projection(mode, 'readable')
+
+    def work(session, job):
+        def counted(partitions):
+            for rows in partitions:
+                job.progress += len(rows)
+                yield rows
+
+        partitions = stream_scores(session, mode, columns, parsed_mods_filters, parsed_score_filters, parsed_beatmap_filters, parsed_beatmapset_filters)
+        return export_formats[export_format], export_rows(export_format, header, columns, counted(partitions))
+
+    params = {'user_id': user_id, 'mode': mode.name, 'export_format': export_format, 'mod_filters': mod_filters,
+              'score_filters': score_filters, 'beatmap_filters': beatmap_filters, 'beatmapset_filters': beatmapset_filters}
+    return submit(token, 'export', params, work)
+
+@router.post('/count_scores', status_code=status.HTTP_202_ACCEPTED)
+def submit_count_scores(token: Annotated[dict, Depends(verify_token)], users: Annotated[list[int] | None, Query()] = None,
+                        mode: ModeOrAll = 'osu', group_by: ScoreGroupBy = None, desc: bool = True,
+                        limit: Annotated[int, Query(le=10000)] = 1000,
+                        mod_filters: str = None,
+                        score_filters: str = None,
+                        beatmap_filters: str = None,
+                        beatmapset_filters: str = None):
+    """
+    Counts scores with the same filters as get_scores, in total or grouped by user, beatmap or rank.
+    Without users, every score in the database is counted.
+    Requests are priced by their filters and number of users: very expensive ones are refused, and each user's
+    expensive requests are rate limited (429 with Retry-After).
+    """
+    mode = mode.value
+    parsed_mods_filters = parse_per_mode(parse_mod_filters, mode, mod_filters)
+    parsed_score_filters = parse_per_mode(lambda m, f: parse_score_filters(m, f) + (parse_user_filters(m, users) if users else ()), mode, score_filters)
+    parsed_beatmap_filters = parse_beatmap_filters(beatmap_filters)
+    parsed_beatmapset_filters = parse_beatmapset_filters(beatmapset_filters)
+    group_by = group_by.value if group_by else None
+    count_scores_limit.charge(token['user_id'], estimate_query_cost(mode, len(users) if users else None, parsed_mods_filters,
+                                                                    parsed_score_filters, parsed_beatmap_filters,
+                                                                    parsed_beatmapset_filters))
+
+    def work(session, job):
+        counts = asyncio.run(count_scores(session, mode, group_by, desc, limit, parsed_mods_filters, parsed_score_filters,
+                                          parsed_beatmap_filters, parsed_beatmapset_filters, timeout=count_scores_limit.timeout))
+        return 'application/json', [orjson.dumps({"mode": mode, "group_by": group_by, "counts": counts})]
+
+    params = {'users': users, 'mode': mode, 'group_by': group_by, 'desc': desc, 'limit': limit, 'mod_filters': mod_filters,
+              'score_filters': score_filters, 'beatmap_filters': beatmap_filters, 'beatmapset_filters': beatmapset_filters}
+    return submit(token, 'count_scores', params, work)
+
+@router.get('/{job_id}', status_code=status.HTTP_200_OK)
+def get_job_status(job_id: str, token: Annotated[dict, Depends(verify_token)]):
+    """
+    Returns a job's status (queued, running, done or failed) and progress
+    """
+    return ORJSONResponse(get_job(job_id, token).to_dict())
+
+@router.get('/{job_id}/result', status_code=status.HTTP_200_OK)
+def get_job_result(job_id: str, token: Annotated[dict, Depends(verify_token)]):
+    """
+    Returns the result of a finished job. Results are kept for an hour after the job finishes.
+    """
+    job = get_job(job_id, token)
+    if job.status == 'failed':
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='Job failed: %s' % job.error)
+    if job.status != 'done':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Job is %s' % job.status)
+    return FileResponse(job.path, media_type=job.media_type)
+
+@router.get('/{job_id}/events', status_code=status.HTTP_200_OK)
+async def stream_job_events(job_id: str, request: Request, token: Annotated[dict, Depends(verify_token)]):
+    """
+    Server-sent events: a "job" event with the job's status whenever it changes, until the job finishes
+    """
+    job = get_job(job_id, token)
+
+    async def job_events():
+        nonlocal job
+        last = None
+        while True:
+            # A job run by another worker is a snapshot, so it is looked up again every time
+            job = get_runner().get(job_id) or job
+            state = job.to_dict()
+            if state != last:
+                yield b'event: job\ndata: ' + orjson.dumps(state) + b'\n\n'
+                last = state
+            if job.finished or await request.is_disconnected():
+                break
+            await asyncio.sleep(JOB_EVENTS_INTERVAL)
+
+    return StreamingResponse(job_events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
@@ -1,57 +1,95 @@
-from fastapi import APIRouter, status, Query, Request
-from typing import Optional, Annotated, Dict, List
+import datetime
+from fastapi import APIRouter, status, Query, Request, HTTPException, Depends
+from typing import Optional, Annotated, Dict, List, Literal
 from pydantic import BaseModel
+from starlette.responses import StreamingResponse, Response
 from sqlalchemy import select
 
 from database.ORM import ORM
 from database.models import RegisteredUser
 from database.util import parse_score_filters, parse_mod_filters, parse_beatmap_filters, parse_beatmapset_filters, \
-    parse_user_filters
+    parse_user_filters, parse_per_mode
 from database.userService import get_profile_pp, top_play_per_day
-from database.scoreService import get_top_n, get_scores, compact_scores_list
-from web.apiModels import Mode, Metric, ScoreGroupBy, ScoreReturnFormat
+from database.scoreService import get_top_n, select_scores, estimate_query_cost, compact_scores_list, next_cursor, stream_scores
+from database.exporters import export_rows, export_formats
+import database.scoreService as scoreService
+from database.leaderboardService import pp_record_history
+from database.timelineService import get_timeline
+from database.serializers import score_projection, mode_score_projection, beatmap_leaderboard_projection, rows_to_dicts, rows_to_compact
+from web.apiModels import Mode, ModeOrAll, Metric, ScoreGroupBy, ScoreReturnFormat, BatchRequest
+from web.responses import ORJSONResponse, make_etag, not_modified
+from web.admission import RouteLimit, run_query
+from web.batch import run_batch
+from web.dependencies import verify_token
+from database.cache import ResponseCache, MISSING, generations, normalize_params
 
 router = APIRouter()
 orm = ORM()
 
+top_cache = ResponseCache('stats/top')
+profile_pp_cache = ResponseCache('stats/profile_pp')
+score_history_cache = ResponseCache('stats/score_history')
+get_scores_limit = RouteLimit('stats/get_scores')
+
+def user_scores_etag(session, request: Request, user_id: int, mode: Mode) -> str:
+    """
+    ETag of a response computed from one user's scores: the user's latest score id and generation
+    """
+    return make_etag(request.url.path, normalize_params(request.query_params),
+                     scoreService.latest_user_score_id(session, user_id, mode), generations.get([('user', user_id)]))
+
 ScoreFilter = Query(default=None, description='Score Filters', example='rank/ABC pp>400 date>2020-04-24 perfect=1 replay=1')
 ModFilter = Query(default=None, description='Mod Filters', example='')
 BeatmapFilter = Query(default=None, description='Beatmap Filters')
 BeatmapsetFilter = Query(default=None, description='Beatmapset Filters')
 
 @router.get('/get_scores')
-async def get_user_scores_with_filters(users: Annotated[list[int] | None, Query()], mode: Mode = 'osu', metric: Metric = 'lazer-score', desc: bool = True, limit: Annotated[int, Query(le=100)] = 100,
+async def get_user_scores_with_filters(request: Request, token: Annotated[dict, Depends(verify_token)],
+               users: Annotated[list[int] | None, Query()], mode: ModeOrAll = 'osu', metric: Metric = 'lazer_score', desc: bool = True, limit: Annotated[int, Query(le=100)] = 100,
                mod_filters: str = None,
                score_filters: str = None,
                beatmap_filters: str = None,
-               beatmapset_filters: str = None, return_format: ScoreReturnFormat = 'readable'):
+               beatmapset_filters: str = None, return_format: ScoreReturnFormat = 'readable',
+               cursor: Annotated[str | None, Query(description='next_cursor from the previous page')] = None):
     """
     Find scores based on parameters.
     Must specify a list of users.
+    Results are paginated: pass the returned next_cursor to get the next page. next_cursor is null on the last page.
+    With mode=all the four modes are searched at once and every score has a "mode" key.
+    Requests are priced by their filters and number of users: very expensive ones are refused, and each user's
+    expensive requests are rate limited (429 with Retry-After).
     """
     session = orm.sessionmaker()
 
-    user_filter = parse_user_filters(mode, users)
-    parsed_mods_filters = parse_mod_filters(mode, mod_filters)
-    parsed_score_filters = parse_score_filters(mode, score_filters)
+    parsed_mods_filters = parse_per_mode(parse_mod_filters, mode, mod_filters)
+    parsed_score_filters = parse_per_mode(lambda m, f: parse_score_filters(m, f) + parse_user_filters(m, users), mode, score_filters)
     parsed_beatmap_filters = parse_beatmap_filters(beatmap_filters)
     parsed_beatmapset_filters = parse_beatmapset_filters(beatmapset_filters)
 
-    scores = await get_scores(session, mode, metric, desc, limit, parsed_mods_filters, parsed_score_filters+user_filter, parsed_beatmap_filters, parsed_beatmapset_filters)
-
-    if return_format == 'minimal':
-        scores = compact_scores_list(scores, metric)
-    elif return_format == 'verbose':
+    scores, page_cursor = [], None
+    if return_format != 'none':
+        header, columns = mode_score_projection(mode, return_format, metric)
+        cost = estimate_query_cost(mode, len(users) if users else None, parsed_mods_filters, parsed_score_filters,
+                                   parsed_beatmap_filters, parsed_beatmapset_filters)
+        try:
+            async with get_scores_limit.admit(token['user_id'], cost):
+                rows = await run_query(request, session, lambda: select_scores(
+                    session, mode, metric, desc, limit, parsed_mods_filters, parsed_score_filters, parsed_beatmap_filters,
+                    parsed_beatmapset_filters, columns=columns, cursor=cursor, timeout=get_scores_limit.timeout))
+        except ValueError as e:
+            session.close()
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        except HTTPException:
+            session.close()
+            raise
+        page_cursor = next_cursor(rows, metric, limit)
+        scores = rows_to_compact(header, rows) if return_format == 'compact' else rows_to_dicts(header, rows)
+    if return_format == 'verbose':
         users =  session.query(RegisteredUser.user_id, RegisteredUser.username, RegisteredUser.avatar_url).filter(RegisteredUser.user_id.in_(users)).all()
         users = [{"user id": x[0], "username": x[1], "avatar_url": x[2]} for x in users]
-        scores = [x.to_dict() | {'beatmap': x.beatmap.to_dict()} for x in scores]
-    elif return_format == 'none':
-        scores = []
-    else:
-        scores = [{"title" : x.beatmap.beatmapset.title, "difficulty name": x.beatmap.version} | x.to_dict()  for x in scores]
     session.close()
 
-    return {
+    return ORJSONResponse({
         "users": users,
         "mode": "mode",
         "metric": metric,
@@ -60,39 +98,53 @@ async def get_user_scores_with_filters(users: Annotated[list[int] | None, Query(
         "score_filters": score_filters,
         "beatmap_filters": beatmap_filters,
         "beatmapset_filters": beatmapset_filters,
-        "scores": scores}
+        "next_cursor": page_cursor,
+        "scores": scores})
 
 @router.get('/top', status_code=status.HTTP_200_OK)
-async def top_n(user_id: int, mode: Mode = 'osu', metric: Metric = 'pp', desc: bool = True, limit: Annotated[int, Query(le=100)] = 100, unique: bool = True,
+def top_n(request: Request, user_id: int, mode: ModeOrAll = 'osu', metric: Metric = 'pp', desc: bool = True, limit: Annotated[int, Query(le=100)] = 100, unique: bool = True,
                 mod_filters: str = None,
                 score_filters: str = None,
                 beatmap_filters: str = None,
                 beatmapset_filters: str = None,
-                return_format: ScoreReturnFormat = 'readable'):
+                return_format: ScoreReturnFormat = 'readable',
+                cursor: Annotated[str | None, Query(description='next_cursor from the previous page')] = None):
     """
-    Gets the top n pp scores from the user (limit 100) based on a set of filters
+    Gets the top n pp scores from the user (limit 100 per page) based on a set of filters
     - **unique:** Return only one score per beatmap
+    - **mode:** all merges the top plays of every mode, each with a "mode" key
+    - **cursor:** Pass the returned next_cursor to get the next page. next_cursor is null on the last page.
     """
-    parsed_mods_filters = parse_mod_filters(mode, mod_filters)
-    parsed_score_filters = parse_score_filters(mode, score_filters)
+    session = orm.sessionmaker()
+    etag = user_scores_etag(session, request, user_id, mode)
+    response = not_modified(request, etag)
+    if response is not None:
+        session.close()
+        return response
+    cache_key, cached = top_cache.lookup(request.query_params, [('user', user_id)], etag)
+    if cached is not MISSING:
+        session.close()
+        return ORJSONResponse(cached, headers={'ETag': etag})
+
+    parsed_mods_filters = parse_per_mode(parse_mod_filters, mode, mod_filters)
+    parsed_score_filters = parse_per_mode(parse_score_filters, mode, score_filters)
     parsed_beatmap_filters = parse_beatmap_filters(beatmap_filters)
     parsed_beatmapset_filters = parse_beatmapset_filters(beatmapset_filters)
 
-    session = orm.sessionmaker()
     limit = min(100, limit) # 100 is the max number of maps
-    top_plays = await get_top_n(session, user_id, mode, metric, desc, limit, unique, parsed_mods_filters, parsed_score_filters, parsed_beatmap_filters, parsed_beatmapset_filters)
-
-    if return_format == 'minimal':
-        top_plays = compact_scores_list(top_plays, metric)
-    elif return_format == 'verbose':
-        top_plays = [x.to_dict() | {'beatmap': x.beatmap.to_dict()} for x in top_plays]
-    elif return_format == 'none':
-        top_plays = []
-    else:
-        top_plays = [{"title" : x.beatmap.beatmapset.title, "difficulty name": x.beatmap.version} | x.to_dict()  for x in top_plays]
+    top_plays, page_cursor = [], None
+    if return_format != 'none':
+        header, columns = mode_score_projection(mode, return_format, metric)
+        try:
+            rows = get_top_n(session, user_id, mode, metric, desc, limit, unique, parsed_mods_filters, parsed_score_filters, parsed_beatmap_filters, parsed_beatmapset_filters, columns=columns, cursor=cursor)
+        except ValueError as e:
+            session.close()
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        page_cursor = next_cursor(rows, metric, limit)
+        top_plays = rows_to_compact(header, rows) if return_format == 'compact' else rows_to_dicts(header, rows)
 
     session.close()
-    return {'user_id': user_id,
+    response = {'user_id': user_id,
             'mode': mode.name,
             'metric': metric.name,
             'desc': desc,
@@ -101,10 +153,69 @@ async def top_n(user_id: int, mode: Mode = 'osu', metric: Metric = 'pp', desc: b
             'beatmap filters': beatmap_filters,
             'beatmapset filters': beatmapset_filters,
             'limit': limit,
+            'next_cursor': page_cursor,
             'top plays': top_plays}
+    top_cache.store(cache_key, response)
+    return ORJSONResponse(response, headers={'ETag': etag})
+
+@router.get('/beatmap_leaderboard', status_code=status.HTTP_200_OK)
+def get_beatmap_leaderboard(beatmap_id: int, mode: Mode = 'osu', metric: Metric = 'lazer_score', limit: Annotated[int, Query(le=100)] = 50,
+                            mod_filters: str = None,
+                            score_filters: str = None):
+    """
+    Ranks registered users by their best score on a beatmap
+    """
+    def load():
+        header, columns = beatmap_leaderboard_projection(mode)
+        session = orm.sessionmaker()
+        try:
+            rows = scoreService.get_beatmap_leaderboard(session, beatmap_id, mode, metric.name, limit,
+                                                        parse_mod_filters(mode, mod_filters), parse_score_filters(mode, score_filters), columns)
+        finally:
+            session.close()
+        # "rank" is the score's grade, so the leaderboard rank is "position"
+        return [{"position": i + 1} | score for i, score in enumerate(rows_to_dicts(header, rows))]
+
+    key = (mode.name, beatmap_id, metric.name, limit, mod_filters, score_filters)
+    scores = scoreService.beatmap_leaderboard_cache.get_or_load(key, load, tags=[(mode.name, beatmap_id)])
+    return ORJSONResponse({'beatmap_id': beatmap_id,
+                           'mode': mode.name,
+                           'metric': metric.name,
+                           'mods': mod_filters,
+                           'score filters': score_filters,
+                           'length': len(scores),
+                           'scores': scores})
+
+@router.get('/export', status_code=status.HTTP_200_OK)
+def export_scores(user_id: int, mode: Mode = 'osu', export_format: Literal['ndjson', 'csv', 'parquet'] = 'ndjson',
+                  mod_filters: str = None,
+                  score_filters: str = None,
+                  beatmap_filters: str = None,
+                  beatmapset_filters: str = None):
+    """
+    Streams all of a user's scores in a mode, with the same filters as get_scores.
+    - **export_format:** ndjson (one score per line), csv, or parquet
+    """
+    parsed_mods_filters = parse_mod_filters(mode, mod_filters)
+    parsed_score_filters = parse_score_filters(mode, score_filters) + parse_user_filters(mode, user_id)
+    parsed_beatmap_filters = parse_beatmap_filters(beatmap_filters)
+    parsed_beatmapset_filters = parse_beatmapset_filters(beatmapset_filters)
+    header, columns = score_projection(mode, 'readable')
+
+    def chunks():
+        session = orm.sessionmaker()
+        try:
+            partitions = stream_scores(session, mode, columns, parsed_mods_filters, parsed_score_filters, parsed_beatmap_filters, parsed_beatmapset_filters)
+            yield from export_rows(export_format, header, columns, partitions)
+        finally:
+            session.close()
+
+    filename = '%s_%s_scores.%s' % (user_id, mode.name, export_format)
+    return StreamingResponse(chunks(), media_type=export_formats[export_format],
+                             headers={'Content-Disposition': 'attachment; filename="%s"' % filename})
 
 @router.get('/profile_pp', status_code=status.HTTP_200_OK)
-async def profile_pp(user_id: int, mode: Mode = 'osu', metric: Metric = 'pp', desc: bool = True, limit: Annotated[int, Query(le=100)] = 100, unique: bool = True, bonus: bool = True,
+def profile_pp(request: Request, user_id: int, mode: Mode = 'osu', metric: Metric = 'pp', desc: bool = True, limit: Annotated[int, Query(le=100)] = 100, unique: bool = True, bonus: bool = True,
                 mod_filters: str = None,
                 score_filters: str = None,
                 beatmap_filters: str = None,
@@ -116,18 +227,30 @@ async def profile_pp(user_id: int, mode: Mode = 'osu', metric: Metric = 'pp', de
     - **n:** Number of scores to return (limit 100)
     - **bonus:** Whether to include max bonus pp in the calculation
     """
+    session = orm.sessionmaker()
+    etag = user_scores_etag(session, request, user_id, mode)
+    response = not_modified(request, etag)
+    if response is not None:
+        session.close()
+        return response
+    cache_key, cached = profile_pp_cache.lookup(request.query_params, [('user', user_id)], etag)
+    if cached is not MISSING:
+        session.close()
+        return ORJSONResponse(cached, headers={'ETag': etag})
+
     limit = min(100, limit)  # 100 is the max number of maps
     parsed_mods_filters = parse_mod_filters(mode, mod_filters)
     parsed_score_filters = parse_score_filters(mode, score_filters)
     parsed_beatmap_filters = parse_beatmap_filters(beatmap_filters)
     parsed_beatmapset_filters = parse_beatmapset_filters(beatmapset_filters)
 
-    session = orm.sessionmaker()
-    scores = await get_top_n(session, user_id, mode, metric, desc, limit, unique, parsed_mods_filters,
-                                parsed_score_filters, parsed_beatmap_filters, parsed_beatmapset_filters)
+    scores = get_top_n(session, user_id, mode, metric, desc, limit, unique, parsed_mods_filters,
+                          parsed_score_filters, parsed_beatmap_filters, parsed_beatmapset_filters, load_beatmap=True)
 
     total_pp = get_profile_pp(scores, bonus, limit)
-    return {'user_id': user_id,
+    top_plays = compact_scores_list(scores, 'pp')
+    session.close()
+    response = {'user_id': user_id,
             'mode': mode.name,
             'metric': metric.name,
             'desc': desc,
@@ -138,16 +261,62 @@ async def profile_pp(user_id: int, mode: Mode = 'osu', metric: Metric = 'pp', de
             'limit': limit,
             'unique': unique,
             'total pp': total_pp,
-            'top plays': compact_scores_list(scores, 'pp')}
+            'top plays': top_plays}
+    profile_pp_cache.store(cache_key, response)
+    return ORJSONResponse(response, headers={'ETag': etag})
+
+@router.get('/pp_record_history', status_code=status.HTTP_200_OK)
+def get_pp_record_history(users: Annotated[list[int], Query()], mode: Mode = 'osu', per_user: bool = False):
+    """
+    Returns every score that was a pp record when it was set, in date order.
+    - **per_user:** Track each user's own pp record. Otherwise, track the record among all the given users combined.
+    """
+    session = orm.sessionmaker()
+    records = pp_record_history(session, users, mode, per_user)
+    session.close()
+    return ORJSONResponse({"users": users, "mode": mode.name, "per_user": per_user, "length": len(records), "records": records})
+
+@router.get('/profile_pp_timeline', status_code=status.HTTP_200_OK)
+def get_profile_pp_timeline(user_id: int, mode: Mode = 'osu', start: datetime.datetime = None, end: datetime.datetime = None):
+    """
+    Returns the user's profile pp over time. There is a point for every score that changed their weighted top 100.
+    """
+    session = orm.sessionmaker()
+    timeline = get_timeline(session, user_id, mode, start, end)
+    session.close()
+    return ORJSONResponse({"user_id": user_id, "mode": mode.name, "length": len(timeline), "timeline": timeline})
 
 @router.get('/score_history', status_code=status.HTTP_200_OK)
-async def get_score_history(user_id: int, mode: Mode = 'osu', filter_string: Optional[str] = None, mod_string: Optional[str] = None, minimal: bool = True):
+def get_score_history(request: Request, user_id: int, mode: Mode = 'osu', filter_string: Optional[str] = None, mod_string: Optional[str] = None, minimal: bool = True):
     """
     Returns the player's month-to-month performance. This includes the highest pp play every month and the number of plays set per month
     """
+    session = orm.sessionmaker()
+    etag = user_scores_etag(session, request, user_id, mode)
+    response = not_modified(request, etag)
+    if response is not None:
+        session.close()
+        return response
+    cache_key, cached = score_history_cache.lookup(request.query_params, [('user', user_id)], etag)
+    if cached is not MISSING:
+        session.close()
+        return ORJSONResponse(cached, headers={'ETag': etag})
+
     filters = parse_score_filters(mode, filter_string)
     mods = parse_mod_filters(mode, mod_string)
-    session = orm.sessionmaker()
     scores = top_play_per_day(session, user_id, mode, filters, mods, minimal)
+    scores = [dict(x) for x in scores] if minimal else [x.to_dict() for x in scores]
     session.close()
-    return {"length": len(scores), "user_id": user_id, "mode": mode.name, "filters": filter_string, "mods": mod_string, "minimal": minimal, "scores": scores}
\ No newline at end of file
+    response = {"length": len(scores), "user_id": user_id, "mode": mode.name, "filters": filter_string, "mods": mod_string, "minimal": minimal, "scores": scores}
+    score_history_cache.store(cache_key, response)
+    return ORJSONResponse(response, headers={'ETag': etag})
+
+@router.post('/batch', status_code=status.HTTP_200_OK)
+async def batch(request: Request, body: BatchRequest):
+    """
+    Runs several stats queries at once and returns their results by name, e.g.
+    {"queries": {"top": {"op": "top", "params": {"user_id": 1}}, "pp": {"op": "profile_pp", "params": {"user_id": 1}}}}
+    returns {"top": {"status": 200, "body": ...}, "pp": {"status": 200, "body": ...}}.
+    The queries run concurrently and identical ones only run once. A failing query only fails its own entry.
+    """
+    return Response(await run_batch(request, body.queries), media_type='application/json')
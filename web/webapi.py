@@ -1,9 +1,13 @@
+import asyncio
 import datetime
+from contextlib import asynccontextmanager
 import importlib
+import orjson
 
-from fastapi import FastAPI, status, Request, Depends
+from fastapi import FastAPI, status, Request, Depends, Query, HTTPException
+from typing import Annotated
 from fastapi.templating import Jinja2Templates
-from starlette.responses import RedirectResponse, FileResponse
+from starlette.responses import RedirectResponse, FileResponse, StreamingResponse
 from sqlalchemy import select, func, or_
 import requests
 from hashlib import sha256
@@ -11,12 +15,20 @@ from starlette.staticfiles import StaticFiles
 
 from database.models import Leaderboard, LeaderboardSpot, RegisteredUser, BeatmapSet, Beatmap, OsuScore, TaikoScore, \
     CatchScore, ManiaScore
-from routers import admin, auth, stats
-from dependencies import verify_token, verify_admin, create_access_token, RegisteredUserCompact, has_token
+from routers import admin, auth, stats, jobs
+from web.dependencies import verify_token, verify_admin, create_access_token, RegisteredUserCompact, has_token, resolve_service_identity
 from database.ORM import ORM
 from database.userService import get_user_from_apikey, register_user, count_users, set_user_authentication
-from database.scoreService import count_scores
-from database.util import parse_score_filters
+import database.scoreService as scoreService
+import database.leaderboardService as leaderboardService
+import database.snapshotService as snapshotService
+import database.leaderboardIndex as leaderboardIndex
+import database.activityService as activityService
+from database.recentScores import get_recent_scores_buffer
+from database.jobs import sweep_results
+from database.cache import LRUCache, ResponseCache, MISSING, response_caches, generations, normalize_params
+from web.responses import ORJSONResponse, make_etag, not_modified
+from web.admission import route_limits
 import dotenv
 import os
 
@@ -50,7 +62,57 @@ tags_metadata = [
 with open("web/description.md", 'r') as f:
     description = f.read(-1)
 
-app = FastAPI(redoc_url=None, openapi_tags=tags_metadata, description=description)
+# Seconds between warm-up attempts while the database can't be reached
+WARMUP_RETRY = 5
+readiness = {'database': False, 'service_identity': False, 'recent_scores': False}
+
+def warm_up():
+    """
+    Opens the first pooled connection, looks up the service user and fills the recent scores buffer, skipping the steps
+    done by an earlier attempt
+    """
+    if not readiness['database']:
+        with orm.engine.connect() as connection:
+            connection.execute(select(1))
+        readiness['database'] = True
+    if not readiness['service_identity']:
+        if os.getenv('HARUHIME_KEY'):
+            resolve_service_identity(orm.sessionmaker)
+        readiness['service_identity'] = True
+    if not readiness['recent_scores']:
+        get_recent_scores_buffer(orm.sessionmaker)
+        readiness['recent_scores'] = True
+
+async def keep_warming_up():
+    while True:
+        try:
+            await asyncio.to_thread(warm_up)
+            return
+        except Exception as e:
+            print('Warm-up failed, retrying in %s seconds' % WARMUP_RETRY)
+            print(e)
+            await asyncio.sleep(WARMUP_RETRY)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm-up runs in the background, so the app starts serving (and /ready answers) even while the database is down
+    warmup = asyncio.create_task(keep_warming_up())
+    # Job results left behind by a previous run of the app
+    await asyncio.to_thread(sweep_results)
+    yield
+    warmup.cancel()
+
+app = FastAPI(redoc_url=None, openapi_tags=tags_metadata, description=description, lifespan=lifespan)
+
+@app.get('/ready', status_code=status.HTTP_200_OK)
+def get_readiness():
+    """
+    Returns 200 once the database pool is connected and the in-memory data is loaded, 503 until then
+    """
+    ready = all(readiness.values())
+    pool = orm.engine.pool.status() if readiness['database'] else None
+    return ORJSONResponse({'ready': ready, **readiness, 'pool': pool},
+                          status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
 
 @app.get("/", response_class=FileResponse)
 def main_page(request: Request, authorization: RegisteredUserCompact = Depends(has_token)):
@@ -141,64 +203,110 @@ def get_fetch_queue():
     """
     return {"message": "Moved to /fetch/fetch_queue"}
 
+def loaded_recent_scores_buffer():
+    """
+    The recent scores buffer once the warm-up has filled it, otherwise a 503. Filling it queries the database, which
+    must not happen on the event loop.
+    """
+    if not readiness['recent_scores']:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Recent scores are still loading, try again later',
+                            headers={'Retry-After': str(WARMUP_RETRY)})
+    return get_recent_scores_buffer(orm.sessionmaker)
+
 @app.get('/recent_scores', status_code=status.HTTP_200_OK)
-async def get_recent_scores(n: int=15):
+async def get_recent_scores(request: Request, n: int=15):
+    """
+    Returns the n most recent scores of every mode (max 15), served from memory
+    """
     n = min(n, 15)
-    session = orm.sessionmaker()
-    osu_scores = session.scalars(select(OsuScore).order_by(OsuScore.score_id.desc()).limit(n)).all()
-    taiko_scores = session.scalars(select(TaikoScore).order_by(TaikoScore.score_id.desc()).limit(n)).all()
-    catch_scores = session.scalars(select(CatchScore).order_by(CatchScore.score_id.desc()).limit(n)).all()
-    mania_scores = session.scalars(select(ManiaScore).order_by(ManiaScore.score_id.desc()).limit(n)).all()
-    scores_list = osu_scores+taiko_scores+catch_scores+mania_scores
-
-    return_list = []
-    for score in scores_list:
-        try:
-            return_list.append(score.beatmap.beatmapset.to_dict() | score.beatmap.to_dict() | score.to_dict() | {"mode": score.get_mode(), "username": score.user.username, "avatar_url": score.user.avatar_url})
-        except:
-            continue
+    buffer = loaded_recent_scores_buffer()
+    etag = make_etag('recent_scores', n, sorted(buffer.seen.items()))
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    return ORJSONResponse(buffer.latest(n), headers={'ETag': etag})
+
+# Seconds between keep-alive comments on an idle stream, which is also how often a disconnect is noticed
+STREAM_HEARTBEAT = 15
 
-    return_list.sort(key=lambda x: x['date'], reverse=True)
-    return return_list[:n]
+@app.get('/recent_scores/stream', status_code=status.HTTP_200_OK)
+async def stream_recent_scores(request: Request):
+    """
+    Server-sent events: a "scores" event with the new scores, newest first, whenever scores are fetched
+    """
+    buffer = loaded_recent_scores_buffer()
+    queue = buffer.listen()
+
+    async def scores_events():
+        try:
+            while True:
+                try:
+                    scores = await asyncio.wait_for(queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield b': keep-alive\n\n'
+                    continue
+                scores = sorted(scores, key=lambda x: x['date'], reverse=True)
+                yield b'event: scores\ndata: ' + orjson.dumps(scores, option=orjson.OPT_NON_STR_KEYS) + b'\n\n'
+        finally:
+            buffer.stop_listening(queue)
+
+    return StreamingResponse(scores_events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.get('/recent_summary', status_code=status.HTTP_200_OK)
-async def get_recent_summary(days: int = 1):
+def get_recent_summary(days: int = 1):
     """
     Returns the number of scores fetched in each mode for the past n days. (max 7 days)
     """
     days = min(7, days)
-    session = orm.sessionmaker()
-    import datetime
-
-    one_day = datetime.timedelta(days=1)
     today = datetime.date.today()
-    data = []
-    for day in range(days):
-        row = {'date': (today - day*one_day).strftime('%Y-%m-%d')}
-        filter_string = f'date>={(today - day*one_day).strftime('%Y-%m-%d')} date<={(today - (day-1)*one_day).strftime('%Y-%m-%d')}'
-        for mode in ['osu', 'taiko', 'fruits', 'mania']:
-            row[mode] = await count_scores(session, mode, score_filters=parse_score_filters(mode, filter_string))
-        data.append(row)
+    session = orm.sessionmaker()
+    counts = activityService.get_daily_counts(session, today - datetime.timedelta(days=days - 1), today)
     session.close()
-    return data
+    return [{'date': date.strftime('%Y-%m-%d')} | counts[date] for date in sorted(counts, reverse=True)]
+
+@app.get('/cache_stats', status_code=status.HTTP_200_OK)
+async def get_cache_stats():
+    """
+    Returns the size and hit/miss counts of each response cache
+    """
+    return {name: cache.stats() for name, cache in response_caches.items()}
+
+@app.get('/admission_stats', status_code=status.HTTP_200_OK)
+async def get_admission_stats():
+    """
+    Returns the running and rejected requests of each rate limited route
+    """
+    return {name: limit.stats() for name, limit in route_limits.items()}
+
+@app.get('/job_stats', status_code=status.HTTP_200_OK)
+async def get_job_stats():
+    """
+    Returns the number of background jobs of this worker in each status
+    """
+    return jobs.get_runner().stats()
+
+# The summary changes slowly and is on the landing page, so it is computed at most once a minute
+database_summary_cache = LRUCache(maxsize=1, ttl=60)
 
 @app.get('/database_summary', status_code=status.HTTP_200_OK)
-async def get_database_summary():
+def get_database_summary():
     """
     Returns the number of scores in the database
     """
-    session = orm.sessionmaker()
-    data = {'num_users': session.query(func.count(RegisteredUser.user_id)).scalar(),
-            'num_beatmapsets': session.query(func.count(BeatmapSet.beatmapset_id)).scalar(),
-            'num_beatmaps': session.query(func.count(Beatmap.beatmap_id)).scalar(),
-            'num_leaderboards': session.query(func.count(Leaderboard.leaderboard_id)).scalar(),
-            'num_leaderboardspots': session.query(func.count(LeaderboardSpot.leaderboard_id)).scalar(),}
-
-    for mode in ['osu', 'taiko', 'fruits', 'mania']:
-        data[mode] = await count_scores(session, mode=mode)
-    session.close()
+    def load():
+        session = orm.sessionmaker()
+        stmt = select(select(func.count(RegisteredUser.user_id)).scalar_subquery().label('num_users'),
+                      select(func.count(BeatmapSet.beatmapset_id)).scalar_subquery().label('num_beatmapsets'),
+                      select(func.count(Beatmap.beatmap_id)).scalar_subquery().label('num_beatmaps'),
+                      select(func.count(Leaderboard.leaderboard_id)).scalar_subquery().label('num_leaderboards'),
+                      select(func.count(LeaderboardSpot.leaderboard_id)).scalar_subquery().label('num_leaderboardspots'))
+        data = dict(session.execute(stmt).one()._mapping) | activityService.get_mode_totals(session)
+        session.close()
+        return data
 
-    return data
+    return database_summary_cache.get_or_load('summary', load)
 
 @app.get('/user_summary', status_code=status.HTTP_200_OK)
 async def get_user_summary():
@@ -209,36 +317,90 @@ async def get_user_summary():
     pass
 
 @app.get("/get_leaderboards", status_code=status.HTTP_200_OK)
-async def get_leaderboards():
+def get_leaderboards():
     session = orm.sessionmaker()
-    stmt = select(Leaderboard)
-    leaderboards = session.scalars(stmt).all()
+    leaderboards = leaderboardService.get_leaderboards(session)
     leaderboards = [x.to_dict() | {"creator_username": x.creator.username} for x in leaderboards]
     session.close()
 
     return leaderboards
 
+leaderboard_info_cache = ResponseCache('get_leaderboard_info')
+
 @app.get("/get_leaderboard_info", status_code=status.HTTP_200_OK)
-async def get_leaderboard_info(leaderboard_id: int = None, leaderboard_name: str = None):
+def get_leaderboard_info(request: Request, leaderboard_id: int = None, leaderboard_name: str = None,
+                         offset: Annotated[int, Query(ge=0)] = 0, limit: Annotated[int | None, Query(ge=1)] = None):
     """
-    Gets a leaderboard and all the tracked players on it. Only requires one identifier, not both
+    Gets a leaderboard and the tracked players on it, best first. Only requires one identifier, not both.
+    Use offset and limit to get a page of a large leaderboard.
+    Responses carry an ETag; send it back as If-None-Match to get a 304 while the standings are unchanged.
     """
     session = orm.sessionmaker()
-    stmt = select(Leaderboard).filter(or_(
-        Leaderboard.leaderboard_id == leaderboard_id,
-        Leaderboard.name == leaderboard_name
-    ))
     try:
-        leaderboard = session.scalars(stmt).one()
-        stmt = select(LeaderboardSpot).filter(LeaderboardSpot.leaderboard_id == leaderboard_id).order_by(LeaderboardSpot.value.desc())
-        leaderboard_spots = session.scalars(stmt).all()
-
-        expanded_leaderboard_spots = [{"value": x.value, "username": x.user.username, "user_id": x.user.user_id, "avatar_url": x.user.avatar_url} for x in leaderboard_spots]
+        stmt = select(Leaderboard.leaderboard_id, Leaderboard.last_updated)
+        if leaderboard_id is not None:
+            stmt = stmt.filter(Leaderboard.leaderboard_id == leaderboard_id)
+        else:
+            stmt = stmt.filter(Leaderboard.name == leaderboard_name)
+        leaderboard_id, last_updated = session.execute(stmt).one()
+        depends_on = [('leaderboard', leaderboard_id)]
+        etag = make_etag('get_leaderboard_info', normalize_params(request.query_params), last_updated, generations.get(depends_on))
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        cache_key, cached = leaderboard_info_cache.lookup(request.query_params, depends_on, etag)
+        if cached is MISSING:
+            index = leaderboardIndex.get_index(session, leaderboard_id, last_updated=last_updated)
+            cached = index.leaderboard | {"num_users": len(index), "offset": offset, "users": index.page(offset, limit)}
+            leaderboard_info_cache.store(cache_key, cached)
+        return ORJSONResponse(cached, headers={'ETag': etag})
+    except:
+        identifier = leaderboard_name if leaderboard_name is not None else leaderboard_id
+        return {"message": f"Something went wrong, are you sure the leaderboard {identifier} exists?"}
+    finally:
+        session.close()
 
-        return leaderboard.to_dict() | {"creator": {"username": leaderboard.creator.username, "user_id": leaderboard.creator.user_id, "avatar_url": leaderboard.creator.avatar_url}} | {"users": expanded_leaderboard_spots}
+@app.get("/leaderboard_rank", status_code=status.HTTP_200_OK)
+def get_leaderboard_rank(user_id: int, leaderboard_id: int = None, leaderboard_name: str = None):
+    """
+    Gets a user's rank and value on a leaderboard. Only requires one identifier, not both
+    """
+    session = orm.sessionmaker()
+    try:
+        index = leaderboardIndex.get_index(session, leaderboard_id, leaderboard_name)
     except:
         identifier = leaderboard_name if leaderboard_name is not None else leaderboard_id
         return {"message": f"Something went wrong, are you sure the leaderboard {identifier} exists?"}
+    finally:
+        session.close()
+    rank = index.rank(user_id)
+    if rank is None:
+        return {"message": f"{user_id} is not on {index.leaderboard['name']}"}
+    return {"leaderboard_id": index.leaderboard["leaderboard_id"], "user_id": user_id, "rank": rank,
+            "value": index.values[user_id], "num_users": len(index)}
+
+@app.get("/leaderboard_rank_history", status_code=status.HTTP_200_OK)
+def get_leaderboard_rank_history(leaderboard_id: int, user_id: int, start: datetime.datetime = None, end: datetime.datetime = None):
+    """
+    Returns a user's rank and value on a leaderboard in every snapshot since start
+    """
+    session = orm.sessionmaker()
+    history = snapshotService.get_rank_history(session, leaderboard_id, user_id, start, end)
+    session.close()
+    return ORJSONResponse({"leaderboard_id": leaderboard_id, "user_id": user_id, "length": len(history), "history": history})
+
+@app.get("/leaderboard_at", status_code=status.HTTP_200_OK)
+def get_leaderboard_at(leaderboard_id: int, timestamp: datetime.datetime, limit: int = None):
+    """
+    Returns the standings of a leaderboard as they were at a point in time
+    """
+    session = orm.sessionmaker()
+    standings = snapshotService.get_leaderboard_at(session, leaderboard_id, timestamp, limit)
+    session.close()
+    if standings is None:
+        return {"message": f"There is no snapshot of leaderboard {leaderboard_id} before {timestamp}"}
+    return ORJSONResponse({"leaderboard_id": leaderboard_id} | standings)
 
 app.include_router(
     auth.router,
@@ -251,6 +413,12 @@ app.include_router(
     tags=["stats"],
     dependencies=[Depends(verify_token)],
 )
+app.include_router(
+    jobs.router,
+    prefix="/jobs",
+    tags=["jobs"],
+    dependencies=[Depends(verify_token)],
+)
 app.include_router(
     admin.router,
     prefix="/admin",
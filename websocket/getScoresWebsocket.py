@@ -93,5 +93,7 @@ if __name__ == "__main__":
 
     from database.ORM import ORM
     from database.scoreService import insert_scores
+    # Subscribes the incremental leaderboard updates to new scores
+    import database.leaderboardService
     from database.models import RegisteredUser
     asyncio.run(run())
\ No newline at end of file